@@ -24,6 +24,15 @@ def run():
             print('Can\'t find settings.py. Run "marketmaker setup" to create project.')
 
 
+def supervise():
+    # import here rather than at the top because it depends on settings.py existing
+    try:
+        from market_maker import supervisor
+        supervisor.run()
+    except ImportError:
+        print('Can\'t find settings.py. Run "marketmaker setup" to create project.')
+
+
 def copy_files():
     package_base = os.path.dirname(__file__)
 
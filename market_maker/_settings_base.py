@@ -21,6 +21,20 @@ API_SECRET = ""
 # Instrument to market make on BitMEX.
 SYMBOL = "XBTUSD"
 
+# If True and no symbol is given on the command line, market make every symbol in CONTRACTS from one process.
+# The symbols share one websocket, one REST connection pool and one rate limit budget. Each gets its own
+# settings-<SYMBOL>.py layered on top of this file, as when running it alone.
+MULTI_SYMBOL = False
+
+# Symbols `marketmaker-supervisor` runs together in one worker process (as with MULTI_SYMBOL), e.g.
+# [["XBTUSD", "ETHUSD"], ["XBTZ20"]]. Each group's connection settings, API keys included, come from its first
+# symbol's settings. Leave empty to run each symbol in CONTRACTS in its own process.
+WORKER_GROUPS = []
+
+# Seconds before `marketmaker-supervisor` restarts a worker that crashed. Doubles with each crash in a row, up to
+# a minute.
+WORKER_RESTART_DELAY = 1
+
 
 ########################################################################################################################
 # Order Size & Spread
@@ -68,6 +82,11 @@ CHECK_POSITION_LIMITS = False
 MIN_POSITION = -10000
 MAX_POSITION = 10000
 
+# With `marketmaker-supervisor`, a limit on the account's total delta in XBT (at mark price, as calc_delta counts
+# it) across every worker using the same API key. Past it, every symbol stops quoting the side that would add to
+# it. None to disable.
+MAX_ACCOUNT_DELTA = None
+
 # If True, will only send orders that rest in the book (ExecInst: ParticipateDoNotInitiate).
 # Use to guarantee a maker rebate.
 # However -- orders that would have matched immediately will instead cancel, and you may end up with
@@ -87,17 +106,73 @@ DRY_RUN = False
 # order amend/replaces are done, you may hit a ratelimit. If so, email BitMEX if you feel you need a higher limit.
 LOOP_INTERVAL = 5
 
+# If True, re-quote when the websocket reports a change to our instrument's prices, our order book top, our
+# orders or our position, instead of polling every LOOP_INTERVAL seconds. LOOP_INTERVAL is then unused.
+EVENT_DRIVEN_LOOP = False
+
+# In event-driven mode, wait this many seconds after the first change before re-quoting, so a burst of related
+# messages (e.g. a fill's order, execution and position updates) is handled in a single tick.
+UPDATE_DEBOUNCE = 0.05
+
+# In event-driven mode, re-quote at least this often (in seconds) even if nothing has changed.
+MAX_IDLE_INTERVAL = 30
+
+# Pull our quotes (cancel our open orders and stop quoting) while our newest market data for the symbol is more than
+# this many seconds old by the exchange's timestamps, whether the feed is lagging or has stopped. Quoting resumes
+# once it catches up. Set it well above how long the instrument goes without an update when the market is quiet.
+# None to always quote.
+MAX_FEED_AGE = None
+
+# Maintain a local L2 order book from the websocket. Set to "orderBookL2_25" (top 25 levels) or "orderBookL2"
+# (full depth) to subscribe; the book's best bid/ask is then used for the ticker, and the book is available via
+# `ExchangeInterface.get_market_depth()`. None to only use bidPrice/askPrice from the instrument.
+ORDERBOOK_TABLE = None
+
+# How many rows to keep of the append-only websocket tables. These are kept in fixed-size ring buffers;
+# once full, each new row replaces the oldest. `recent_trades()` returns up to TABLE_CAPACITY['trade'] trades.
+TABLE_CAPACITY = {'trade': 200, 'quote': 200, 'execution': 200}
+
+# Path of a market data feed file written by `python -m market_maker.ws.feed` (e.g. "/dev/shm/bitmex-feed"). If set,
+# instruments, the top of the book and trades are read from it, and the websocket only subscribes to our
+# orders, executions, position and margin. Run one feed handler per host and point every bot there at it, so the
+# market data is received and decoded once. None to subscribe directly.
+MARKET_DATA_FEED = None
+
 # Wait times between orders / errors
 API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
 TIMEOUT = 7
 
+# Keep this many requests of the REST rate limit budget in hand. When creating and amending orders would eat into
+# it, the levels closest to the mid are updated first and the outer levels wait for a later tick.
+RATE_LIMIT_RESERVE = 10
+
 # If we're doing a dry run, use these numbers for BTC balances
 DRY_BTC = 50
 
+# If set, record every websocket frame and REST request/response to this file (gzipped JSON lines, appended to).
+# Recordings can be replayed with market_maker.utils.recorder.Replayer / ReplaySession, e.g. to reproduce an
+# incident or benchmark message handling against real traffic.
+RECORD_FILE = None
+
 # Available levels: logging.(DEBUG|INFO|WARN|ERROR)
 LOG_LEVEL = logging.INFO
 
+# Logging happens in a background thread, so a slow stdout or disk never holds up trading. Up to this many lines
+# wait for it; past that, lines are dropped (and how many is logged) rather than waited on.
+LOG_QUEUE_SIZE = 10000
+
+# If set, append every order we create, amend or cancel, and every fill, to this file as a line of JSON: the event,
+# our time() and the order's symbol, orderID, clOrdID, side, price and quantities.
+ORDER_EVENT_LOG = None
+
+# Every phase of the loop, REST request and websocket message is timed into a latency histogram. If METRICS_PORT is
+# set, they're served in Prometheus' text format at http://localhost:<METRICS_PORT>/metrics (with the supervisor,
+# worker N, counting from 0 in WORKER_GROUPS order, serves on METRICS_PORT + N). Every METRICS_LOG_INTERVAL seconds,
+# the p50, p99 and max of each over that interval are logged; 0 to not log them.
+METRICS_PORT = None
+METRICS_LOG_INTERVAL = 60
+
 # To uniquely identify orders placed by this bot, the bot sends a ClOrdID (Client order ID) that is attached
 # to each order so its source can be identified. This keeps the market maker from cancelling orders that are
 # manually placed, or orders placed by another bot.
@@ -110,6 +185,26 @@ ORDERID_PREFIX = "mm_bitmex_"
 # If any of these files (and this file) changes, reload the bot.
 WATCHED_FILES = [join('market_maker', 'market_maker.py'), join('market_maker', 'bitmex.py'), 'settings.py']
 
+# If True, keep our open orders when the bot restarts (e.g. because a watched file changed) rather than canceling
+# them and losing their place in the queue. On startup, open orders with our ORDERID_PREFIX are adopted into the
+# ladder and only amended where they differ from it. Shutting down still cancels everything.
+WARM_START = False
+
+# If set, keep BitMEX's dead man's switch (order/cancelAllAfter) armed with this timeout, in seconds (e.g. 60): if the
+# bot stops re-arming it because it hung, crashed or lost its connection, the exchange cancels every open order on
+# the account. It's re-armed every quarter of the timeout and disarmed on a clean shutdown. With WARM_START, make it
+# longer than a restart takes.
+DEAD_MANS_SWITCH = None
+
+# On shutdown, cancel with one order/all request for the symbol rather than by the IDs of the orders the websocket
+# shows. That also catches orders still on their way to us, but cancels every order on the symbol, including other
+# bots' and manual ones.
+CANCEL_ALL_ON_EXIT = False
+
+# If set, a directory to checkpoint each symbol's run to (as <symbol>.json): when it started, our position then,
+# and our open orders. With WARM_START, a restart carries on the same run from there.
+CHECKPOINT_DIR = None
+
 
 ########################################################################################################################
 # BitMEX Portfolio
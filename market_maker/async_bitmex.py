@@ -0,0 +1,91 @@
+"""asyncio interface to the BitMEX REST API."""
+from __future__ import absolute_import
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+class AsyncBitMEX(object):
+
+    """Sends BitMEX REST requests concurrently from asyncio.
+
+    Each call runs the matching `BitMEX` method, so auth (APIKeyAuthWithExpires), retries, rate limiting
+    and error handling are exactly the synchronous client's. Calls run on a pool of `concurrency` workers
+    sharing the BitMEX session, whose connection pool is sized to match so each worker keeps its own
+    keep-alive connection.
+
+    Await the coroutines from your own event loop, or use `run()` from synchronous code.
+
+    To share one worker pool between connectors for several symbols, pass it as `executor`; its owner
+    then sizes the session's connection pool (see `mount_pool`) and shuts it down.
+    """
+
+    def __init__(self, bitmex, concurrency=4, executor=None):
+        self.logger = logging.getLogger('root')
+        self.bitmex = bitmex
+        self.ownsExecutor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(concurrency)
+            mount_pool(bitmex.session, concurrency)
+        self.executor = executor
+        self.loop = None
+
+    def run(self, coroutine):
+        """Run a coroutine to completion from synchronous code."""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
+
+    def exit(self):
+        if self.ownsExecutor:
+            self.executor.shutdown(wait=False)
+        if self.loop is not None:
+            self.loop.close()
+
+    async def call(self, method, *args, **kwargs):
+        """Run a `BitMEX` method (e.g. 'cancel') on the worker pool."""
+        fn = functools.partial(getattr(self.bitmex, method), *args, **kwargs)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn)
+
+    async def place_order(self, quantity, price):
+        return await self.call('place_order', quantity, price)
+
+    async def amend_bulk_orders(self, orders):
+        return await self.call('amend_bulk_orders', orders)
+
+    async def create_bulk_orders(self, orders):
+        return await self.call('create_bulk_orders', orders)
+
+    async def cancel(self, orderID):
+        return await self.call('cancel', orderID)
+
+    async def http_open_orders(self):
+        return await self.call('http_open_orders')
+
+    async def isolate_margin(self, symbol, leverage, rethrow_errors=False):
+        return await self.call('isolate_margin', symbol, leverage, rethrow_errors=rethrow_errors)
+
+    async def submit_orders(self, to_amend, to_create, to_cancel):
+        """Amend, create and cancel orders concurrently; empty lists send nothing.
+
+        Returns [amended, created, canceled], each the call's result or the exception it raised.
+        """
+        async def noop(orders):
+            return orders
+
+        calls = [
+            self.amend_bulk_orders(to_amend) if to_amend else noop(to_amend),
+            self.create_bulk_orders(to_create) if to_create else noop(to_create),
+            self.cancel([order['orderID'] for order in to_cancel]) if to_cancel else noop(to_cancel),
+        ]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+
+def mount_pool(session, size):
+    """Keep up to `size` keep-alive connections in `session`, one per concurrent worker."""
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
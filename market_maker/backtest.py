@@ -0,0 +1,510 @@
+"""Backtest an OrderManager against recorded market data.
+
+    python -m market_maker.backtest XBTUSD recording.gz [--interval 5] [--strategy custom_strategy:CustomOrderManager]
+
+The recording is a RECORD_FILE capture (see utils.recorder). Its instrument, quote and trade streams drive
+a SimulatedExchange that stands in for ExchangeInterface. The order manager is ticked on a simulated clock
+instead of sleeping, so hours of data run in seconds. Run it from your marketmaker project, like the bot.
+"""
+from __future__ import absolute_import
+import argparse
+import importlib
+import json
+import logging
+import time
+
+import requests
+
+from market_maker.market_maker import OrderManager
+from market_maker.settings import settings
+from market_maker.utils import constants, errors, fastjson, ratelimit
+from market_maker.utils.math import tickLog, toNearest
+from market_maker.utils.recorder import Replayer
+from market_maker.utils.snapshot import TickSnapshot
+from market_maker.ws.orderbook import OrderBookL2
+
+logger = logging.getLogger('root')
+
+# BitMEX's default REST budget: 300 requests per 5 minutes.
+RATE_LIMIT = 300
+RATE_LIMIT_WINDOW = 300
+
+
+def market_events(path, symbol):
+    """Yield (time, table, row) for the instrument, quote and trade rows of `symbol` in a recording."""
+    for t, frame in Replayer(path).frames():
+        message = fastjson.loads(frame)
+        if message.get('table') not in ('instrument', 'quote', 'trade'):
+            continue
+        if message.get('action') not in ('partial', 'insert', 'update'):
+            continue
+        for row in message['data']:
+            if row.get('symbol') == symbol:
+                yield t, message['table'], row
+
+
+class SimulatedExchange(object):
+
+    """Stands in for ExchangeInterface, matching our orders against historical quotes and trades.
+
+    The model:
+    - Orders and amends are acknowledged at once (as the REST call would return) but can't fill until
+      `latency` seconds later.
+    - An order joining the best bid/ask queues behind the size displayed there; one inside the spread is
+      first in line; one behind the touch joins the queue when the market reaches it. Price changes and
+      size increases lose queue position, size decreases keep it.
+    - Trades at our price fill us after the size queued ahead; trades through our price fill us outright.
+      A quote crossing our price fills us at our price.
+    - Orders that would cross on entry take liquidity at the touch, or are canceled if `postOnly`.
+    - REST calls are charged like BitMEX: bulk create/amend 0.1 request per order (rounded up), cancels 1.
+    """
+
+    def __init__(self, symbol, events, latency=0.05, postOnly=False, balance=None, orderIDPrefix=None):
+        self.symbol = symbol
+        self.dry_run = False
+        self.events = iter(events)
+        self.nextEvent = next(self.events, None)
+        self.latency = latency
+        self.postOnly = postOnly
+        self.balance = settings.DRY_BTC if balance is None else balance
+        self.orderIDPrefix = orderIDPrefix or settings.ORDERID_PREFIX
+
+        self.now = self.nextEvent[0] if self.nextEvent else 0
+        self.startTime = self.now
+        self.instrument = None
+        self.bid = self.ask = self.bidSize = self.askSize = self.last = None
+        self.book = OrderBookL2(symbol)  # One level a side, from the quote; rebuilt by get_market_depth
+
+        self.orders = {}      # Live orders by orderID
+        self.queue = {}       # orderID -> size queued ahead of us at our price, None if behind the touch
+        self.activeAt = {}    # orderID -> time the order (or its last amend) reaches the book
+        self.nextOrderID = 1
+
+        self.position = {'symbol': symbol, 'currentQty': 0, 'avgCostPrice': 0, 'avgEntryPrice': 0}
+        self.cash = 0.0
+        self.requests = []    # (time, cost) of every REST call
+        self.rateLimiter = ratelimit.RateLimiter(RATE_LIMIT, RATE_LIMIT_WINDOW, clock=lambda: self.now)
+        self.stats = {'fills': 0, 'buyVolume': 0, 'sellVolume': 0, 'maxPosition': 0,
+                      'creates': 0, 'amends': 0, 'cancels': 0, 'rejects': 0}
+
+    #
+    # Simulation
+    #
+    def start(self):
+        """Run the market forward until we have an instrument and a two-sided quote."""
+        while self.instrument is None or self.bid is None or self.ask is None:
+            if self.nextEvent is None:
+                raise ValueError("Recording has no instrument and two-sided quote for %s" % self.symbol)
+            self.advance(self.nextEvent[0])
+
+    def advance(self, until):
+        """Apply market events up to `until`. Returns False once the recording is exhausted."""
+        while self.nextEvent is not None and self.nextEvent[0] <= until:
+            t, table, row = self.nextEvent
+            self.now = t
+            if table == 'instrument':
+                self._on_instrument(row)
+            elif table == 'quote':
+                self._on_quote(row)
+            else:
+                self._on_trade(row)
+            self.nextEvent = next(self.events, None)
+        self.now = max(self.now, until)
+        return self.nextEvent is not None
+
+    def report(self):
+        """Summarize the run: PnL marked to mid, fills, inventory and REST usage."""
+        qty = self.position['currentQty']
+        return {
+            'duration': self.now - self.startTime,
+            'pnl': self._pnl(),
+            'pnlCurrency': 'XBT' if self.instrument.get('isInverse') else 'quote currency',
+            'fills': self.stats['fills'],
+            'buyVolume': self.stats['buyVolume'],
+            'sellVolume': self.stats['sellVolume'],
+            'position': qty,
+            'maxPosition': self.stats['maxPosition'],
+            'openOrders': len(self.orders),
+            'creates': self.stats['creates'],
+            'amends': self.stats['amends'],
+            'cancels': self.stats['cancels'],
+            'rejects': self.stats['rejects'],
+            'requests': sum(cost for _, cost in self.requests),
+            'peakRequestsPerWindow': self._peak_requests(),
+            'rateLimit': RATE_LIMIT,
+        }
+
+    #
+    # ExchangeInterface
+    #
+    @property
+    def bitmex(self):
+        # OrderManager.exit() calls exchange.bitmex.exit()
+        return self
+
+    def exit(self):
+        pass
+
+    def get_instrument(self, symbol=None):
+        return self.instrument
+
+    def get_ticker(self, symbol=None):
+        ticker = {'last': self.last or self.bid, 'buy': self.bid, 'sell': self.ask, 'mid': (self.bid + self.ask) / 2}
+        return {k: toNearest(float(v), self.instrument['tickSize']) for k, v in ticker.items()}
+
+    def get_feed_latency(self, symbol=None):
+        # The recording's timestamps are all the clock there is; there's no feed to fall behind.
+        return {'age': None, 'lag': None, 'quoteAge': None, 'quoteTime': None, 'offset': None, 'tables': {}}
+
+    def get_position(self, symbol=None):
+        return self.position
+
+    def get_delta(self, symbol=None):
+        return self.position['currentQty']
+
+    def calc_delta(self):
+        qty = self.position['currentQty']
+        mid = (self.bid + self.ask) / 2
+        delta = qty / mid if self.instrument.get('isInverse') else qty * mid
+        return {'spot': delta, 'mark_price': delta, 'basis': 0}
+
+    def get_margin(self):
+        pnl = self._pnl() if self.instrument.get('isInverse') else 0
+        balance = (self.balance + pnl) * constants.XBt_TO_XBT
+        return {'marginBalance': balance, 'availableFunds': balance}
+
+    def get_orders(self):
+        return list(self.orders.values())
+
+    def get_highest_buy(self):
+        buys = [o for o in self.orders.values() if o['side'] == 'Buy']
+        return max(buys, key=lambda o: o['price']) if buys else {'price': -2**32}
+
+    def get_lowest_sell(self):
+        sells = [o for o in self.orders.values() if o['side'] == 'Sell']
+        return min(sells, key=lambda o: o['price']) if sells else {'price': 2**32}
+
+    def get_market_depth(self, symbol=None):
+        """The book as far as the recording's quotes show it: the best bid and ask, one level a side."""
+        rows = []
+        if self.bid is not None:
+            rows.append({'id': 0, 'side': 'Buy', 'price': self.bid, 'size': self.bidSize or 0})
+        if self.ask is not None:
+            rows.append({'id': 1, 'side': 'Sell', 'price': self.ask, 'size': self.askSize or 0})
+        self.book.partial(rows)
+        return self.book
+
+    def get_snapshot(self):
+        return TickSnapshot.capture(self)
+
+    def is_open(self):
+        return True
+
+    def wait_for_sync(self, timeout=None):
+        return True
+
+    def wait_for_update(self, timeout=None):
+        return set(), None
+
+    def check_market_open(self):
+        if self.instrument["state"] != "Open" and self.instrument["state"] != "Closed":
+            raise errors.MarketClosedError("The instrument %s is not open. State: %s" %
+                                           (self.symbol, self.instrument["state"]))
+
+    def check_if_orderbook_empty(self):
+        if self.bid is None or self.ask is None:
+            raise errors.MarketEmptyError("Orderbook is empty, cannot quote")
+
+    def get_order_budget(self):
+        return self.rateLimiter.budget(ratelimit.ORDER, settings.RATE_LIMIT_RESERVE)
+
+    def create_bulk_orders(self, orders):
+        self._charge(max(1, ratelimit.bulk_cost(len(orders))))
+        for order in orders:
+            orderID = str(self.nextOrderID)
+            self.nextOrderID += 1
+            order.update({'orderID': orderID, 'clOrdID': self.orderIDPrefix + orderID, 'symbol': self.symbol,
+                          'leavesQty': order['orderQty'], 'cumQty': 0, 'ordStatus': 'New'})
+            self.stats['creates'] += 1
+
+            crosses = order['price'] >= self.ask if order['side'] == 'Buy' else order['price'] <= self.bid
+            if crosses and self.postOnly:
+                order['ordStatus'] = 'Canceled'
+                self.stats['rejects'] += 1
+                continue
+            self.orders[orderID] = order
+            if crosses:
+                self._fill(order, order['leavesQty'], self.ask if order['side'] == 'Buy' else self.bid)
+            else:
+                self.queue[orderID] = self._queue_on_entry(order)
+                self.activeAt[orderID] = self.now + self.latency
+        return orders
+
+    def amend_bulk_orders(self, orders):
+        self._charge(max(1, ratelimit.bulk_cost(len(orders))))
+        for amend in orders:
+            order = self.orders.get(amend['orderID'])
+            if order is None:
+                self._reject('Invalid ordStatus')
+            self.stats['amends'] += 1
+
+            leavesQty = amend['orderQty'] - order['cumQty']
+            if leavesQty <= 0:
+                self._remove(order, 'Canceled')
+                continue
+            losesPriority = amend['price'] != order['price'] or leavesQty > order['leavesQty']
+            order.update({'orderQty': amend['orderQty'], 'price': amend['price'], 'leavesQty': leavesQty})
+            if losesPriority:
+                self.queue[order['orderID']] = self._queue_on_entry(order)
+            self.activeAt[order['orderID']] = self.now + self.latency
+        return orders
+
+    def cancel_bulk_orders(self, orders):
+        self._charge(1, ratelimit.CANCEL)
+        for order in orders:
+            if order['orderID'] in self.orders:
+                self._remove(self.orders[order['orderID']], 'Canceled')
+                self.stats['cancels'] += 1
+        return orders
+
+    def submit_orders(self, to_amend, to_create, to_cancel):
+        results = []
+        for send, orders in [(self.amend_bulk_orders, to_amend), (self.create_bulk_orders, to_create),
+                             (self.cancel_bulk_orders, to_cancel)]:
+            try:
+                results.append(send(orders) if orders else orders)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def cancel_all_orders(self):
+        self._charge(1, ratelimit.CANCEL)
+        for order in list(self.orders.values()):
+            self._remove(order, 'Canceled')
+            self.stats['cancels'] += 1
+
+    def adopt_orders(self):
+        # WARM_START: the run begins with whatever orders the exchange has, i.e. none.
+        return self.get_orders()
+
+    def kill(self):
+        orders = self.get_orders()
+        self.cancel_all_orders()
+        return orders
+
+    # Nothing is ever in flight, and there's no dead man's switch.
+    def halt(self):
+        pass
+
+    def finish_requests(self):
+        pass
+
+    def disarm(self):
+        pass
+
+    #
+    # Matching
+    #
+    def _on_instrument(self, row):
+        if self.instrument is None:
+            self.instrument = dict(row)
+        else:
+            self.instrument.update(row)
+        if 'tickSize' in row:
+            self.instrument['tickLog'] = tickLog(row['tickSize'])
+
+    def _on_quote(self, row):
+        self.bid, self.bidSize = row.get('bidPrice', self.bid), row.get('bidSize', self.bidSize)
+        self.ask, self.askSize = row.get('askPrice', self.ask), row.get('askSize', self.askSize)
+        if self.bid is None or self.ask is None:
+            return
+        self.instrument.update({'bidPrice': self.bid, 'askPrice': self.ask, 'midPrice': (self.bid + self.ask) / 2})
+
+        for order in list(self.orders.values()):
+            if not self._active(order):
+                continue
+            orderID, price = order['orderID'], order['price']
+            if order['side'] == 'Buy':
+                touch, touchSize, crossed = self.bid, self.bidSize, self.ask <= price
+            else:
+                touch, touchSize, crossed = self.ask, self.askSize, self.bid >= price
+            if crossed:
+                # The other side came to us, so we must have traded.
+                self._fill(order, order['leavesQty'], price)
+            elif price == touch:
+                # Size ahead of us can only shrink (cancels), or appear if we just reached the touch.
+                ahead = self.queue[orderID]
+                self.queue[orderID] = touchSize if ahead is None else min(ahead, touchSize)
+            elif (price > touch) == (order['side'] == 'Buy'):
+                self.queue[orderID] = 0  # We're improving the market.
+
+    def _on_trade(self, row):
+        price, remaining = row['price'], row['size']
+        self.last = price
+        self.instrument['lastPrice'] = price
+        # A sell aggressor trades against bids, best first, and vice versa.
+        side = 'Buy' if row['side'] == 'Sell' else 'Sell'
+        resting = sorted((o for o in self.orders.values() if o['side'] == side and self._active(o)),
+                         key=lambda o: -o['price'] if side == 'Buy' else o['price'])
+        for order in resting:
+            if remaining <= 0:
+                break
+            through = price < order['price'] if side == 'Buy' else price > order['price']
+            if through:
+                fill = min(order['leavesQty'], remaining)
+            elif price == order['price']:
+                ahead = self.queue[order['orderID']]
+                if ahead is None:
+                    ahead = remaining  # We were behind the touch; assume what traded was ahead of us.
+                fill = min(order['leavesQty'], max(0, remaining - ahead))
+                self.queue[order['orderID']] = max(0, ahead - remaining)
+            else:
+                break
+            if fill > 0:
+                remaining -= fill
+                self._fill(order, fill, order['price'])
+
+    def _pnl(self):
+        """Cash from fills plus the position marked to mid, in XBT for inverse contracts."""
+        mid = (self.bid + self.ask) / 2
+        if self.instrument.get('isInverse'):
+            return self.cash - self.position['currentQty'] / mid
+        return self.cash + self.position['currentQty'] * mid
+
+    def _queue_on_entry(self, order):
+        touch, touchSize = (self.bid, self.bidSize) if order['side'] == 'Buy' else (self.ask, self.askSize)
+        if order['price'] == touch:
+            return touchSize
+        if (order['price'] > touch) == (order['side'] == 'Buy'):
+            return 0
+        return None
+
+    def _active(self, order):
+        return self.activeAt.get(order['orderID'], 0) <= self.now
+
+    def _fill(self, order, qty, price):
+        order['cumQty'] += qty
+        order['leavesQty'] -= qty
+        if order['leavesQty'] <= 0:
+            self._remove(order, 'Filled')
+
+        signed = qty if order['side'] == 'Buy' else -qty
+        if self.instrument.get('isInverse'):
+            self.cash += signed / price
+        else:
+            self.cash -= signed * price
+
+        current = self.position['currentQty']
+        new = current + signed
+        if current == 0 or (current > 0) != (new > 0) and new != 0:
+            avg = price  # Opened or flipped
+        elif abs(new) > abs(current):
+            avg = (abs(current) * self.position['avgEntryPrice'] + qty * price) / abs(new)
+        else:
+            avg = self.position['avgEntryPrice'] if new != 0 else 0
+        self.position.update({'currentQty': new, 'avgEntryPrice': avg, 'avgCostPrice': avg})
+
+        self.stats['fills'] += 1
+        self.stats['buyVolume' if signed > 0 else 'sellVolume'] += qty
+        self.stats['maxPosition'] = max(self.stats['maxPosition'], abs(new))
+
+    def _remove(self, order, status):
+        order['ordStatus'] = status
+        self.orders.pop(order['orderID'], None)
+        self.queue.pop(order['orderID'], None)
+        self.activeAt.pop(order['orderID'], None)
+
+    def _reject(self, message):
+        """Fail the way BitMEX does, with a 400 carrying an error message."""
+        response = requests.Response()
+        response.status_code = 400
+        response._content = json.dumps({'error': {'message': message, 'name': 'HTTPError'}}).encode('utf8')
+        raise requests.exceptions.HTTPError(message, response=response)
+
+    def _charge(self, cost, cls=ratelimit.ORDER):
+        self.requests.append((self.now, cost))
+        self.rateLimiter.charge(cls, cost)
+
+    def _peak_requests(self):
+        """Most requests spent in any RATE_LIMIT_WINDOW."""
+        peak = spent = start = 0
+        for t, cost in self.requests:
+            spent += cost
+            while self.requests[start][0] <= t - RATE_LIMIT_WINDOW:
+                spent -= self.requests[start][1]
+                start += 1
+            peak = max(peak, spent)
+        return peak
+
+
+class Backtest(object):
+
+    """Ticks an OrderManager (sub)class against a SimulatedExchange, the way run_loop would."""
+
+    def __init__(self, exchange, orderManagerClass=OrderManager, interval=None):
+        self.exchange = exchange
+        self.orderManagerClass = orderManagerClass
+        self.interval = settings.LOOP_INTERVAL if interval is None else interval
+
+    def run(self):
+        """Run to the end of the data and return the exchange's report, plus ticks and wall time."""
+        wallStart = time.time()
+        self.exchange.start()
+        ticks = 0
+        try:
+            om = self.orderManagerClass(exchange=self.exchange)
+            while self.exchange.advance(self.exchange.now + self.interval):
+                ticks += 1
+                try:
+                    om.sanity_check()
+                except (errors.MarketClosedError, errors.MarketEmptyError) as e:
+                    logger.info("Skipping tick: %s" % e)
+                    continue
+                om.print_status()
+                om.place_orders()
+        except SystemExit:
+            logger.warning("Order manager exited at %.0fs into the data." %
+                           (self.exchange.now - self.exchange.startTime))
+
+        report = self.exchange.report()
+        report['ticks'] = ticks
+        report['wallTime'] = time.time() - wallStart
+        return report
+
+
+def load_class(path):
+    """Load 'module:Class', e.g. 'custom_strategy:CustomOrderManager'."""
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Backtest the market maker against a recording')
+    parser.add_argument('symbol', help='Instrument symbol to trade')
+    parser.add_argument('recording', help='A RECORD_FILE recording containing instrument, quote and trade data')
+    parser.add_argument('--interval', type=float, default=None, help='Seconds between ticks (default LOOP_INTERVAL)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds until orders and amends reach the book')
+    parser.add_argument('--strategy', default=None, help='OrderManager subclass to test, as module:Class')
+    parser.add_argument('--verbose', action='store_true', help='Show the order manager\'s logging')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    exchange = SimulatedExchange(args.symbol, market_events(args.recording, args.symbol),
+                                 latency=args.latency, postOnly=settings.POST_ONLY)
+    orderManagerClass = load_class(args.strategy) if args.strategy else OrderManager
+    report = Backtest(exchange, orderManagerClass, args.interval).run()
+
+    print("Simulated %.1f hours in %.1fs (%d ticks)" % (report['duration'] / 3600, report['wallTime'], report['ticks']))
+    print("PnL: %.8f %s" % (report['pnl'], report['pnlCurrency']))
+    print("Fills: %d (bought %d, sold %d)" % (report['fills'], report['buyVolume'], report['sellVolume']))
+    print("Position: %d (max %d), open orders: %d" % (report['position'], report['maxPosition'], report['openOrders']))
+    print("Orders: %d created, %d amended, %d canceled, %d rejected" %
+          (report['creates'], report['amends'], report['cancels'], report['rejects']))
+    print("REST requests: %d, peak %d per %ds (limit %d)" %
+          (report['requests'], report['peakRequestsPerWindow'], RATE_LIMIT_WINDOW, report['rateLimit']))
+
+
+if __name__ == "__main__":
+    run()
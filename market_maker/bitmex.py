@@ -7,8 +7,11 @@ import json
 import base64
 import uuid
 import logging
+import random
 from market_maker.auth import APIKeyAuthWithExpires
-from market_maker.utils import constants, errors
+from market_maker.utils import constants, errors, metrics, ratelimit
+from market_maker.ws import latency
+from market_maker.ws.feed import FeedReader
 from market_maker.ws.ws_thread import BitMEXWebsocket
 
 
@@ -17,9 +20,28 @@ class BitMEX(object):
 
     """BitMEX API Connector."""
 
+    # Transient REST failures are retried up to MAX_RETRIES times, backing off exponentially (with jitter)
+    # between these bounds, in seconds.
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_MIN = 0.1
+    RETRY_BACKOFF_MAX = 5
+
+    # Give up retrying order creates and amends after this many seconds; by then the next tick will
+    # have a better quote.
+    ORDER_DEADLINE = 3
+
     def __init__(self, base_url=None, symbol=None, apiKey=None, apiSecret=None,
-                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7):
-        """Init connector."""
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, orderBook=None,
+                 recorder=None, session=None, ws=None, rateLimiter=None, marketDataFeed=None):
+        """Init connector.
+
+        Pass a utils.recorder.Recorder as `recorder` to record all REST and websocket traffic.
+        `session` (a requests.Session), `ws` (a BitMEXWebsocket, already connected or replaying) and
+        `rateLimiter` (a utils.ratelimit.RateLimiter) replace the ones we'd otherwise create, e.g. to replay a
+        recording or to share them between connectors for several symbols. A `ws` passed in is the caller's
+        to close; so is the recorder then.
+        Pass the path of a ws.feed file as `marketDataFeed` to read market data from it rather than subscribing.
+        """
         self.logger = logging.getLogger('root')
         self.base_url = base_url
         self.symbol = symbol
@@ -33,18 +55,22 @@ class BitMEX(object):
         if len(orderIDPrefix) > 13:
             raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
         self.orderIDPrefix = orderIDPrefix
-        self.retries = 0  # initialize counter
+        self.recorder = recorder
+        self.rateLimiter = rateLimiter or ratelimit.RateLimiter()
 
         # Prepare HTTPS session
-        self.session = requests.Session()
+        self.session = session or requests.Session()
         # These headers are always sent
         self.session.headers.update({'user-agent': 'liquidbot-' + constants.VERSION})
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
 
         # Create websocket for streaming data
-        self.ws = BitMEXWebsocket()
-        self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth)
+        self.ownsWs = ws is None
+        if ws is None:
+            ws = BitMEXWebsocket(recorder=recorder, feed=FeedReader(marketDataFeed) if marketDataFeed else None)
+            ws.connect(base_url, symbol, shouldAuth=shouldWSAuth, orderBook=orderBook)
+        self.ws = ws
 
         self.timeout = timeout
 
@@ -52,7 +78,11 @@ class BitMEX(object):
         self.exit()
 
     def exit(self):
+        if not self.ownsWs:
+            return
         self.ws.exit()
+        if self.recorder:
+            self.recorder.close()
 
     #
     # Public methods
@@ -73,12 +103,28 @@ class BitMEX(object):
             query['filter'] = json.dumps(filter)
         return self._curl_bitmex(path='instrument', query=query, verb='GET')
 
-    def market_depth(self, symbol):
-        """Get market depth / orderbook."""
+    def feed_latency(self, symbol=None):
+        """How far behind the exchange our market data is. See ws.latency.FeedLatency.status."""
+        if symbol is None:
+            symbol = self.symbol
+        return self.ws.feed_latency(symbol)
+
+    def market_depth(self, symbol=None):
+        """Get market depth / orderbook. Returns an OrderBookL2; requires the `orderBook` subscription."""
+        if symbol is None:
+            symbol = self.symbol
         return self.ws.market_depth(symbol)
 
-    def recent_trades(self):
-        """Get recent trades.
+    def wait_for_sync(self, timeout=None):
+        """Block until realtime data is rebuilt after a websocket reconnect. Returns False on timeout."""
+        return self.ws.wait_for_sync(timeout)
+
+    def wait_for_update(self, timeout=None):
+        """Block until market or account data for our symbol changes. See BitMEXWebsocket.wait_for_update."""
+        return self.ws.wait_for_update(timeout, self.symbol)
+
+    def recent_trades(self, count=None):
+        """Get the most recent `count` trades (default: all kept), oldest first.
 
         Returns
         -------
@@ -89,7 +135,7 @@ class BitMEX(object):
                u'tid': u'93842'},
 
         """
-        return self.ws.recent_trades()
+        return self.ws.recent_trades(count)
 
     #
     # Authentication required methods
@@ -152,7 +198,7 @@ class BitMEX(object):
 
         endpoint = "order"
         # Generate a unique clOrdID with our prefix so we can identify it.
-        clOrdID = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+        clOrdID = self._new_clOrdID()
         postdict = {
             'symbol': self.symbol,
             'orderQty': quantity,
@@ -163,24 +209,47 @@ class BitMEX(object):
 
     @authentication_required
     def amend_bulk_orders(self, orders):
-        """Amend multiple orders."""
+        """Amend multiple orders.
+
+        Orders we know are moved to a fresh clOrdID by the amend (origClOrdID -> clOrdID). That makes the
+        amend safe to retry: if an earlier attempt was applied, the retry no longer finds the origClOrdID.
+        """
+        amends = []
+        for order in orders:
+            amend = dict(order)
+            current = self.ws.get_order(amend['orderID']) if 'orderID' in amend else None
+            if current is not None and current['clOrdID'] and 'clOrdID' not in amend:
+                del amend['orderID']
+                amend.update({'origClOrdID': current['clOrdID'], 'clOrdID': self._new_clOrdID()})
+            amends.append(amend)
         # Note rethrow; if this fails, we want to catch it and re-tick
-        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True)
+        return self._curl_bitmex(path='order/bulk', postdict={'orders': amends}, verb='PUT', rethrow_errors=True,
+                                 deadline=time.time() + BitMEX.ORDER_DEADLINE)
 
     @authentication_required
     def create_bulk_orders(self, orders):
         """Create multiple orders."""
         for order in orders:
-            order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+            order['clOrdID'] = self._new_clOrdID()
             order['symbol'] = self.symbol
             if self.postOnly:
                 order['execInst'] = 'ParticipateDoNotInitiate'
-        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='POST')
+        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='POST',
+                                 deadline=time.time() + BitMEX.ORDER_DEADLINE)
+
+    def order_budget(self, reserve=0):
+        """How many order placement/amend requests we can send now, keeping `reserve` in hand."""
+        return self.rateLimiter.budget(ratelimit.ORDER, reserve)
 
     @authentication_required
     def open_orders(self):
         """Get open orders."""
-        return self.ws.open_orders(self.orderIDPrefix)
+        return self.ws.open_orders(self.orderIDPrefix, self.symbol)
+
+    @authentication_required
+    def executions(self):
+        """Get our recent executions."""
+        return self.ws.executions(self.symbol)
 
     @authentication_required
     def http_open_orders(self):
@@ -206,6 +275,30 @@ class BitMEX(object):
         }
         return self._curl_bitmex(path=path, postdict=postdict, verb="DELETE")
 
+    @authentication_required
+    def cancel_all(self, symbol=None):
+        """Cancel every open order on `symbol` (default: ours) in one request, including ones we didn't place."""
+        path = "order/all"
+        postdict = {
+            'symbol': symbol or self.symbol,
+        }
+        return self._curl_bitmex(path=path, postdict=postdict, verb="DELETE")
+
+    @authentication_required
+    def cancel_all_after(self, timeout, deadline=None):
+        """Arm the exchange's dead man's switch: it cancels every open order on the account, on all symbols, unless
+           this is called again within `timeout` milliseconds. A timeout of 0 disarms it.
+
+        Errors are raised, never exited on, and a 429 doesn't cancel our orders: the caller re-arms on its own
+        schedule. Re-arming is idempotent, so it's retried (even after a timeout) until `deadline` (a time.time()), if
+        given."""
+        path = "order/cancelAllAfter"
+        postdict = {
+            'timeout': timeout,
+        }
+        return self._curl_bitmex(path=path, postdict=postdict, verb="POST", rethrow_errors=True, deadline=deadline,
+                                 max_retries=BitMEX.MAX_RETRIES, cancel_on_ratelimit=False)
+
     @authentication_required
     def withdraw(self, amount, fee, address):
         path = "user/requestWithdrawal"
@@ -217,9 +310,19 @@ class BitMEX(object):
         }
         return self._curl_bitmex(path=path, postdict=postdict, verb="POST", max_retries=0)
 
+    def _new_clOrdID(self):
+        """Generate a unique clOrdID with our prefix so we can identify our orders."""
+        return self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+
     def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
-                     max_retries=None):
-        """Send a request to BitMEX Servers."""
+                     max_retries=None, deadline=None, cancel_on_ratelimit=True):
+        """Send a request to BitMEX Servers.
+
+        Transient failures (timeouts, connection errors, 503s, 429s) are retried with jittered exponential
+        backoff, up to `max_retries` times and, if `deadline` (a time.time()) is given, only while it hasn't
+        passed; each attempt's timeout is cut short to fit. On a 429, our open orders are canceled while we wait
+        for the rate limit to reset, unless `cancel_on_ratelimit` is False.
+        """
         # Handle URL
         url = self.base_url + path
 
@@ -230,13 +333,56 @@ class BitMEX(object):
         if not verb:
             verb = 'POST' if postdict else 'GET'
 
-        # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
+        # A 429 or 503 means the request wasn't applied, so it can always be retried. After a timeout or a lost
+        # connection we can't tell, so by default those are only retried for requests that can't be applied
+        # twice. GET/DELETE are idempotent. Order creates carry a clOrdID, so a duplicate is rejected and
+        # recovered below; amends from amend_bulk_orders rotate origClOrdID -> clOrdID, so a retry of an applied
+        # amend finds nothing.
+        unappliedRetries = uncertainRetries = max_retries
         if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
-
+            unappliedRetries = BitMEX.MAX_RETRIES
+            uncertainRetries = BitMEX.MAX_RETRIES if self._is_retry_safe(verb, path, postdict) else 0
+
+        attempt = 0
+        while True:
+            attemptTimeout = timeout
+            if deadline is not None:
+                attemptTimeout = min(timeout, max(0.1, deadline - time.time()))
+            try:
+                return self._send_request(url, path, query, postdict, attemptTimeout, verb, rethrow_errors,
+                                          retrying=attempt > 0, cancel_on_ratelimit=cancel_on_ratelimit)
+            except _Retry as r:
+                attempt += 1
+                if attempt > (unappliedRetries if r.unapplied else uncertainRetries):
+                    raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
+                wait = r.wait if r.wait is not None else self._backoff(attempt)
+                if deadline is not None and time.time() + wait >= deadline:
+                    raise Exception("Deadline passed retrying %s (%s), raising." % (path, json.dumps(postdict or '')))
+                time.sleep(wait)
+
+    @staticmethod
+    def _backoff(attempt):
+        """Seconds to wait before retry number `attempt`: exponential, with full jitter."""
+        ceiling = min(BitMEX.RETRY_BACKOFF_MAX, BitMEX.RETRY_BACKOFF_MIN * 2 ** (attempt - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+    @staticmethod
+    def _is_retry_safe(verb, path, postdict):
+        """Whether sending this request twice can't apply it twice."""
+        if verb in ['GET', 'DELETE']:
+            return True
+        if path.strip('/') not in ['order', 'order/bulk'] or not postdict:
+            return False
+        orders = postdict.get('orders', [postdict])
+        if verb == 'POST':
+            return all(o.get('clOrdID') for o in orders)
+        if verb == 'PUT':
+            return all(o.get('origClOrdID') and o.get('clOrdID') for o in orders)
+        return False
+
+    def _send_request(self, url, path, query, postdict, timeout, verb, rethrow_errors, retrying=False,
+                      cancel_on_ratelimit=True):
+        """Make one attempt at a request. Raises _Retry if it should be retried."""
         # Auth: API Key/Secret
         auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
 
@@ -246,11 +392,11 @@ class BitMEX(object):
             else:
                 exit(1)
 
-        def retry():
-            self.retries += 1
-            if self.retries > max_retries:
-                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries)
+        # Wait out our own estimate of the rate limit rather than be 429'd.
+        wait = self.rateLimiter.wait_time(verb, path, postdict)
+        if wait > 0:
+            self.logger.warning("Rate limit budget spent, waiting %.1fs before %s %s." % (wait, verb, path))
+            time.sleep(wait)
 
         # Make the request
         response = None
@@ -258,7 +404,13 @@ class BitMEX(object):
             self.logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
             req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
             prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
+            sent = time.time()
+            response = self._send_timed(prepped, verb, path, timeout)
+            received = time.time()
+            self.rateLimiter.spend(verb, path, postdict)
+            self.rateLimiter.update(verb, path, response.headers)
+            if self.recorder:
+                self.recorder.record_rest(verb, url, query, postdict, response=response)
             # Make non-200s throw
             response.raise_for_status()
 
@@ -277,6 +429,8 @@ class BitMEX(object):
 
             # 404, can be thrown if order canceled or does not exist.
             elif response.status_code == 404:
+                if retrying and verb == 'PUT':
+                    return self._recover_amend(postdict, e)
                 if verb == 'DELETE':
                     self.logger.error("Order not found: %s" % postdict['orderID'])
                     return
@@ -296,45 +450,50 @@ class BitMEX(object):
                 reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
 
                 # We're ratelimited, and we may be waiting for a long time. Cancel orders.
-                self.logger.warning("Canceling all known orders in the meantime.")
-                self.cancel([o['orderID'] for o in self.open_orders()])
+                if cancel_on_ratelimit:
+                    self.logger.warning("Canceling all known orders in the meantime.")
+                    self.cancel([o['orderID'] for o in self.open_orders()])
 
                 self.logger.error("Your ratelimit will reset at %s. Sleeping for %d seconds." % (reset_str, to_sleep))
-                time.sleep(to_sleep)
-
-                # Retry the request.
-                return retry()
+                raise _Retry(max(0, to_sleep), unapplied=True)
 
             # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
             elif response.status_code == 503:
                 self.logger.warning("Unable to contact the BitMEX API (503), retrying. " +
                                     "Request: %s \n %s" % (url, json.dumps(postdict)))
-                time.sleep(3)
-                return retry()
+                retryAfter = response.headers.get('Retry-After')
+                raise _Retry(float(retryAfter) if retryAfter else None, unapplied=True)
 
             elif response.status_code == 400:
                 error = response.json()['error']
                 message = error['message'].lower() if error else ''
 
-                # Duplicate clOrdID: that's fine, probably a deploy, go get the order(s) and return it
+                # Duplicate clOrdID: that's fine, probably a deploy or a retry of a create that went through.
+                # Go get the order(s) and return them.
                 if 'duplicate clordid' in message:
-                    orders = postdict['orders'] if 'orders' in postdict else postdict
+                    orders = postdict['orders'] if 'orders' in postdict else [postdict]
+                    byClOrdID = dict((order['clOrdID'], order) for order in orders)
 
-                    IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
-                    orderResults = self._curl_bitmex('/order', query={'filter': IDs}, verb='GET')
+                    IDs = json.dumps({'clOrdID': list(byClOrdID)})
+                    orderResults = self._curl_bitmex('order', query={'filter': IDs}, verb='GET')
 
-                    for i, order in enumerate(orderResults):
+                    for order in orderResults:
+                        posted = byClOrdID[order['clOrdID']]
+                        side = posted.get('side') or ('Buy' if posted['orderQty'] > 0 else 'Sell')
                         if (
-                                order['orderQty'] != abs(postdict['orderQty']) or
-                                order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
-                                order['price'] != postdict['price'] or
-                                order['symbol'] != postdict['symbol']):
+                                order['orderQty'] != abs(posted['orderQty']) or
+                                order['side'] != side or
+                                order['price'] != posted['price'] or
+                                order['symbol'] != posted['symbol']):
                             raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
                                             'did not match POST.\nPOST data: %s\nReturned order: %s' % (
-                                                json.dumps(orders[i]), json.dumps(order)))
+                                                json.dumps(posted), json.dumps(order)))
                     # All good
                     return orderResults
 
+                elif retrying and verb == 'PUT' and 'origclordid' in message:
+                    return self._recover_amend(postdict, e)
+
                 elif 'insufficient available balance' in message:
                     self.logger.error('Account out of funds. The message: %s' % error['message'])
                     exit_or_throw(Exception('Insufficient Funds'))
@@ -346,17 +505,58 @@ class BitMEX(object):
             exit_or_throw(e)
 
         except requests.exceptions.Timeout as e:
+            if self.recorder:
+                self.recorder.record_rest(verb, url, query, postdict, error=e)
             # Timeout, re-run this request
             self.logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
-            return retry()
+            raise _Retry()
 
         except requests.exceptions.ConnectionError as e:
+            if self.recorder:
+                self.recorder.record_rest(verb, url, query, postdict, error=e)
             self.logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. " +
                                 "Request: %s %s \n %s" % (e, url, json.dumps(postdict)))
-            time.sleep(1)
-            return retry()
-
-        # Reset retry counter on success
-        self.retries = 0
-
-        return response.json()
+            raise _Retry()
+
+        result = response.json()
+        if verb != 'GET':
+            # Changes are stamped with the exchange's time as it makes them; what we read can be older.
+            latency.exchangeClock.sample_response(sent, received, result)
+        return result
+
+    def _send_timed(self, prepped, verb, path, timeout):
+        """Send a prepared request, timing it by endpoint and outcome: its HTTP status, or timeout or error."""
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.send(prepped, timeout=timeout)
+            status = str(response.status_code)
+            return response
+        except requests.exceptions.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            metrics.histogram('rest_request_seconds', verb=verb, path=path.strip('/'), status=status).record(
+                time.perf_counter() - start)
+
+    def _recover_amend(self, postdict, error):
+        """A retried amend found its origClOrdIDs gone. If every order now has the clOrdID we moved it to,
+           an earlier attempt was applied: return the orders. Otherwise re-raise `error`."""
+        amends = postdict['orders'] if 'orders' in postdict else [postdict]
+        IDs = json.dumps({'clOrdID': [amend['clOrdID'] for amend in amends]})
+        orderResults = self._curl_bitmex('order', query={'filter': IDs}, verb='GET')
+        if len(orderResults) != len(amends):
+            raise error
+        self.logger.info("Amend was applied by an earlier attempt; recovered %d orders." % len(orderResults))
+        return orderResults
+
+
+class _Retry(Exception):
+
+    """Raised by BitMEX._send_request when a request should be retried, after `wait` seconds (None: back off).
+       `unapplied` if the exchange said it didn't apply the request (a 429 or 503), rather than our not knowing."""
+
+    def __init__(self, wait=None, unapplied=False):
+        super(_Retry, self).__init__()
+        self.wait = wait
+        self.unapplied = unapplied
@@ -0,0 +1,785 @@
+"""A local stand-in for BitMEX, for integration and load testing without network access.
+
+    python -m market_maker.emulator [--port 3000] [--symbol XBTUSD] [--key KEY:SECRET] [--tick 1]
+
+Then point BASE_URL at http://localhost:3000/api/v1/ and use the same key and secret in settings.py.
+
+It implements the REST endpoints BitMEX uses (order, order/bulk, order/all, order/cancelAllAfter,
+position/leverage, instrument) and the /realtime websocket (partial/insert/update/delete on instrument, quote,
+trade, order, execution, margin and position), with API key auth and X-RateLimit headers / 429s. /realtimemd
+multiplexes the same streams, one per account, over one socket. A random-walk market moves every `tick`
+seconds and fills resting orders it crosses.
+
+Behaviour can be scripted from Python (Emulator.set_latency, fail_next, burst, drop_connections) or over
+HTTP by POSTing the same settings as JSON to /control, e.g.
+
+    {"latency": 0.2, "jitter": 0.05, "pathLatency": {"order/bulk": 0.5}, "fail": {"count": 3, "status": 503},
+     "burst": {"count": 1000}, "drop": true}
+"""
+from __future__ import absolute_import
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import math
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from market_maker.auth.APIKeyAuth import generate_signature
+
+logger = logging.getLogger('root')
+
+API_PREFIX = '/api/v1/'
+WS_MAGIC = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+PUBLIC_TABLES = ['instrument', 'quote', 'trade']
+PRIVATE_TABLES = ['order', 'execution', 'margin', 'position']
+TABLE_KEYS = {
+    'instrument': ['symbol'], 'quote': [], 'trade': [], 'order': ['orderID'], 'execution': ['execID'],
+    'margin': ['account', 'currency'], 'position': ['account', 'symbol', 'currency'],
+}
+
+
+def timestamp(when=None):
+    moment = datetime.datetime.utcnow() if when is None else datetime.datetime.utcfromtimestamp(when)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class APIError(Exception):
+    def __init__(self, status, message, headers=None):
+        super(APIError, self).__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Emulator(object):
+
+    """Exchange state and behaviour. Thread-safe; every public method takes the lock."""
+
+    def __init__(self, symbols=('XBTUSD',), keys=None, rateLimit=300, rateLimitWindow=300, tick=1.0, seed=None):
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.keys = keys or {}           # api key -> secret
+        self.accounts = {}               # api key -> account number
+        self.rateLimit = rateLimit
+        self.rateLimitWindow = rateLimitWindow
+        self.buckets = {}                # api key -> [tokens, last refill time]
+        self.tick = tick
+
+        # Scripted behaviour
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.pathLatency = {}
+        self.failures = []               # Statuses to fail the next requests with
+
+        self.instruments = {}
+        for symbol in symbols:
+            price = 10000.0 if symbol.startswith('XBT') else 100.0
+            self.instruments[symbol] = {
+                'symbol': symbol, 'state': 'Open', 'tickSize': 0.5 if symbol.startswith('XBT') else 0.05,
+                'isQuanto': False, 'isInverse': True, 'multiplier': -100000000,
+                'underlyingToSettleMultiplier': -100000000, 'quoteToSettleMultiplier': None, 'initMargin': 0.01,
+                'bidPrice': price - 0.5, 'askPrice': price, 'lastPrice': price, 'midPrice': price - 0.25,
+                'markPrice': price, 'indicativeSettlePrice': price, 'timestamp': timestamp(),
+            }
+        self.orders = {}                 # orderID -> order
+        self.positions = {}              # (account, symbol) -> position
+        self.margins = {}                # account -> margin
+        self.connections = set()
+        self.running = False
+        self.cancelAllAt = {}            # account -> when its dead man's switch fires
+
+    #
+    # Scripting
+    #
+    def set_latency(self, latency=0.0, jitter=0.0, pathLatency=None):
+        """Delay every REST response by `latency` plus up to `jitter` seconds, or per path (e.g. 'order/bulk')."""
+        with self.lock:
+            self.latency, self.jitter, self.pathLatency = latency, jitter, dict(pathLatency or {})
+
+    def fail_next(self, count=1, status=503):
+        """Answer the next `count` REST requests with `status`."""
+        with self.lock:
+            self.failures += [status] * count
+
+    def burst(self, count, symbol=None):
+        """Push `count` market data updates to every connection as fast as possible."""
+        for _ in range(count):
+            self.step_market(symbol)
+
+    def drop_connections(self):
+        """Close every websocket, e.g. to exercise client reconnects."""
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def control(self, command):
+        """Apply a /control command; see the module docstring."""
+        if 'latency' in command or 'jitter' in command or 'pathLatency' in command:
+            self.set_latency(command.get('latency', self.latency), command.get('jitter', self.jitter),
+                             command.get('pathLatency', self.pathLatency))
+        if 'fail' in command:
+            self.fail_next(command['fail'].get('count', 1), command['fail'].get('status', 503))
+        if 'burst' in command:
+            self.burst(command['burst'].get('count', 100), command['burst'].get('symbol'))
+        if command.get('drop'):
+            self.drop_connections()
+        return {'latency': self.latency, 'jitter': self.jitter, 'pathLatency': self.pathLatency,
+                'pendingFailures': len(self.failures), 'connections': len(self.connections)}
+
+    #
+    # Market
+    #
+    def run_market(self):
+        """Move the market every `tick` seconds until stop()."""
+        self.running = True
+        while self.running:
+            time.sleep(self.tick)
+            self.step_market()
+            self.check_dead_mans_switches()
+
+    def stop(self):
+        self.running = False
+
+    def check_dead_mans_switches(self):
+        """Cancel every open order of accounts whose order/cancelAllAfter timer has run out."""
+        with self.lock:
+            for account, deadline in list(self.cancelAllAt.items()):
+                if time.time() >= deadline:
+                    del self.cancelAllAt[account]
+                    orders = [o for o in self.orders.values() if o['account'] == account and o['leavesQty'] > 0]
+                    logger.info("Dead man's switch fired for account %d: canceling %d orders." % (account, len(orders)))
+                    for order in orders:
+                        self._cancel_order(order)
+
+    def step_market(self, symbol=None):
+        """Random-walk one instrument (default: a random one), publish it, and match resting orders."""
+        with self.lock:
+            instrument = self.instruments[symbol or self.random.choice(list(self.instruments))]
+            tick = instrument['tickSize']
+            mid = instrument['askPrice'] + self.random.choice([-1, 0, 0, 1]) * tick
+            update = {'symbol': instrument['symbol'], 'bidPrice': mid - tick, 'askPrice': mid,
+                      'midPrice': mid - tick / 2, 'markPrice': mid, 'timestamp': timestamp()}
+            instrument.update(update)
+            self.publish('instrument', 'update', [update])
+            self.publish('quote', 'insert', [{'symbol': instrument['symbol'], 'bidPrice': mid - tick,
+                                              'bidSize': self.random.randint(1, 50000), 'askPrice': mid,
+                                              'askSize': self.random.randint(1, 50000), 'timestamp': timestamp()}])
+            if self.random.random() < 0.3:
+                side = self.random.choice(['Buy', 'Sell'])
+                price = mid if side == 'Buy' else mid - tick
+                instrument['lastPrice'] = price
+                self.publish('trade', 'insert', [{'symbol': instrument['symbol'], 'side': side, 'price': price,
+                                                  'size': self.random.randint(1, 10000), 'timestamp': timestamp()}])
+            for order in list(self.orders.values()):
+                if order['symbol'] == instrument['symbol'] and order['leavesQty'] > 0 and self._crosses(order):
+                    self._fill(order, order['price'])
+
+    #
+    # REST
+    #
+    def handle_rest(self, verb, path, query, body, headers):
+        """Handle one REST request. Returns (status, response headers, JSON-able body)."""
+        delay = self.pathLatency.get(path, self.latency) + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        with self.lock:
+            apiKey = self._authenticate(verb, API_PREFIX + path, query, body, headers)
+            limitHeaders = self._charge(apiKey, path, verb, body)
+            try:
+                if self.failures:
+                    raise APIError(self.failures.pop(0), 'Injected failure')
+                return 200, limitHeaders, self._route(apiKey, verb, path, query, body)
+            except APIError as e:
+                limitHeaders.update(e.headers)
+                raise APIError(e.status, str(e), limitHeaders)
+
+    def _route(self, apiKey, verb, path, query, body):
+        params = dict((k, v[0]) for k, v in parse_qs(query).items())
+        if body:
+            params.update(json.loads(body))
+        account = self.accounts[apiKey]
+
+        if path == 'instrument' and verb == 'GET':
+            rows = list(self.instruments.values())
+            return self._filter(rows, params)
+        if path == 'order' and verb == 'GET':
+            return self._filter([o for o in self.orders.values() if o['account'] == account], params)[
+                :int(params.get('count', 100))]
+        if path == 'order' and verb == 'POST':
+            return self._create(account, params)
+        if path == 'order' and verb == 'PUT':
+            return self._amend(account, params)
+        if path == 'order' and verb == 'DELETE':
+            return self._cancel(account, params)
+        if path == 'order/bulk' and verb == 'POST':
+            return [self._create(account, order) for order in params.get('orders', [])]
+        if path == 'order/bulk' and verb == 'PUT':
+            return [self._amend(account, order) for order in params.get('orders', [])]
+        if path == 'order/all' and verb == 'DELETE':
+            orders = [o for o in self.orders.values() if o['account'] == account and o['leavesQty'] > 0 and
+                      params.get('symbol') in (None, o['symbol'])]
+            return [self._cancel_order(o) for o in orders]
+        if path == 'order/cancelAllAfter' and verb == 'POST':
+            timeout = int(params['timeout'])
+            now = time.time()
+            if timeout:
+                self.cancelAllAt[account] = now + timeout / 1000.0
+            else:
+                self.cancelAllAt.pop(account, None)
+            return {'now': timestamp(), 'cancelTime': timestamp(self.cancelAllAt[account]) if timeout else 0}
+        if path == 'position/leverage' and verb == 'POST':
+            position = self._position(account, params['symbol'])
+            position['leverage'] = params['leverage']
+            self.publish('position', 'update', [self._keys('position', position, leverage=params['leverage'])])
+            return position
+        raise APIError(404, 'Not Found')
+
+    def _authenticate(self, verb, path, query, body, headers):
+        apiKey = headers.get('api-key')
+        if apiKey not in self.keys:
+            raise APIError(401, 'Invalid API Key.')
+        expires = headers.get('api-expires')
+        if not expires or int(expires) < time.time():
+            raise APIError(401, 'This request has expired.')
+        url = path + ('?' + query if query else '')
+        if headers.get('api-signature') != generate_signature(self.keys[apiKey], verb, url, expires, body or ''):
+            raise APIError(401, 'Signature not valid.')
+        self.accounts.setdefault(apiKey, len(self.accounts) + 1)
+        return apiKey
+
+    def _charge(self, apiKey, path, verb, body):
+        """Token bucket per key, refilled at rateLimit per rateLimitWindow. Returns X-RateLimit headers."""
+        now = time.time()
+        rate = float(self.rateLimit) / self.rateLimitWindow
+        bucket = self.buckets.setdefault(apiKey, [float(self.rateLimit), now])
+        bucket[0] = min(self.rateLimit, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        cost = 1
+        if path == 'order/bulk':
+            cost = max(1, int(math.ceil(len(json.loads(body or '{}').get('orders', [])) / 10.0)))
+        isCancel = verb == 'DELETE' and path in ('order', 'order/all')
+
+        headers = {'X-RateLimit-Limit': str(self.rateLimit),
+                   'X-RateLimit-Reset': str(int(now + (self.rateLimit - bucket[0] + cost) / rate))}
+        if bucket[0] < cost and not isCancel:
+            # Cancels always go through, as on BitMEX.
+            wait = (cost - bucket[0]) / rate
+            headers.update({'X-RateLimit-Remaining': '0', 'Retry-After': str(int(math.ceil(wait)))})
+            raise APIError(429, 'Rate limit exceeded, retry in %d seconds.' % math.ceil(wait), headers)
+        bucket[0] = max(0.0, bucket[0] - cost)
+        headers['X-RateLimit-Remaining'] = str(int(bucket[0]))
+        return headers
+
+    #
+    # Orders
+    #
+    def _create(self, account, params):
+        clOrdID = params.get('clOrdID', '')
+        if clOrdID and any(o['clOrdID'] == clOrdID for o in self.orders.values()):
+            raise APIError(400, 'Duplicate clOrdID')
+        symbol = params.get('symbol')
+        if symbol not in self.instruments:
+            raise APIError(400, 'Invalid symbol')
+        qty = int(params['orderQty'])
+        side = params.get('side') or ('Buy' if qty > 0 else 'Sell')
+        order = {
+            'orderID': str(uuid.uuid4()), 'clOrdID': clOrdID, 'account': account, 'symbol': symbol,
+            'side': side, 'orderQty': abs(qty), 'price': float(params['price']), 'leavesQty': abs(qty), 'cumQty': 0,
+            'avgPx': None, 'ordType': 'Limit', 'ordStatus': 'New', 'execInst': params.get('execInst', ''),
+            'text': '', 'transactTime': timestamp(), 'timestamp': timestamp(),
+        }
+        self.orders[order['orderID']] = order
+        if self._crosses(order) and 'ParticipateDoNotInitiate' in order['execInst']:
+            order.update({'leavesQty': 0, 'ordStatus': 'Canceled', 'text': 'Canceled: Order had execInst of '
+                          'ParticipateDoNotInitiate'})
+            self.publish('order', 'insert', [order])
+            return order
+        self.publish('order', 'insert', [order])
+        if self._crosses(order):
+            instrument = self.instruments[symbol]
+            self._fill(order, instrument['askPrice'] if side == 'Buy' else instrument['bidPrice'])
+        return order
+
+    def _amend(self, account, params):
+        order = self._find(account, params.get('orderID'), params.get('origClOrdID'))
+        if order is None:
+            raise APIError(404, 'Not Found')
+        if order['leavesQty'] <= 0:
+            raise APIError(400, 'Invalid ordStatus')
+        if 'price' in params:
+            order['price'] = float(params['price'])
+        if 'orderQty' in params:
+            order['orderQty'] = int(params['orderQty'])
+            order['leavesQty'] = max(0, order['orderQty'] - order['cumQty'])
+        elif 'leavesQty' in params:
+            order['leavesQty'] = int(params['leavesQty'])
+            order['orderQty'] = order['cumQty'] + order['leavesQty']
+        if params.get('clOrdID'):
+            order['clOrdID'] = params['clOrdID']
+        if order['leavesQty'] == 0:
+            order['ordStatus'] = 'Filled' if order['cumQty'] else 'Canceled'
+        order['timestamp'] = timestamp()
+        self.publish('order', 'update', [self._keys('order', order, price=order['price'], clOrdID=order['clOrdID'],
+                                                    orderQty=order['orderQty'], leavesQty=order['leavesQty'],
+                                                    ordStatus=order['ordStatus'], timestamp=order['timestamp'])])
+        if order['leavesQty'] > 0 and self._crosses(order):
+            self._fill(order, order['price'])
+        return order
+
+    def _cancel(self, account, params):
+        ids = params.get('orderID') or params.get('clOrdID')
+        if not isinstance(ids, list):
+            ids = [ids]
+        canceled = []
+        for orderID in ids:
+            order = self._find(account, orderID, orderID)
+            if order is None:
+                continue
+            if order['leavesQty'] > 0:
+                self._cancel_order(order)
+            canceled.append(order)
+        if not canceled:
+            raise APIError(404, 'Not Found')
+        return canceled
+
+    def _cancel_order(self, order):
+        order.update({'leavesQty': 0, 'ordStatus': 'Canceled', 'timestamp': timestamp()})
+        self.publish('order', 'update', [self._keys('order', order, leavesQty=0, ordStatus='Canceled',
+                                                    timestamp=order['timestamp'])])
+        return order
+
+    def _find(self, account, orderID, clOrdID):
+        order = self.orders.get(orderID)
+        if order is None and clOrdID:
+            order = next((o for o in self.orders.values() if o['clOrdID'] == clOrdID), None)
+        return order if order is not None and order['account'] == account else None
+
+    def _crosses(self, order):
+        instrument = self.instruments[order['symbol']]
+        if order['side'] == 'Buy':
+            return order['price'] >= instrument['askPrice']
+        return order['price'] <= instrument['bidPrice']
+
+    def _fill(self, order, price):
+        qty = order['leavesQty']
+        order.update({'cumQty': order['cumQty'] + qty, 'leavesQty': 0, 'avgPx': price, 'ordStatus': 'Filled',
+                      'timestamp': timestamp()})
+        self.publish('execution', 'insert', [{
+            'execID': str(uuid.uuid4()), 'orderID': order['orderID'], 'clOrdID': order['clOrdID'],
+            'account': order['account'], 'symbol': order['symbol'], 'side': order['side'], 'price': order['price'],
+            'lastQty': qty, 'lastPx': price, 'execType': 'Trade', 'ordStatus': 'Filled',
+            'timestamp': order['timestamp']}])
+        self.publish('order', 'update', [self._keys('order', order, cumQty=order['cumQty'], leavesQty=0,
+                                                    avgPx=price, ordStatus='Filled', timestamp=order['timestamp'])])
+
+        position = self._position(order['account'], order['symbol'])
+        current = position['currentQty']
+        signed = qty if order['side'] == 'Buy' else -qty
+        new = current + signed
+        if new == 0:
+            avg = 0
+        elif current == 0 or (current > 0) != (new > 0):
+            avg = price
+        elif abs(new) > abs(current):
+            avg = (abs(current) * position['avgEntryPrice'] + qty * price) / abs(new)
+        else:
+            avg = position['avgEntryPrice']
+        position.update({'currentQty': new, 'avgEntryPrice': avg, 'avgCostPrice': avg,
+                         'homeNotional': new / price, 'timestamp': timestamp()})
+        self.publish('position', 'update', [self._keys('position', position, currentQty=new, avgEntryPrice=avg,
+                                                       avgCostPrice=avg, homeNotional=position['homeNotional'],
+                                                       timestamp=position['timestamp'])])
+
+    def _position(self, account, symbol):
+        key = (account, symbol)
+        if key not in self.positions:
+            self.positions[key] = {'account': account, 'symbol': symbol, 'currency': 'XBt', 'currentQty': 0,
+                                   'avgCostPrice': 0, 'avgEntryPrice': 0, 'homeNotional': 0, 'leverage': 0,
+                                   'timestamp': timestamp()}
+            self.publish('position', 'insert', [self.positions[key]])
+        return self.positions[key]
+
+    def _margin(self, account):
+        if account not in self.margins:
+            self.margins[account] = {'account': account, 'currency': 'XBt', 'walletBalance': 100000000,
+                                     'marginBalance': 100000000, 'availableFunds': 100000000,
+                                     'timestamp': timestamp()}
+        return self.margins[account]
+
+    def _filter(self, rows, params):
+        filters = json.loads(params['filter']) if 'filter' in params else {}
+        if 'symbol' in params:
+            filters['symbol'] = params['symbol']
+        result = []
+        for row in rows:
+            matched = True
+            for key, value in filters.items():
+                if key == 'ordStatus.isTerminated':
+                    matched = matched and (row['leavesQty'] <= 0) == value
+                elif isinstance(value, list):
+                    matched = matched and row.get(key) in value
+                else:
+                    matched = matched and row.get(key) == value
+            if matched:
+                result.append(row)
+        return result
+
+    @staticmethod
+    def _keys(table, row, **fields):
+        """An update row: the table's keys, account and symbol plus the changed fields."""
+        update = dict((key, row[key]) for key in TABLE_KEYS[table] + ['account', 'symbol'])
+        update.update(fields)
+        return update
+
+    #
+    # Realtime
+    #
+    def subscribe(self, connection, topics):
+        """Subscribe a connection to topics like 'quote:XBTUSD' or 'position', sending each partial."""
+        with self.lock:
+            for topic in topics:
+                table, _, symbol = topic.partition(':')
+                if table not in PUBLIC_TABLES + PRIVATE_TABLES:
+                    connection.send({'success': False, 'error': 'Unknown table: %s' % table,
+                                     'request': {'op': 'subscribe', 'args': [topic]}})
+                    continue
+                if table in PRIVATE_TABLES and connection.account is None:
+                    connection.send({'success': False, 'error': 'Not authenticated.', 'status': 401,
+                                     'request': {'op': 'subscribe', 'args': [topic]}})
+                    continue
+                connection.subscriptions.add((table, symbol or None))
+                connection.send({'success': True, 'subscribe': topic, 'request': {'op': 'subscribe', 'args': [topic]}})
+                partial = {'table': table, 'action': 'partial', 'keys': TABLE_KEYS[table],
+                           'data': [row for row in self._rows(table, connection.account) if
+                                    not symbol or row.get('symbol') == symbol]}
+                if symbol:
+                    partial['filter'] = {'symbol': symbol}
+                connection.send(partial)
+
+    def authenticate_ws(self, connection, apiKey, expires, signature):
+        with self.lock:
+            secret = self.keys.get(apiKey)
+            if secret is None or int(expires) < time.time() or \
+                    signature != generate_signature(secret, 'GET', '/realtime', expires, ''):
+                return False
+            self.accounts.setdefault(apiKey, len(self.accounts) + 1)
+            connection.account = self.accounts[apiKey]
+            return True
+
+    def publish(self, table, action, rows):
+        """Send rows to every connection subscribed to them."""
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            symbols = set(symbol for subTable, symbol in list(connection.subscriptions) if subTable == table)
+            if not symbols:
+                continue
+            visible = [row for row in rows if (None in symbols or row.get('symbol') in symbols) and
+                       (table in PUBLIC_TABLES or row.get('account') == connection.account)]
+            if visible:
+                connection.send({'table': table, 'action': action, 'data': visible})
+
+    def _rows(self, table, account):
+        if table == 'instrument':
+            return list(self.instruments.values())
+        if table == 'order':
+            return [o for o in self.orders.values() if o['account'] == account and o['leavesQty'] > 0]
+        if table == 'position':
+            return [p for (a, _), p in self.positions.items() if a == account]
+        if table == 'margin':
+            return [self._margin(account)]
+        return []  # quote, trade and execution history isn't kept
+
+
+class WebSocketConnection(object):
+
+    """A minimal server-side RFC 6455 connection: text frames, ping/pong and close."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sendLock = threading.Lock()
+        self.subscriptions = set()
+        self.account = None
+        self.closed = False
+
+    def send(self, message):
+        payload = json.dumps(message).encode('utf8')
+        self._send_frame(0x1, payload)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._send_frame(0x8, b'')
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            self.closed = True
+
+    def receive(self):
+        """Return the next text message, or None once the connection closes."""
+        while True:
+            try:
+                header = self._read(2)
+                opcode, length = header[0] & 0x0f, header[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('>H', self._read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self._read(8))[0]
+                mask = self._read(4) if header[1] & 0x80 else b'\0\0\0\0'
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._read(length)))
+            except (OSError, socket.error, EOFError):
+                self.closed = True
+                return None
+            if opcode == 0x8:
+                self.close()
+                return None
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+            elif opcode == 0x1:
+                return payload.decode('utf8')
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self.sendLock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except (OSError, socket.error):
+                self.closed = True
+
+
+class MultiplexedStream(object):
+
+    """One stream on a /realtimemd connection. The emulator treats it as a connection of its own."""
+
+    def __init__(self, connection, streamID, topic):
+        self.connection = connection
+        self.streamID = streamID
+        self.topic = topic
+        self.subscriptions = set()
+        self.account = None
+
+    def send(self, message):
+        self.connection.send([0, self.streamID, self.topic, message])
+
+    def close(self):
+        # Streams can't be dropped on their own; drop the socket under them.
+        self.connection.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like BitMEX
+
+    def do_GET(self):
+        if urlparse(self.path).path in ('/realtime', '/realtimemd'):
+            return self.handle_websocket()
+        self.handle_rest('GET')
+
+    def do_POST(self):
+        self.handle_rest('POST')
+
+    def do_PUT(self):
+        self.handle_rest('PUT')
+
+    def do_DELETE(self):
+        self.handle_rest('DELETE')
+
+    def handle_rest(self, verb):
+        emulator = self.server.emulator
+        url = urlparse(self.path)
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+
+        if url.path == '/control' and verb == 'POST':
+            return self.respond(200, {}, emulator.control(json.loads(body or '{}')))
+        if not url.path.startswith(API_PREFIX):
+            return self.respond(404, {}, {'error': {'message': 'Not Found', 'name': 'HTTPError'}})
+
+        try:
+            status, headers, result = emulator.handle_rest(verb, url.path[len(API_PREFIX):], url.query, body,
+                                                           dict((k.lower(), v) for k, v in self.headers.items()))
+        except APIError as e:
+            status, headers, result = e.status, e.headers, {'error': {'message': str(e), 'name': 'HTTPError'}}
+        except (ValueError, KeyError, TypeError) as e:
+            status, headers, result = 400, {}, {'error': {'message': 'Bad request: %s' % e, 'name': 'HTTPError'}}
+        self.respond(status, headers, result)
+
+    def respond(self, status, headers, result):
+        payload = json.dumps(result).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (OSError, socket.error):
+            # The client gave up waiting (e.g. a timeout under injected latency).
+            self.close_connection = True
+
+    def handle_websocket(self):
+        emulator = self.server.emulator
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            return self.respond(400, {}, {'error': {'message': 'Expected a websocket upgrade', 'name': 'HTTPError'}})
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode('utf8')).digest()).decode('utf8')
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        connection = WebSocketConnection(self.connection)
+        if urlparse(self.path).path == '/realtimemd':
+            return self.handle_multiplexed(connection)
+        with emulator.lock:
+            emulator.connections.add(connection)
+        try:
+            connection.send({'info': 'Welcome to the BitMEX emulator.', 'timestamp': timestamp()})
+            if self.headers.get('api-key'):
+                if not emulator.authenticate_ws(connection, self.headers.get('api-key'),
+                                                self.headers.get('api-expires', '0'),
+                                                self.headers.get('api-signature')):
+                    connection.send({'status': 401, 'error': 'Invalid API Key.'})
+            query = parse_qs(urlparse(self.path).query)
+            if 'subscribe' in query:
+                emulator.subscribe(connection, query['subscribe'][0].split(','))
+
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+                self.handle_op(connection, json.loads(message))
+        finally:
+            with emulator.lock:
+                emulator.connections.discard(connection)
+            self.close_connection = True
+
+    def handle_multiplexed(self, connection):
+        """Serve /realtimemd: frames are [type, stream ID, topic(, payload)], type 1 opening a stream, 2 closing it
+           and 0 carrying a message on it. A 'userAuth:<key>:<expires>:<signature>' topic authenticates the stream."""
+        emulator = self.server.emulator
+        streams = {}
+        try:
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+                frame = json.loads(message)
+                kind, streamID, topic = frame[:3]
+                if kind == 1:
+                    stream = streams[streamID] = MultiplexedStream(connection, streamID, topic)
+                    stream.send({'info': 'Welcome to the BitMEX emulator.', 'timestamp': timestamp()})
+                    if topic.startswith('userAuth:') and \
+                            not emulator.authenticate_ws(stream, *topic.split(':', 3)[1:]):
+                        stream.send({'status': 401, 'error': 'Invalid API Key.'})
+                    with emulator.lock:
+                        emulator.connections.add(stream)
+                elif kind == 2:
+                    with emulator.lock:
+                        emulator.connections.discard(streams.pop(streamID, None))
+                elif kind == 0 and streamID in streams:
+                    self.handle_op(streams[streamID], frame[3])
+        finally:
+            with emulator.lock:
+                for stream in streams.values():
+                    emulator.connections.discard(stream)
+            self.close_connection = True
+
+    def handle_op(self, connection, message):
+        emulator = self.server.emulator
+        op, args = message.get('op'), message.get('args', [])
+        if op == 'subscribe':
+            emulator.subscribe(connection, args if isinstance(args, list) else [args])
+        elif op in ('authKey', 'authKeyExpires'):
+            ok = emulator.authenticate_ws(connection, *args)
+            connection.send({'success': ok, 'request': message} if ok else
+                            {'status': 401, 'error': 'Signature not valid.', 'request': message})
+        elif op == 'ping':
+            connection.send('pong')
+        else:
+            connection.send({'status': 400, 'error': 'Unknown or unsupported op: %s' % op, 'request': message})
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(emulator, host='localhost', port=3000):
+    """Start the emulator's HTTP/websocket server and market thread in the background. Returns the server;
+       call server.shutdown() and emulator.stop() to stop them."""
+    server = ThreadingServer((host, port), RequestHandler)
+    server.emulator = emulator
+    for target in [server.serve_forever, emulator.run_market]:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    return server
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Local BitMEX emulator for integration and load testing')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--symbol', action='append', help='Instrument to list (repeatable, default XBTUSD)')
+    parser.add_argument('--key', action='append', help='API key as KEY:SECRET (repeatable)')
+    parser.add_argument('--tick', type=float, default=1.0, help='Seconds between market moves')
+    parser.add_argument('--rate-limit', type=int, default=300, help='Requests per 5 minutes per key')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every REST response')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
+    keys = dict(key.split(':', 1) for key in (args.key or ['LOCAL_KEY:LOCAL_SECRET']))
+    emulator = Emulator(symbols=args.symbol or ['XBTUSD'], keys=keys, rateLimit=args.rate_limit, tick=args.tick)
+    emulator.set_latency(args.latency)
+    server = serve(emulator, args.host, args.port)
+    logger.info("BitMEX emulator listening on http://%s:%d%s with keys: %s" %
+                (args.host, args.port, API_PREFIX, ", ".join(keys)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    run()
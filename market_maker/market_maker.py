@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from time import sleep
+from time import sleep, time
 import sys
 from datetime import datetime
 from os.path import getmtime
@@ -9,8 +9,14 @@ import atexit
 import signal
 
 from market_maker import bitmex
+from market_maker.async_bitmex import AsyncBitMEX
 from market_maker.settings import settings
-from market_maker.utils import log, constants, errors, math
+from market_maker.utils import log, constants, errors, math, metrics, ratelimit
+from market_maker.utils.checkpoint import Checkpoint
+from market_maker.utils.deadman import DeadMansSwitch
+from market_maker.utils.orderstate import OrderTracker
+from market_maker.utils.recorder import Recorder
+from market_maker.utils.snapshot import TickSnapshot
 
 # Used for reloading the bot - saves modified times of key files
 import os
@@ -24,16 +30,40 @@ logger = log.setup_custom_logger('root')
 
 
 class ExchangeInterface:
-    def __init__(self, dry_run=False):
+    # Replaced per instance by the `symbolSettings` passed in, if any.
+    settings = settings
+
+    def __init__(self, dry_run=False, symbol=None, connection=None, symbolSettings=None):
+        """Pass a multi_symbol.SharedConnection as `connection` to share its websocket, REST session, worker pool
+           and rate limit budget with other symbols' ExchangeInterfaces."""
+        if symbolSettings is not None:
+            self.settings = symbolSettings
         self.dry_run = dry_run
-        if len(sys.argv) > 1:
+        if symbol is not None:
+            self.symbol = symbol
+        elif len(sys.argv) > 1:
             self.symbol = sys.argv[1]
         else:
-            self.symbol = settings.SYMBOL
-        self.bitmex = bitmex.BitMEX(base_url=settings.BASE_URL, symbol=self.symbol,
-                                    apiKey=settings.API_KEY, apiSecret=settings.API_SECRET,
-                                    orderIDPrefix=settings.ORDERID_PREFIX, postOnly=settings.POST_ONLY,
-                                    timeout=settings.TIMEOUT)
+            self.symbol = self.settings.SYMBOL
+        if connection is None:
+            recorder = Recorder(self.settings.RECORD_FILE) if self.settings.RECORD_FILE else None
+            session = ws = rateLimiter = executor = None
+        else:
+            recorder, session, ws = connection.recorder, connection.session, connection.ws(self.symbol)
+            rateLimiter, executor = connection.rate_limiter(self.symbol), connection.executor
+        self.bitmex = bitmex.BitMEX(base_url=self.settings.BASE_URL, symbol=self.symbol,
+                                    apiKey=self.settings.API_KEY, apiSecret=self.settings.API_SECRET,
+                                    orderIDPrefix=self.settings.ORDERID_PREFIX, postOnly=self.settings.POST_ONLY,
+                                    timeout=self.settings.TIMEOUT, orderBook=self.settings.ORDERBOOK_TABLE,
+                                    recorder=recorder, session=session, ws=ws, rateLimiter=rateLimiter,
+                                    marketDataFeed=self.settings.MARKET_DATA_FEED)
+        self.rest = AsyncBitMEX(self.bitmex, executor=executor)
+        self.halted = False
+        # Our orders as we've asked for them, ahead of the websocket.
+        self.orderState = OrderTracker()
+        self.deadMansSwitch = None
+        if self.settings.DEAD_MANS_SWITCH and not self.dry_run:
+            self.deadMansSwitch = DeadMansSwitch.arm(self.bitmex, self.settings.DEAD_MANS_SWITCH)
 
     def cancel_order(self, order):
         tickLog = self.get_instrument()['tickLog']
@@ -41,10 +71,9 @@ class ExchangeInterface:
         while True:
             try:
                 self.bitmex.cancel(order['orderID'])
-                sleep(settings.API_REST_INTERVAL)
             except ValueError as e:
                 logger.info(e)
-                sleep(settings.API_ERROR_INTERVAL)
+                sleep(self.settings.API_ERROR_INTERVAL)
             else:
                 break
 
@@ -63,38 +92,86 @@ class ExchangeInterface:
             logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
 
         if len(orders):
-            self.bitmex.cancel([order['orderID'] for order in orders])
+            self.log_order_events('cancel', self.bitmex.cancel([order['orderID'] for order in orders]))
+            sleep(self.settings.API_REST_INTERVAL)
+
+        return orders
+
+    def kill(self):
+        """Cancel our orders on this symbol as fast as we can, e.g. on shutdown: one request, with nothing fetched
+           first. Returns the orders canceled.
 
-        sleep(settings.API_REST_INTERVAL)
+        That's the orders the websocket shows, or with CANCEL_ALL_ON_EXIT an order/all for the symbol, which also
+        gets orders the websocket hasn't shown us yet but cancels everyone's orders on the symbol. Call halt()
+        first, and cancel_all_orders() once requests in flight are done, to catch anything they placed."""
+        if self.dry_run:
+            return []
+        if self.settings.CANCEL_ALL_ON_EXIT:
+            canceled = self.bitmex.cancel_all()
+        else:
+            # Including any we've created that the websocket hasn't shown us yet.
+            orderIDs = set(o['orderID'] for o in self.bitmex.open_orders() + self.orderState.open_orders())
+            if not orderIDs:
+                return []
+            canceled = self.bitmex.cancel(list(orderIDs))
+        self.log_order_events('cancel', canceled)
+        return canceled
+
+    def finish_requests(self):
+        """Wait for the REST requests already sent to finish. Call halt() first.
+
+        A worker pool shared with other symbols (see multi_symbol) is left running for them: its owner,
+        MultiSymbolManager.exit, waits for it."""
+        if self.rest.ownsExecutor:
+            self.rest.executor.shutdown(wait=True)
+
+    def disarm(self):
+        """Disarm the dead man's switch, once our orders are canceled."""
+        if self.deadMansSwitch is not None:
+            self.deadMansSwitch.disarm()
+
+    def adopt_orders(self):
+        """Take over the open orders a previous run left, rather than canceling them. Returns them.
+
+        The websocket's order partial should already have them all; we check it against HTTP, as
+        cancel_all_orders does. Orders it still doesn't show after API_ERROR_INTERVAL are canceled, so we never
+        quote around orders we can't see."""
+        if self.dry_run:
+            return []
+
+        logger.info("Warm start: adopting our open orders.")
+        orders = self.bitmex.http_open_orders()
+        deadline = time() + self.settings.API_ERROR_INTERVAL
+        while True:
+            seen = set(o['orderID'] for o in self.bitmex.open_orders())
+            missing = [o for o in orders if o['orderID'] not in seen]
+            if not missing or time() >= deadline:
+                break
+            sleep(0.1)
+
+        if missing:
+            tickLog = self.get_instrument()['tickLog']
+            for order in missing:
+                logger.info("Canceling: %s %d @ %.*f (not on the websocket)" %
+                            (order['side'], order['orderQty'], tickLog, order['price']))
+            self.bitmex.cancel([order['orderID'] for order in missing])
+        return [o for o in orders if o['orderID'] in seen]
+
+    def halt(self):
+        """Refuse to create or amend orders from now on, e.g. while shutting down. Canceling still works."""
+        self.halted = True
+
+    def check_halted(self):
+        if self.halted:
+            raise errors.ExchangeHaltedError("Not placing orders for %s: shutting down." % self.symbol)
 
     def get_portfolio(self):
-        contracts = settings.CONTRACTS
+        contracts = self.settings.CONTRACTS
         portfolio = {}
         for symbol in contracts:
             position = self.bitmex.position(symbol=symbol)
             instrument = self.bitmex.instrument(symbol=symbol)
-
-            if instrument['isQuanto']:
-                future_type = "Quanto"
-            elif instrument['isInverse']:
-                future_type = "Inverse"
-            elif not instrument['isQuanto'] and not instrument['isInverse']:
-                future_type = "Linear"
-            else:
-                raise NotImplementedError("Unknown future type; not quanto or inverse: %s" % instrument['symbol'])
-
-            if instrument['underlyingToSettleMultiplier'] is None:
-                multiplier = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
-            else:
-                multiplier = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
-
-            portfolio[symbol] = {
-                "currentQty": float(position['currentQty']),
-                "futureType": future_type,
-                "multiplier": multiplier,
-                "markPrice": float(instrument['markPrice']),
-                "spot": float(instrument['indicativeSettlePrice'])
-            }
+            portfolio[symbol] = portfolio_item(instrument, position)
 
         return portfolio
 
@@ -105,15 +182,8 @@ class ExchangeInterface:
         mark_delta = 0
         for symbol in portfolio:
             item = portfolio[symbol]
-            if item['futureType'] == "Quanto":
-                spot_delta += item['currentQty'] * item['multiplier'] * item['spot']
-                mark_delta += item['currentQty'] * item['multiplier'] * item['markPrice']
-            elif item['futureType'] == "Inverse":
-                spot_delta += (item['multiplier'] / item['spot']) * item['currentQty']
-                mark_delta += (item['multiplier'] / item['markPrice']) * item['currentQty']
-            elif item['futureType'] == "Linear":
-                spot_delta += item['multiplier'] * item['currentQty']
-                mark_delta += item['multiplier'] * item['currentQty']
+            spot_delta += item_delta(item, item['spot'])
+            mark_delta += item_delta(item, item['markPrice'])
         basis_delta = mark_delta - spot_delta
         delta = {
             "spot": spot_delta,
@@ -134,13 +204,16 @@ class ExchangeInterface:
 
     def get_margin(self):
         if self.dry_run:
-            return {'marginBalance': float(settings.DRY_BTC), 'availableFunds': float(settings.DRY_BTC)}
+            return {'marginBalance': float(self.settings.DRY_BTC), 'availableFunds': float(self.settings.DRY_BTC)}
         return self.bitmex.funds()
 
     def get_orders(self):
+        """Our open orders, as they'll be once the websocket has caught up with the requests we've sent. Orders it
+           hasn't confirmed yet have a pending ordStatus (see OrderTracker)."""
         if self.dry_run:
             return []
-        return self.bitmex.open_orders()
+        self.orderState.reconcile(self.bitmex.open_orders(), self.bitmex.executions())
+        return self.orderState.open_orders()
 
     def get_highest_buy(self):
         buys = [o for o in self.get_orders() if o['side'] == 'Buy']
@@ -166,6 +239,28 @@ class ExchangeInterface:
             symbol = self.symbol
         return self.bitmex.ticker_data(symbol)
 
+    def get_feed_latency(self, symbol=None):
+        """How far behind the exchange our market data is: the age of the newest of it and of the best bid/ask,
+           and how long it took to reach us. See ws.latency.FeedLatency.status."""
+        if symbol is None:
+            symbol = self.symbol
+        return self.bitmex.feed_latency(symbol)
+
+    def get_market_depth(self, symbol=None):
+        if symbol is None:
+            symbol = self.symbol
+        return self.bitmex.market_depth(symbol)
+
+    def get_snapshot(self):
+        """Capture instrument, ticker, position, margin and open orders for one tick."""
+        return TickSnapshot.capture(self)
+
+    def wait_for_sync(self, timeout=None):
+        return self.bitmex.wait_for_sync(timeout)
+
+    def wait_for_update(self, timeout=None):
+        return self.bitmex.wait_for_update(timeout)
+
     def is_open(self):
         """Check that websockets are still open."""
         return not self.bitmex.ws.exited
@@ -182,99 +277,206 @@ class ExchangeInterface:
         if instrument['midPrice'] is None:
             raise errors.MarketEmptyError("Orderbook is empty, cannot quote")
 
+    def get_order_budget(self):
+        """Order create/amend requests we can send now without dipping into RATE_LIMIT_RESERVE."""
+        return self.bitmex.order_budget(self.settings.RATE_LIMIT_RESERVE)
+
     def amend_bulk_orders(self, orders):
+        self.check_halted()
         if self.dry_run:
             return orders
-        return self.bitmex.amend_bulk_orders(orders)
+        self.orderState.amending(orders)
+        amended = self.bitmex.amend_bulk_orders(orders)
+        self.orderState.amended(amended)
+        self.log_order_events('amend', amended)
+        return amended
 
     def create_bulk_orders(self, orders):
+        self.check_halted()
         if self.dry_run:
             return orders
-        return self.bitmex.create_bulk_orders(orders)
+        created = self.bitmex.create_bulk_orders(orders)
+        self.orderState.created(created)
+        self.log_order_events('create', created)
+        return created
 
     def cancel_bulk_orders(self, orders):
         if self.dry_run:
             return orders
-        return self.bitmex.cancel([order['orderID'] for order in orders])
+        self.orderState.canceling(orders)
+        try:
+            canceled = self.bitmex.cancel([order['orderID'] for order in orders])
+        except Exception:
+            self.orderState.cancel_failed(orders)
+            raise
+        self.orderState.canceled(canceled)
+        self.log_order_events('cancel', canceled)
+        return canceled
+
+    def submit_orders(self, to_amend, to_create, to_cancel):
+        """Amend, create and cancel orders concurrently. Returns [amended, created, canceled], each the
+           call's result or the exception it raised."""
+        self.check_halted()
+        if self.dry_run:
+            return [to_amend, to_create, to_cancel]
+        self.orderState.amending(to_amend)
+        self.orderState.canceling(to_cancel)
+        amended, created, canceled = self.rest.run(self.rest.submit_orders(to_amend, to_create, to_cancel))
+        if not isinstance(amended, BaseException):
+            self.orderState.amended(amended)
+        if not isinstance(created, BaseException):
+            self.orderState.created(created)
+        if isinstance(canceled, BaseException):
+            self.orderState.cancel_failed(to_cancel)
+        else:
+            self.orderState.canceled(canceled)
+        self.log_order_events('amend', amended)
+        self.log_order_events('create', created)
+        self.log_order_events('cancel', canceled)
+        return [amended, created, canceled]
+
+    def log_order_events(self, event, result):
+        """Log the orders in `result`, an order request's result, to ORDER_EVENT_LOG (if set) as `event`."""
+        if log.orderEvents() is None or not isinstance(result, (list, dict)):
+            return
+        for order in result if isinstance(result, list) else [result]:
+            if isinstance(order, dict) and not order.get('error'):
+                log.order_event(event, order)
 
 
 class OrderManager:
-    def __init__(self):
-        self.exchange = ExchangeInterface(settings.DRY_RUN)
-        # Once exchange is created, register exit handler that will always cancel orders
-        # on any error.
-        atexit.register(self.exit)
-        signal.signal(signal.SIGTERM, self.exit)
+    # Replaced per instance by the `symbolSettings` passed in, if any.
+    settings = settings
+
+    def __init__(self, exchange=None, symbolSettings=None):
+        if symbolSettings is not None:
+            self.settings = symbolSettings
+        if exchange is None:
+            self.exchange = ExchangeInterface(self.settings.DRY_RUN, symbolSettings=symbolSettings)
+            # Once exchange is created, register exit handler that will always cancel orders
+            # on any error.
+            atexit.register(self.exit)
+            signal.signal(signal.SIGTERM, self.exit)
+        else:
+            # Supplied by the caller, e.g. a backtest's simulated exchange. The caller owns its lifecycle.
+            self.exchange = exchange
 
         logger.info("Using symbol %s." % self.exchange.symbol)
 
-        if settings.DRY_RUN:
+        if self.settings.DRY_RUN:
             logger.info("Initializing dry run. Orders printed below represent what would be posted to BitMEX.")
         else:
             logger.info("Order Manager initializing, connecting to BitMEX. Live run: executing real trades.")
 
         self.start_time = datetime.now()
-        self.instrument = self.exchange.get_instrument()
+        self.snapshot = None
+        self.feedLatency = None  # How far behind the exchange the snapshot was, as get_feed_latency() reports
+        self.feedStale = False  # Whether we've pulled our quotes because the feed fell behind
+        self.exiting = False
         self.starting_qty = self.exchange.get_delta()
+        self.checkpoint = None
+        self.checkpointOrders = None  # Our open orders when the last run checkpointed, if we resumed it
+        if self.settings.CHECKPOINT_DIR:
+            self.checkpoint = Checkpoint(os.path.join(self.settings.CHECKPOINT_DIR, '%s.json' % self.exchange.symbol))
+            if self.settings.WARM_START:
+                self.resume(self.checkpoint.load())
         self.running_qty = self.starting_qty
         self.reset()
 
     def reset(self):
-        self.exchange.cancel_all_orders()
+        if self.settings.WARM_START:
+            self.adopt_orders()
+        else:
+            self.exchange.cancel_all_orders()
         self.sanity_check()
         self.print_status()
 
         # Create orders and converge.
         self.place_orders()
+        self.save_checkpoint()
+
+    def adopt_orders(self):
+        """Keep the orders a previous run left open. The first tick's converge_orders treats them like any others,
+           amending only the ones that differ from the ladder."""
+        orders = self.exchange.adopt_orders()
+        logger.info("Adopted %d open orders." % len(orders))
+        if self.checkpointOrders is not None:
+            closed = set(self.checkpointOrders) - set(o['orderID'] for o in orders)
+            if closed:
+                logger.info("%d orders from the last run have been filled or canceled since." % len(closed))
+
+    def resume(self, state):
+        """Pick the last run back up from its checkpoint, if it left one."""
+        if state is None:
+            return
+        logger.info("Resuming the run started %s." % datetime.fromtimestamp(state['startTime']))
+        self.start_time = datetime.fromtimestamp(state['startTime'])
+        self.starting_qty = state['startingQty']
+        self.checkpointOrders = state['orders']
+
+    def save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        self.checkpoint.save({'startTime': self.start_time.timestamp(), 'startingQty': self.starting_qty,
+                              'orders': sorted(o['orderID'] for o in self.exchange.get_orders())})
 
     def print_status(self):
         """Print the current MM status."""
 
-        margin = self.exchange.get_margin()
-        position = self.exchange.get_position()
-        self.running_qty = self.exchange.get_delta()
-        tickLog = self.exchange.get_instrument()['tickLog']
+        margin = self.snapshot.margin
+        position = self.snapshot.position
+        self.running_qty = self.snapshot.delta
+        tickLog = self.snapshot.tickLog
         self.start_XBt = margin["marginBalance"]
 
         logger.info("Current XBT Balance: %.6f" % XBt_to_XBT(self.start_XBt))
         logger.info("Current Contract Position: %d" % self.running_qty)
-        if settings.CHECK_POSITION_LIMITS:
-            logger.info("Position limits: %d/%d" % (settings.MIN_POSITION, settings.MAX_POSITION))
+        if self.settings.CHECK_POSITION_LIMITS:
+            logger.info("Position limits: %d/%d" % (self.settings.MIN_POSITION, self.settings.MAX_POSITION))
         if position['currentQty'] != 0:
             logger.info("Avg Cost Price: %.*f" % (tickLog, float(position['avgCostPrice'])))
             logger.info("Avg Entry Price: %.*f" % (tickLog, float(position['avgEntryPrice'])))
         logger.info("Contracts Traded This Run: %d" % (self.running_qty - self.starting_qty))
         logger.info("Total Contract Delta: %.4f XBT" % self.exchange.calc_delta()['spot'])
 
+    @property
+    def instrument(self):
+        """Deprecated: use self.snapshot.instrument. The instrument as of this tick's snapshot (or, before the first
+           tick, as the websocket has it now), for strategies written when it was an attribute."""
+        if self.snapshot is None:
+            return self.exchange.get_instrument()
+        return self.snapshot.instrument
+
     def get_ticker(self):
-        ticker = self.exchange.get_ticker()
-        tickLog = self.exchange.get_instrument()['tickLog']
+        ticker = self.snapshot.ticker
+        tickLog = self.snapshot.tickLog
+        tickSize = self.snapshot.tickSize
 
         # Set up our buy & sell positions as the smallest possible unit above and below the current spread
         # and we'll work out from there. That way we always have the best price but we don't kill wide
         # and potentially profitable spreads.
-        self.start_position_buy = ticker["buy"] + self.instrument['tickSize']
-        self.start_position_sell = ticker["sell"] - self.instrument['tickSize']
+        self.start_position_buy = math.fromTicks(math.toTicks(ticker["buy"], tickSize) + 1, tickSize)
+        self.start_position_sell = math.fromTicks(math.toTicks(ticker["sell"], tickSize) - 1, tickSize)
 
         # If we're maintaining spreads and we already have orders in place,
         # make sure they're not ours. If they are, we need to adjust, otherwise we'll
         # just work the orders inward until they collide.
-        if settings.MAINTAIN_SPREADS:
-            if ticker['buy'] == self.exchange.get_highest_buy()['price']:
+        if self.settings.MAINTAIN_SPREADS:
+            if ticker['buy'] == self.snapshot.highest_buy()['price']:
                 self.start_position_buy = ticker["buy"]
-            if ticker['sell'] == self.exchange.get_lowest_sell()['price']:
+            if ticker['sell'] == self.snapshot.lowest_sell()['price']:
                 self.start_position_sell = ticker["sell"]
 
         # Back off if our spread is too small.
-        if self.start_position_buy * (1.00 + settings.MIN_SPREAD) > self.start_position_sell:
-            self.start_position_buy *= (1.00 - (settings.MIN_SPREAD / 2))
-            self.start_position_sell *= (1.00 + (settings.MIN_SPREAD / 2))
+        if self.start_position_buy * (1.00 + self.settings.MIN_SPREAD) > self.start_position_sell:
+            self.start_position_buy *= (1.00 - (self.settings.MIN_SPREAD / 2))
+            self.start_position_sell *= (1.00 + (self.settings.MIN_SPREAD / 2))
 
         # Midpoint, used for simpler order placement.
         self.start_position_mid = ticker["mid"]
         logger.info(
             "%s Ticker: Buy: %.*f, Sell: %.*f" %
-            (self.instrument['symbol'], tickLog, ticker["buy"], tickLog, ticker["sell"])
+            (self.snapshot.instrument['symbol'], tickLog, ticker["buy"], tickLog, ticker["sell"])
         )
         logger.info('Start Positions: Buy: %.*f, Sell: %.*f, Mid: %.*f' %
                     (tickLog, self.start_position_buy, tickLog, self.start_position_sell,
@@ -284,24 +486,24 @@ class OrderManager:
     def get_price_offset(self, index):
         """Given an index (1, -1, 2, -2, etc.) return the price for that side of the book.
            Negative is a buy, positive is a sell."""
-        # Maintain existing spreads for max profit
-        if settings.MAINTAIN_SPREADS:
-            start_position = self.start_position_buy if index < 0 else self.start_position_sell
-            # First positions (index 1, -1) should start right at start_position, others should branch from there
-            index = index + 1 if index < 0 else index - 1
-        else:
-            # Offset mode: ticker comes from a reference exchange and we define an offset.
-            start_position = self.start_position_buy if index < 0 else self.start_position_sell
-
-            # If we're attempting to sell, but our sell price is actually lower than the buy,
-            # move over to the sell side.
-            if index > 0 and start_position < self.start_position_buy:
-                start_position = self.start_position_sell
-            # Same for buys.
-            if index < 0 and start_position > self.start_position_sell:
-                start_position = self.start_position_buy
-
-        return math.toNearest(start_position * (1 + settings.INTERVAL) ** index, self.instrument['tickSize'])
+        return self.get_price_offsets([index])[0]
+
+    def get_price_offsets(self, indices):
+        """get_price_offset for a whole ladder of indices at once. Prices are worked out in ticks and only
+           turned back into floats at the end."""
+        tickSize = self.snapshot.tickSize
+        factor = 1 + self.settings.INTERVAL
+        # Start positions in ticks. These are whole unless MIN_SPREAD pushed them apart.
+        start_buy = self.start_position_buy / tickSize
+        start_sell = self.start_position_sell / tickSize
+        # Maintain existing spreads for max profit: the first positions (index 1, -1) start right at
+        # start_position and others branch from there. In offset mode (ticker comes from a reference
+        # exchange and we define an offset) every index is a step away.
+        shift = 1 if self.settings.MAINTAIN_SPREADS else 0
+
+        ticks = [int(round(start_buy * factor ** (index + shift))) if index < 0 else
+                 int(round(start_sell * factor ** (index - shift))) for index in indices]
+        return [math.fromTicks(t, tickSize) for t in ticks]
 
     ###
     # Orders
@@ -316,23 +518,29 @@ class OrderManager:
         # then we match orders from the outside in, ensuring the fewest number of orders are amended and only
         # a new order is created in the inside. If we did it inside-out, all orders would be amended
         # down and a new order would be created at the outside.
-        for i in reversed(range(1, settings.ORDER_PAIRS + 1)):
-            if not self.long_position_limit_exceeded():
-                buy_orders.append(self.prepare_order(-i))
-            if not self.short_position_limit_exceeded():
-                sell_orders.append(self.prepare_order(i))
+        levels = list(reversed(range(1, self.settings.ORDER_PAIRS + 1)))
+        indices = [-i for i in levels] + levels
+        prices = dict(zip(indices, self.get_price_offsets(indices)))
+        buy = not self.long_position_limit_exceeded()
+        sell = not self.short_position_limit_exceeded()
+        for i in levels:
+            if buy:
+                buy_orders.append(self.prepare_order(-i, prices[-i]))
+            if sell:
+                sell_orders.append(self.prepare_order(i, prices[i]))
 
         return self.converge_orders(buy_orders, sell_orders)
 
-    def prepare_order(self, index):
-        """Create an order object."""
+    def prepare_order(self, index, price=None):
+        """Create an order object. Pass `price` if you already have it from get_price_offsets."""
 
-        if settings.RANDOM_ORDER_SIZE is True:
-            quantity = random.randint(settings.MIN_ORDER_SIZE, settings.MAX_ORDER_SIZE)
+        if self.settings.RANDOM_ORDER_SIZE is True:
+            quantity = random.randint(self.settings.MIN_ORDER_SIZE, self.settings.MAX_ORDER_SIZE)
         else:
-            quantity = settings.ORDER_START_SIZE + ((abs(index) - 1) * settings.ORDER_STEP_SIZE)
+            quantity = self.settings.ORDER_START_SIZE + ((abs(index) - 1) * self.settings.ORDER_STEP_SIZE)
 
-        price = self.get_price_offset(index)
+        if price is None:
+            price = self.get_price_offset(index)
 
         return {'price': price, 'orderQty': quantity, 'side': "Buy" if index < 0 else "Sell"}
 
@@ -341,81 +549,134 @@ class OrderManager:
            This involves amending any open orders and creating new ones if any have filled completely.
            We start from the closest orders outward."""
 
-        tickLog = self.exchange.get_instrument()['tickLog']
-        to_amend = []
-        to_create = []
-        to_cancel = []
-        buys_matched = 0
-        sells_matched = 0
-        existing_orders = self.exchange.get_orders()
+        tickLog = self.snapshot.tickLog
+        existing_orders = self.snapshot.orders
+        orders_by_id = dict((o['orderID'], o) for o in existing_orders)
+        to_amend, to_create, to_cancel = self.diff_orders(existing_orders, buy_orders, sell_orders)
 
-        # Check all existing orders and match them up with what we want to place.
-        # If there's an open one, we might be able to amend it to fit what we want.
-        for order in existing_orders:
-            try:
-                if order['side'] == 'Buy':
-                    desired_order = buy_orders[buys_matched]
-                    buys_matched += 1
-                else:
-                    desired_order = sell_orders[sells_matched]
-                    sells_matched += 1
-
-                # Found an existing order. Do we need to amend it?
-                if desired_order['orderQty'] != order['leavesQty'] or (
-                        # If price has changed, and the change is more than our RELIST_INTERVAL, amend.
-                        desired_order['price'] != order['price'] and
-                        abs((desired_order['price'] / order['price']) - 1) > settings.RELIST_INTERVAL):
-                    to_amend.append({'orderID': order['orderID'], 'orderQty': order['cumQty'] + desired_order['orderQty'],
-                                     'price': desired_order['price'], 'side': order['side']})
-            except IndexError:
-                # Will throw if there isn't a desired order to match. In that case, cancel it.
-                to_cancel.append(order)
-
-        while buys_matched < len(buy_orders):
-            to_create.append(buy_orders[buys_matched])
-            buys_matched += 1
-
-        while sells_matched < len(sell_orders):
-            to_create.append(sell_orders[sells_matched])
-            sells_matched += 1
+        to_amend, to_create = self.ration_orders(to_amend, to_create, self.exchange.get_order_budget())
 
         if len(to_amend) > 0:
             for amended_order in reversed(to_amend):
-                reference_order = [o for o in existing_orders if o['orderID'] == amended_order['orderID']][0]
-                logger.info("Amending %4s: %d @ %.*f to %d @ %.*f (%+.*f)" % (
-                    amended_order['side'],
-                    reference_order['leavesQty'], tickLog, reference_order['price'],
-                    (amended_order['orderQty'] - reference_order['cumQty']), tickLog, amended_order['price'],
-                    tickLog, (amended_order['price'] - reference_order['price'])
-                ))
-            # This can fail if an order has closed in the time we were processing.
-            # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
-            # made it not amendable.
-            # If that happens, we need to catch it and re-tick.
-            try:
-                self.exchange.amend_bulk_orders(to_amend)
-            except requests.exceptions.HTTPError as e:
-                errorObj = e.response.json()
-                if errorObj['error']['message'] == 'Invalid ordStatus':
-                    logger.warn("Amending failed. Waiting for order data to converge and retrying.")
-                    sleep(0.5)
-                    return self.place_orders()
-                else:
-                    logger.error("Unknown error on amend: %s. Exiting" % errorObj)
-                    sys.exit(1)
+                reference_order = orders_by_id[amended_order['orderID']]
+                # Arguments rather than %, so the log thread does the formatting.
+                logger.info("Amending %4s: %d @ %.*f to %d @ %.*f (%+.*f)",
+                            amended_order['side'],
+                            reference_order['leavesQty'], tickLog, reference_order['price'],
+                            (amended_order['orderQty'] - reference_order['cumQty']), tickLog, amended_order['price'],
+                            tickLog, (amended_order['price'] - reference_order['price']))
 
         if len(to_create) > 0:
-            logger.info("Creating %d orders:" % (len(to_create)))
+            logger.info("Creating %d orders:", len(to_create))
             for order in reversed(to_create):
-                logger.info("%4s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
-            self.exchange.create_bulk_orders(to_create)
+                logger.info("%4s %d @ %.*f", order['side'], order['orderQty'], tickLog, order['price'])
 
         # Could happen if we exceed a delta limit
         if len(to_cancel) > 0:
-            logger.info("Canceling %d orders:" % (len(to_cancel)))
+            logger.info("Canceling %d orders:", len(to_cancel))
             for order in reversed(to_cancel):
-                logger.info("%4s %d @ %.*f" % (order['side'], order['leavesQty'], tickLog, order['price']))
-            self.exchange.cancel_bulk_orders(to_cancel)
+                logger.info("%4s %d @ %.*f", order['side'], order['leavesQty'], tickLog, order['price'])
+
+        # From the exchange moving the best bid/ask to our orders for it going out.
+        if (to_amend or to_create) and self.feedLatency and self.feedLatency['quoteTime'] is not None:
+            metrics.histogram('quote_latency_seconds', symbol=self.exchange.symbol).record(
+                max(0.0, time() - self.feedLatency['quoteTime']))
+
+        # Amends, creates and cancels touch different orders, so they go out together.
+        with self.timer('submit_orders'):
+            amended, created, canceled = self.exchange.submit_orders(to_amend, to_create, to_cancel)
+
+        # The amend can fail if an order has closed in the time we were processing.
+        # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
+        # made it not amendable.
+        # If that happens, the amended orders stay pending until the websocket shows what became of them, and
+        # the next tick converges from there.
+        if isinstance(amended, requests.exceptions.HTTPError):
+            errorObj = amended.response.json()
+            if errorObj['error']['message'] == 'Invalid ordStatus':
+                logger.warn("Amending failed: an order closed first. Leaving it to the next tick.")
+                amended = None
+            else:
+                logger.error("Unknown error on amend: %s. Exiting" % errorObj)
+                sys.exit(1)
+        for result in [amended, created, canceled]:
+            if isinstance(result, BaseException):
+                raise result
+
+    def diff_orders(self, existing_orders, buy_orders, sell_orders):
+        """Work out the fewest changes that turn our existing orders into the desired ones.
+           Returns (to_amend, to_create, to_cancel)."""
+        to_amend = []
+        to_create = []
+        to_cancel = []
+        for side, desired_orders in (('Buy', buy_orders), ('Sell', sell_orders)):
+            existing = [o for o in existing_orders if o['side'] == side]
+            matches, creates, cancels = self.align_orders(existing, desired_orders, descending=side == 'Buy')
+            for order, desired_order in matches:
+                # Until the websocket confirms the last request for an order, another would be based on stale
+                # data. It waits for a later tick.
+                if self.needs_amend(order, desired_order) and not OrderTracker.is_pending(order):
+                    to_amend.append({'orderID': order['orderID'], 'orderQty': order['cumQty'] + desired_order['orderQty'],
+                                     'price': desired_order['price'], 'side': order['side']})
+            to_create += creates
+            to_cancel += cancels
+        return to_amend, to_create, to_cancel
+
+    def align_orders(self, existing, desired, descending):
+        """Pair up one side's existing and desired orders with the fewest changes.
+
+        Existing orders that already fit a desired order are kept, as many as possible (a maximum bipartite
+        matching), so e.g. a middle level filling costs one create rather than amending every order past it.
+        The rest are paired up in price order from the inside out and amended; any left over are created
+        or canceled. Returns (matches, creates, cancels), where matches are (existing, desired) pairs.
+        """
+        existing = sorted(existing, key=lambda o: o['price'], reverse=descending)
+        desired = sorted(desired, key=lambda o: o['price'], reverse=descending)
+        fits = [[j for j, d in enumerate(desired) if not self.needs_amend(o, d)] for o in existing]
+        owner = {}  # desired index -> index of the existing order kept for it
+
+        def augment(i, seen):
+            for j in fits[i]:
+                if j not in seen:
+                    seen.add(j)
+                    if j not in owner or augment(owner[j], seen):
+                        owner[j] = i
+                        return True
+            return False
+
+        for i in range(len(existing)):
+            augment(i, set())
+
+        kept = set(owner.values())
+        spare_existing = [o for i, o in enumerate(existing) if i not in kept]
+        spare_desired = [d for j, d in enumerate(desired) if j not in owner]
+        matches = [(existing[i], desired[j]) for j, i in owner.items()] + list(zip(spare_existing, spare_desired))
+        return matches, spare_desired[len(spare_existing):], spare_existing[len(spare_desired):]
+
+    def needs_amend(self, order, desired_order):
+        """Whether an existing order has to be amended to stand in for the desired one."""
+        return desired_order['orderQty'] != order['leavesQty'] or (
+            # If price has changed, and the change is more than our RELIST_INTERVAL, amend.
+            desired_order['price'] != order['price'] and
+            abs((desired_order['price'] / order['price']) - 1) > self.settings.RELIST_INTERVAL)
+
+    def ration_orders(self, to_amend, to_create, budget):
+        """Trim amends and creates to what `budget` requests can pay for, keeping those closest to the mid.
+           Deferred orders are left as they are until a later tick."""
+        if ratelimit.bulk_cost(len(to_amend)) + ratelimit.bulk_cost(len(to_create)) <= budget:
+            return to_amend, to_create
+
+        kept_amends, kept_creates = [], []
+        candidates = [(o, kept_amends) for o in to_amend] + [(o, kept_creates) for o in to_create]
+        for order, kept in sorted(candidates, key=lambda c: abs(c[0]['price'] - self.start_position_mid)):
+            kept.append(order)
+            if ratelimit.bulk_cost(len(kept_amends)) + ratelimit.bulk_cost(len(kept_creates)) > budget:
+                kept.pop()
+
+        logger.warning("Rate limit budget is low (%d requests). Deferring %d of %d order changes to a later tick." %
+                       (budget, len(to_amend) + len(to_create) - len(kept_amends) - len(kept_creates),
+                        len(to_amend) + len(to_create)))
+        return [o for o in to_amend if o in kept_amends], [o for o in to_create if o in kept_creates]
 
     ###
     # Position Limits
@@ -423,24 +684,23 @@ class OrderManager:
 
     def short_position_limit_exceeded(self):
         """Returns True if the short position limit is exceeded"""
-        if not settings.CHECK_POSITION_LIMITS:
+        if not self.settings.CHECK_POSITION_LIMITS:
             return False
-        position = self.exchange.get_delta()
-        return position <= settings.MIN_POSITION
+        return self.snapshot.delta <= self.settings.MIN_POSITION
 
     def long_position_limit_exceeded(self):
         """Returns True if the long position limit is exceeded"""
-        if not settings.CHECK_POSITION_LIMITS:
+        if not self.settings.CHECK_POSITION_LIMITS:
             return False
-        position = self.exchange.get_delta()
-        return position >= settings.MAX_POSITION
+        return self.snapshot.delta >= self.settings.MAX_POSITION
 
     ###
     # Sanity
     ##
 
     def sanity_check(self):
-        """Perform checks before placing orders."""
+        """Perform checks before placing orders. This starts a tick: the rest of it works off the snapshot
+           taken here."""
 
         # Check if OB is empty - if so, can't quote.
         self.exchange.check_if_orderbook_empty()
@@ -448,14 +708,19 @@ class OrderManager:
         # Ensure market is still open.
         self.exchange.check_market_open()
 
+        # Everything we decide this tick comes from this one view of the market and our account.
+        self.snapshot = self.exchange.get_snapshot()
+        self.feedLatency = self.exchange.get_feed_latency()
+
         # Get ticker, which sets price offsets and prints some debugging info.
         ticker = self.get_ticker()
 
         # Sanity check:
-        if self.get_price_offset(-1) >= ticker["sell"] or self.get_price_offset(1) <= ticker["buy"]:
+        first_buy, first_sell = self.get_price_offsets([-1, 1])
+        if first_buy >= ticker["sell"] or first_sell <= ticker["buy"]:
             logger.error("Buy: %s, Sell: %s" % (self.start_position_buy, self.start_position_sell))
             logger.error("First buy position: %s\nBitMEX Best Ask: %s\nFirst sell position: %s\nBitMEX Best Bid: %s" %
-                         (self.get_price_offset(-1), ticker["sell"], self.get_price_offset(1), ticker["buy"]))
+                         (first_buy, ticker["sell"], first_sell, ticker["buy"]))
             logger.error("Sanity check failed, exchange data is inconsistent")
             self.exit()
 
@@ -463,12 +728,12 @@ class OrderManager:
         if self.long_position_limit_exceeded():
             logger.info("Long delta limit exceeded")
             logger.info("Current Position: %.f, Maximum Position: %.f" %
-                        (self.exchange.get_delta(), settings.MAX_POSITION))
+                        (self.snapshot.delta, self.settings.MAX_POSITION))
 
         if self.short_position_limit_exceeded():
             logger.info("Short delta limit exceeded")
             logger.info("Current Position: %.f, Minimum Position: %.f" %
-                        (self.exchange.get_delta(), settings.MIN_POSITION))
+                        (self.snapshot.delta, self.settings.MIN_POSITION))
 
     ###
     # Running
@@ -484,10 +749,48 @@ class OrderManager:
         """Ensure the WS connections are still open."""
         return self.exchange.is_open()
 
-    def exit(self):
+    def check_feed(self):
+        """Pull our quotes while our newest market data is more than MAX_FEED_AGE seconds old. Returns False
+           while it is."""
+        if not self.settings.MAX_FEED_AGE:
+            return True
+        age = self.exchange.get_feed_latency()['age']
+        if age is None or age <= self.settings.MAX_FEED_AGE:
+            if self.feedStale:
+                logger.info("Market data has caught up with the exchange. Quoting again.")
+                self.feedStale = False
+            return True
+
+        if not self.feedStale:
+            logger.warning("Market data is %.1fs behind the exchange (MAX_FEED_AGE is %ss). Pulling our quotes." %
+                           (age, self.settings.MAX_FEED_AGE))
+            self.feedStale = True
+        orders = self.exchange.get_orders()
+        if orders:
+            try:
+                self.exchange.cancel_bulk_orders(orders)
+            except Exception as e:
+                logger.warning("Unable to pull our quotes, will retry: %s" % e)
+        return False
+
+    def exit(self, *args):
+        """Cancel our orders and exit. Also the SIGTERM handler."""
+        if self.exiting:
+            return
+        self.exiting = True
         logger.info("Shutting down. All open orders will be cancelled.")
+        start = time()
         try:
-            self.exchange.cancel_all_orders()
+            # Cancel what we know about straight away...
+            self.exchange.halt()
+            canceled = self.exchange.kill()
+            logger.info("Canceled %d orders in %.1fms." % (len(canceled), (time() - start) * 1000))
+            # ...then let requests already in flight land, and sweep up anything they placed.
+            self.exchange.finish_requests()
+            stragglers = self.exchange.cancel_all_orders()
+            logger.info("Confirmed no open orders (%d more canceled) %.1fms after shutdown began." %
+                        (len(stragglers or []), (time() - start) * 1000))
+            self.exchange.disarm()
             self.exchange.bitmex.exit()
         except errors.AuthenticationError as e:
             logger.info("Was not authenticated; could not cancel orders.")
@@ -496,26 +799,70 @@ class OrderManager:
 
         sys.exit()
 
+    def wait_for_tick(self):
+        """Wait until it's time to re-quote: LOOP_INTERVAL when polling, otherwise until something changes."""
+        if not self.settings.EVENT_DRIVEN_LOOP:
+            sleep(self.settings.LOOP_INTERVAL)
+            return
+
+        # With MAX_FEED_AGE, wake up often enough to notice the feed stopping.
+        timeout = min(self.settings.MAX_IDLE_INTERVAL, self.settings.MAX_FEED_AGE or self.settings.MAX_IDLE_INTERVAL)
+        tables, since = self.exchange.wait_for_update(timeout)
+        if since is None:
+            logger.debug("No updates in %ss, re-quoting." % timeout)
+            return
+
+        # Let the rest of a burst arrive, then swallow it so it doesn't trigger a second tick.
+        sleep(self.settings.UPDATE_DEBOUNCE)
+        tables |= self.exchange.wait_for_update(0)[0]
+        logger.debug("Re-quoting on %s update, %.1fms after the first change." %
+                     (", ".join(sorted(tables)), (time() - since) * 1000))
+
+    def timer(self, phase):
+        """Time a phase of the loop into the loop_phase_seconds metric."""
+        return metrics.timer('loop_phase_seconds', phase=phase, symbol=self.exchange.symbol)
+
     def run_loop(self):
         while True:
-            sys.stdout.write("-----\n")
-            sys.stdout.flush()
+            log.write("-----\n")
 
-            self.check_file_change()
-            sleep(settings.LOOP_INTERVAL)
+            with self.timer('check_file_change'):
+                self.check_file_change()
+            with self.timer('wait_for_tick'):
+                self.wait_for_tick()
 
-            # This will restart on very short downtime, but if it's longer,
-            # the MM will crash entirely as it is unable to connect to the WS on boot.
+            # The websocket reconnects and resubscribes by itself. We only restart if it gave up.
             if not self.check_connection():
                 logger.error("Realtime data connection unexpectedly closed, restarting.")
                 self.restart()
 
-            self.sanity_check()  # Ensures health of mm - several cut-out points here
-            self.print_status()  # Print skew, delta, etc
-            self.place_orders()  # Creates desired orders and converges to existing orders
+            # Don't quote off stale data while it's rebuilding tables after a reconnect.
+            with self.timer('wait_for_sync'):
+                synced = self.exchange.wait_for_sync(self.settings.API_ERROR_INTERVAL)
+            if not synced:
+                logger.warning("Realtime data is still resynchronizing. Skipping this tick.")
+                continue
+
+            # Nor off market data that has fallen behind the exchange.
+            with self.timer('check_feed'):
+                fresh = self.check_feed()
+            if not fresh:
+                continue
+
+            # 'tick' is the whole of the work, from the snapshot to the checkpoint.
+            with self.timer('tick'):
+                with self.timer('sanity_check'):
+                    self.sanity_check()  # Ensures health of mm - several cut-out points here
+                with self.timer('print_status'):
+                    self.print_status()  # Print skew, delta, etc
+                with self.timer('place_orders'):
+                    self.place_orders()  # Creates desired orders and converges to existing orders
+                with self.timer('save_checkpoint'):
+                    self.save_checkpoint()
 
     def restart(self):
         logger.info("Restarting the market maker...")
+        log.flush()  # exec() doesn't run atexit handlers.
         os.execv(sys.executable, [sys.executable] + sys.argv)
 
 #
@@ -537,8 +884,48 @@ def margin(instrument, quantity, price):
     return cost(instrument, quantity, price) * instrument["initMargin"]
 
 
+def portfolio_item(instrument, position):
+    """What calc_delta needs to know about one symbol's position."""
+    if instrument['isQuanto']:
+        future_type = "Quanto"
+    elif instrument['isInverse']:
+        future_type = "Inverse"
+    elif not instrument['isQuanto'] and not instrument['isInverse']:
+        future_type = "Linear"
+    else:
+        raise NotImplementedError("Unknown future type; not quanto or inverse: %s" % instrument['symbol'])
+
+    if instrument['underlyingToSettleMultiplier'] is None:
+        multiplier = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
+    else:
+        multiplier = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
+
+    return {
+        "currentQty": float(position['currentQty']),
+        "futureType": future_type,
+        "multiplier": multiplier,
+        "markPrice": float(instrument['markPrice']),
+        "spot": float(instrument['indicativeSettlePrice'])
+    }
+
+
+def item_delta(item, price):
+    """Currency delta of a portfolio_item at `price`."""
+    if item['futureType'] == "Quanto":
+        return item['currentQty'] * item['multiplier'] * price
+    elif item['futureType'] == "Inverse":
+        return (item['multiplier'] / price) * item['currentQty']
+    elif item['futureType'] == "Linear":
+        return item['multiplier'] * item['currentQty']
+
+
 def run():
     logger.info('BitMEX Market Maker Version: %s\n' % constants.VERSION)
+    metrics.start(settings.METRICS_PORT, settings.METRICS_LOG_INTERVAL)
+
+    if settings.MULTI_SYMBOL and len(sys.argv) <= 1:
+        from market_maker import multi_symbol
+        return multi_symbol.run()
 
     om = OrderManager()
     # Try/except just keeps ctrl-c from printing an ugly stacktrace
@@ -0,0 +1,218 @@
+"""Market make several symbols from one process.
+
+Each symbol in settings.CONTRACTS gets its own OrderManager and ExchangeInterface, with settings-<SYMBOL>.py
+layered on top of settings.py, running in its own thread. They share one websocket subscribed to every
+symbol, one REST session and worker pool, and one rate limit budget, so the process holds one set of
+connections however many symbols it quotes. Symbols can trade on different accounts (e.g. sub-accounts) by
+setting API_KEY and API_SECRET in their settings-<SYMBOL>.py. Each account then gets its own rate limit budget
+and realtime stream, and the streams share one /realtimemd websocket.
+
+Enable it with MULTI_SYMBOL = True and run `marketmaker` without a symbol, or call `run()` with your own
+OrderManager subclass.
+"""
+from __future__ import absolute_import
+import atexit
+import logging
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import requests
+
+from market_maker.async_bitmex import mount_pool
+from market_maker.market_maker import ExchangeInterface, OrderManager
+from market_maker.settings import settings, symbol_settings
+from market_maker.utils import metrics, ratelimit
+from market_maker.utils.recorder import Recorder
+from market_maker.ws.feed import FeedReader
+from market_maker.ws.multiplex import Multiplexer
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+logger = logging.getLogger('root')
+
+
+class SharedConnection(object):
+
+    """The websocket, REST session, worker pool and rate limit budgets shared by every symbol.
+
+    Connection settings (BASE_URL, ORDERBOOK_TABLE, RECORD_FILE, MARKET_DATA_FEED) come from `connectionSettings`,
+    by default settings.py. Each symbol's API key comes from its settings in `symbolSettings` (symbol -> settings),
+    by default `connectionSettings` too. Symbols on the same key share a realtime stream and a rate limit budget;
+    if there's more than one key, the streams share one /realtimemd socket. Pass `rateLimiters` (API key ->
+    RateLimiter) to share budgets beyond this process.
+    """
+
+    # Concurrent REST requests per symbol; each tick sends up to three (amend, create, cancel) at once.
+    WORKERS_PER_SYMBOL = 2
+    MIN_WORKERS = 4
+
+    def __init__(self, symbols, connectionSettings=None, rateLimiters=None, symbolSettings=None):
+        connectionSettings = connectionSettings or settings
+        symbolSettings = symbolSettings or {}
+        self.symbols = symbols
+        self.recorder = Recorder(connectionSettings.RECORD_FILE) if connectionSettings.RECORD_FILE else None
+        self.session = requests.Session()
+
+        workers = max(SharedConnection.MIN_WORKERS, SharedConnection.WORKERS_PER_SYMBOL * len(symbols))
+        self.executor = ThreadPoolExecutor(workers)
+        mount_pool(self.session, workers)
+
+        accounts = {}  # API key -> (secret, its symbols)
+        self.keys = {}
+        for symbol in symbols:
+            symbolSetting = symbolSettings.get(symbol, connectionSettings)
+            self.keys[symbol] = symbolSetting.API_KEY
+            accounts.setdefault(symbolSetting.API_KEY, (symbolSetting.API_SECRET, []))[1].append(symbol)
+        self.rateLimiters = dict(rateLimiters or {})
+        for apiKey in accounts:
+            self.rateLimiters.setdefault(apiKey, ratelimit.RateLimiter())
+
+        self.mux = None
+        if len(accounts) > 1:
+            logger.info("Multiplexing %d accounts over one websocket." % len(accounts))
+            self.mux = Multiplexer(connectionSettings.BASE_URL)
+            self.mux.connect()
+
+        feed = FeedReader(connectionSettings.MARKET_DATA_FEED) if connectionSettings.MARKET_DATA_FEED else None
+        self.streams = {}  # API key -> BitMEXWebsocket
+        for apiKey, (apiSecret, keySymbols) in accounts.items():
+            self.streams[apiKey] = BitMEXWebsocket(recorder=self.recorder, feed=feed, mux=self.mux, apiKey=apiKey,
+                                                   apiSecret=apiSecret)
+            self.streams[apiKey].connect(connectionSettings.BASE_URL, keySymbols, shouldAuth=True,
+                                         orderBook=connectionSettings.ORDERBOOK_TABLE)
+
+    def ws(self, symbol):
+        """The realtime stream for `symbol`'s account."""
+        return self.streams[self.keys[symbol]]
+
+    def rate_limiter(self, symbol):
+        """The rate limit budget of `symbol`'s account."""
+        return self.rateLimiters[self.keys[symbol]]
+
+    def exit(self):
+        self.executor.shutdown(wait=False)
+        for ws in self.streams.values():
+            ws.exit()
+        if self.mux:
+            self.mux.exit()
+        if self.recorder:
+            self.recorder.close()
+
+
+class MultiSymbolManager(object):
+
+    """Runs an OrderManager (sub)class per symbol over one SharedConnection.
+
+    If any symbol's loop stops (an error, or its sanity check failing), every symbol's orders are canceled
+    and the process exits, just as a single-symbol bot would: with status 1 after an error, otherwise 0.
+    Override `connect` to set up the SharedConnection differently.
+    """
+
+    def __init__(self, symbols, orderManagerClass=OrderManager):
+        self.symbols = symbols
+        self.orderManagerClass = orderManagerClass
+        self.exchanges = {}
+        self.managers = {}
+        self.exiting = False
+        self.failed = False
+
+        # Log lines from different symbols are interleaved; tag each with its thread, named for the symbol.
+        for handler in logger.handlers:
+            handler.setFormatter(logging.Formatter(
+                fmt='%(asctime)s - %(levelname)s - %(threadName)s - %(module)s - %(message)s'))
+
+        logger.info("Market making %s from one process." % ", ".join(symbols))
+        # Loaded up front: importing settings files isn't safe from several threads at once.
+        self.symbolSettings = dict((symbol, symbol_settings(symbol, settings)) for symbol in symbols)
+        self.connection = self.connect()
+        atexit.register(self.exit)
+        signal.signal(signal.SIGTERM, self.exit)
+
+    def connect(self):
+        return SharedConnection(self.symbols, symbolSettings=self.symbolSettings)
+
+    def run_loop(self):
+        threads = [threading.Thread(target=self.run_symbol, args=(symbol, self.symbolSettings[symbol]), name=symbol)
+                   for symbol in self.symbols]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while all(thread.is_alive() for thread in threads):
+            sleep(1)
+        stopped = [thread.name for thread in threads if not thread.is_alive()]
+        logger.error("Market making stopped for %s. Shutting down." % ", ".join(stopped))
+        self.exit()
+
+    def run_symbol(self, symbol, symbolSettings):
+        """Thread body: set up this symbol's order manager, then run its loop."""
+        exchange = ExchangeInterface(symbolSettings.DRY_RUN, symbol=symbol, connection=self.connection,
+                                     symbolSettings=symbolSettings)
+        self.exchanges[symbol] = exchange
+        try:
+            self.managers[symbol] = self.orderManagerClass(exchange=exchange, symbolSettings=symbolSettings)
+            self.managers[symbol].run_loop()
+        except Exception:
+            if not self.exiting:
+                self.failed = True
+                raise
+            # Order requests fail once exit() has halted the exchanges; that's expected.
+        except SystemExit as e:
+            # e.g. a REST error exit(1)ing, or the order manager's own exit(). Either way, this symbol has stopped.
+            if not self.exiting:
+                logger.error("Market making for %s exited (status %s)." % (symbol, e.code))
+                if e.code:
+                    self.failed = True
+
+    def exit(self, *args):
+        if self.exiting:
+            return
+        self.exiting = True
+        logger.info("Shutting down. All open orders will be cancelled.")
+        start = time()
+        # Stop every symbol placing orders and cancel the orders we know about straight away. Then let what's
+        # already in the shared worker pool finish, and sweep up anything it placed.
+        exchanges = list(self.exchanges.items())
+        for symbol, exchange in exchanges:
+            exchange.halt()
+        exchanges = [(symbol, exchange) for symbol, exchange in exchanges if not self.keeps_orders(exchange)]
+        for symbol, exchange in exchanges:
+            try:
+                exchange.kill()
+            except Exception as e:
+                logger.info("Unable to cancel %s orders: %s" % (symbol, e))
+        if exchanges:
+            logger.info("Canceled orders in %.1fms." % ((time() - start) * 1000))
+        self.connection.executor.shutdown(wait=True)
+        for symbol, exchange in exchanges:
+            try:
+                exchange.cancel_all_orders()
+                exchange.disarm()
+            except Exception as e:
+                logger.info("Unable to cancel %s orders: %s" % (symbol, e))
+        if exchanges:
+            logger.info("Confirmed no open orders %.1fms after shutdown began." % ((time() - start) * 1000))
+        self.connection.exit()
+        sys.exit(self.exit_code())
+
+    def exit_code(self):
+        return 1 if self.failed else 0
+
+    def keeps_orders(self, exchange):
+        """Whether to leave `exchange`'s orders open when we exit, for the next run to adopt."""
+        return False
+
+
+def run(orderManagerClass=OrderManager):
+    metrics.start(settings.METRICS_PORT, settings.METRICS_LOG_INTERVAL)
+    manager = MultiSymbolManager(list(settings.CONTRACTS), orderManagerClass)
+    # Try/except just keeps ctrl-c from printing an ugly stacktrace
+    try:
+        manager.run_loop()
+    except (KeyboardInterrupt, SystemExit):
+        sys.exit(manager.exit_code())
+
+
+if __name__ == "__main__":
+    run()
@@ -22,22 +22,30 @@ def import_path(fullpath):
     return module
 
 
+def symbol_settings(symbol=None, base=None):
+    """Assemble settings: settings-<symbol>.py, if there is one, layered on top of `base` (a settings dict,
+       by default the defaults and then settings.py)."""
+    symbolSettings = None
+    if symbol:
+        print("Importing symbol settings for %s..." % symbol)
+        try:
+            symbolSettings = import_path(os.path.join('..', 'settings-%s' % symbol))
+        except Exception as e:
+            print("Unable to find settings-%s.py." % symbol)
+
+    assembled = {}
+    if base is None:
+        assembled.update(vars(baseSettings))
+        assembled.update(vars(userSettings))
+    else:
+        assembled.update(base)
+    if symbolSettings:
+        assembled.update(vars(symbolSettings))
+    return dotdict(assembled)
+
+
 userSettings = import_path(os.path.join('.', 'settings'))
-symbolSettings = None
 symbol = sys.argv[1] if len(sys.argv) > 1 else None
-if symbol:
-    print("Importing symbol settings for %s..." % symbol)
-    try:
-        symbolSettings = import_path(os.path.join('..', 'settings-%s' % symbol))
-    except Exception as e:
-        print("Unable to find settings-%s.py." % symbol)
-
-# Assemble settings.
-settings = {}
-settings.update(vars(baseSettings))
-settings.update(vars(userSettings))
-if symbolSettings:
-    settings.update(vars(symbolSettings))
 
 # Main export
-settings = dotdict(settings)
+settings = symbol_settings(symbol)
@@ -0,0 +1,254 @@
+"""Run groups of symbols in separate worker processes, so strategies can use more than one core.
+
+Each group in settings.WORKER_GROUPS (by default, each symbol in CONTRACTS on its own) runs in its own worker
+process, the same way `multi_symbol` runs symbols in one process. The supervisor restarts workers that crash,
+and starts a fresh one when a worker asks to restart (its files changed, or its websocket gave up) rather than
+exec'ing over itself.
+
+Workers share a few things through shared memory:
+  * Workers on the same API key spend from one rate limit budget, as the exchange counts it.
+  * Each symbol's delta is published, so every worker on an account can respect MAX_ACCOUNT_DELTA, the limit on
+    the account's total delta (as calc_delta counts it, at mark price).
+
+Run `marketmaker-supervisor`, or call `run()` with your own OrderManager subclass.
+"""
+from __future__ import absolute_import
+import atexit
+import logging
+import multiprocessing
+import signal
+import sys
+from time import sleep, time
+
+from market_maker.market_maker import OrderManager, item_delta, portfolio_item
+from market_maker.multi_symbol import MultiSymbolManager, SharedConnection
+from market_maker.settings import settings, symbol_settings
+from market_maker.utils import metrics
+from market_maker.utils.ratelimit import SharedRateLimiter
+
+logger = logging.getLogger('root')
+
+# A worker exits with this to be replaced straight away, rather than after a crash's restart delay.
+RESTART_EXIT_CODE = 3
+
+
+class AccountDelta(object):
+
+    """Each symbol's delta, in a shared array, summed over the symbols on one account."""
+
+    def __init__(self, values, slots):
+        self.values = values  # One slot per symbol under the supervisor
+        self.slots = slots    # symbol -> slot, for this account's symbols
+
+    def update(self, snapshot):
+        """Publish this symbol's delta from its tick snapshot. Returns the account's total."""
+        item = portfolio_item(snapshot.instrument, snapshot.position)
+        self.values[self.slots[snapshot.instrument['symbol']]] = item_delta(item, item['markPrice'])
+        return sum(self.values[slot] for slot in self.slots.values())
+
+
+def supervised(orderManagerClass, worker, accountDeltas):
+    """orderManagerClass, adapted to run in a supervised worker. `accountDeltas` maps API keys to AccountDeltas."""
+
+    class SupervisedOrderManager(orderManagerClass):
+
+        deltaSnapshot = None
+        accountTotal = 0
+
+        def restart(self):
+            logger.info("Restarting the market maker...")
+            worker.restarting = True
+            # Ends this symbol's thread. The worker then cancels its orders and exits for the supervisor to
+            # start a new one.
+            sys.exit()
+
+        def account_delta(self):
+            if self.deltaSnapshot is not self.snapshot:
+                self.deltaSnapshot = self.snapshot
+                self.accountTotal = accountDeltas[self.settings.API_KEY].update(self.snapshot)
+            return self.accountTotal
+
+        def short_position_limit_exceeded(self):
+            if super(SupervisedOrderManager, self).short_position_limit_exceeded():
+                return True
+            if self.settings.MAX_ACCOUNT_DELTA is None:
+                return False
+            return self.account_delta() <= -self.settings.MAX_ACCOUNT_DELTA
+
+        def long_position_limit_exceeded(self):
+            if super(SupervisedOrderManager, self).long_position_limit_exceeded():
+                return True
+            if self.settings.MAX_ACCOUNT_DELTA is None:
+                return False
+            return self.account_delta() >= self.settings.MAX_ACCOUNT_DELTA
+
+    return SupervisedOrderManager
+
+
+class WorkerManager(MultiSymbolManager):
+
+    """A worker's MultiSymbolManager: exits with RESTART_EXIT_CODE when one of its symbols asks to restart,
+       leaving its orders open for the replacement if WARM_START is set."""
+
+    def __init__(self, symbols, orderManagerClass, accountDeltas, rateLimiters):
+        self.restarting = False
+        self.rateLimiters = rateLimiters
+        super(WorkerManager, self).__init__(symbols, supervised(orderManagerClass, self, accountDeltas))
+
+    def connect(self):
+        return SharedConnection(self.symbols, connectionSettings=self.symbolSettings[self.symbols[0]],
+                                rateLimiters=self.rateLimiters, symbolSettings=self.symbolSettings)
+
+    def exit_code(self):
+        return RESTART_EXIT_CODE if self.restarting else super(WorkerManager, self).exit_code()
+
+    def keeps_orders(self, exchange):
+        # The replacement worker adopts them.
+        return self.restarting and exchange.settings.WARM_START
+
+
+def run_worker(symbols, baseSettings, orderManagerClass, rateLimits, deltas, slots):
+    """Worker process body. `baseSettings` are the supervisor's settings, so overrides made at runtime carry over;
+       settings-<SYMBOL>.py files are layered on top as usual. `rateLimits` and `slots` are per API key."""
+    settings.update(baseSettings)
+    metrics.start(settings.METRICS_PORT, settings.METRICS_LOG_INTERVAL)
+    rateLimiters = dict((apiKey, SharedRateLimiter(*rateLimit)) for apiKey, rateLimit in rateLimits.items())
+    accountDeltas = dict((apiKey, AccountDelta(deltas, keySlots)) for apiKey, keySlots in slots.items())
+    manager = WorkerManager(symbols, orderManagerClass, accountDeltas, rateLimiters)
+    try:
+        manager.run_loop()
+    except KeyboardInterrupt:
+        manager.exit()
+
+
+class Worker(object):
+
+    """A group of symbols and the process running them."""
+
+    def __init__(self, symbols, args):
+        self.symbols = symbols
+        self.name = "+".join(symbols)
+        self.args = args
+        self.process = None
+        self.started = None
+        self.crashes = 0
+        self.restartAt = None
+
+
+class Supervisor(object):
+
+    """Starts a worker process per group of symbols and keeps them running."""
+
+    # A worker that crashes after running this long (seconds) is restarted without the delay built up by earlier
+    # crashes.
+    STABLE_RUN = 60
+    MAX_RESTART_DELAY = 60
+    # How long to give workers to cancel their orders and exit when shutting down.
+    SHUTDOWN_TIMEOUT = 30
+
+    def __init__(self, groups, orderManagerClass=OrderManager):
+        # Spawned, not forked: a restarted worker loads the code as it is now, as the single-symbol bot's restart
+        # does.
+        self.context = multiprocessing.get_context('spawn')
+        self.exiting = False
+
+        # Only plain settings carry over to the workers.
+        baseSettings = dict((k, v) for k, v in settings.items() if k.isupper())
+
+        # The exchange counts the rate limit and the position per API key, so workers on a key share them.
+        symbols = [symbol for group in groups for symbol in group]
+        deltas = self.context.RawArray('d', len(symbols))
+        keys = dict((symbol, symbol_settings(symbol, settings).API_KEY) for symbol in symbols)
+        rateLimits = {}  # API key -> its shared rate limit
+        accounts = {}    # API key -> {symbol: its slot in deltas}
+        for slot, symbol in enumerate(symbols):
+            if keys[symbol] not in rateLimits:
+                rateLimits[keys[symbol]] = SharedRateLimiter.allocate(self.context)
+                accounts[keys[symbol]] = {}
+            accounts[keys[symbol]][symbol] = slot
+
+        self.workers = []
+        for i, group in enumerate(groups):
+            groupKeys = set(keys[symbol] for symbol in group)
+            workerSettings = baseSettings
+            if settings.METRICS_PORT:
+                workerSettings = dict(baseSettings, METRICS_PORT=settings.METRICS_PORT + i)
+            self.workers.append(Worker(group, (group, workerSettings, orderManagerClass,
+                                               dict((k, rateLimits[k]) for k in groupKeys), deltas,
+                                               dict((k, accounts[k]) for k in groupKeys))))
+
+        logger.info("Supervising %d workers: %s" % (len(self.workers), ", ".join(w.name for w in self.workers)))
+        atexit.register(self.exit)
+        signal.signal(signal.SIGTERM, self.exit)
+
+    def start(self, worker):
+        worker.process = self.context.Process(target=run_worker, args=worker.args, name=worker.name)
+        worker.process.start()
+        worker.started = time()
+        worker.restartAt = None
+        logger.info("Started worker %s (pid %d)." % (worker.name, worker.process.pid))
+
+    def run_loop(self):
+        for worker in self.workers:
+            self.start(worker)
+
+        while self.workers:
+            sleep(1)
+            for worker in list(self.workers):
+                if worker.restartAt is not None:
+                    if time() >= worker.restartAt:
+                        self.start(worker)
+                elif not worker.process.is_alive():
+                    self.reap(worker)
+
+        logger.info("All workers have stopped.")
+
+    def reap(self, worker):
+        """Decide what to do about a worker that exited."""
+        code = worker.process.exitcode
+        if code == 0:
+            # Stopped on purpose (e.g. a failed sanity check), as a single-symbol bot would.
+            logger.info("Worker %s stopped." % worker.name)
+            self.workers.remove(worker)
+        elif code == RESTART_EXIT_CODE:
+            worker.crashes = 0
+            self.start(worker)
+        else:
+            if time() - worker.started >= Supervisor.STABLE_RUN:
+                worker.crashes = 0
+            delay = min(Supervisor.MAX_RESTART_DELAY, settings.WORKER_RESTART_DELAY * 2 ** worker.crashes)
+            worker.crashes += 1
+            logger.error("Worker %s exited with status %s. Restarting it in %ds." % (worker.name, code, delay))
+            worker.restartAt = time() + delay
+
+    def exit(self, *args):
+        if self.exiting:
+            return
+        self.exiting = True
+        logger.info("Shutting down. Workers will cancel their open orders.")
+        running = [w.process for w in self.workers if w.process is not None and w.process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time() + Supervisor.SHUTDOWN_TIMEOUT
+        for process in running:
+            process.join(max(0, deadline - time()))
+            if process.is_alive():
+                logger.error("Worker %s didn't exit in time." % process.name)
+        sys.exit()
+
+
+def groups_from_settings():
+    return [list(group) for group in settings.WORKER_GROUPS] or [[symbol] for symbol in settings.CONTRACTS]
+
+
+def run(orderManagerClass=OrderManager):
+    supervisor = Supervisor(groups_from_settings(), orderManagerClass)
+    # Try/except just keeps ctrl-c from printing an ugly stacktrace
+    try:
+        supervisor.run_loop()
+    except (KeyboardInterrupt, SystemExit):
+        sys.exit()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,31 @@
+"""Save a little of the order manager's state to disk, so a restart can pick up where the last run left off."""
+import json
+import os
+
+
+class Checkpoint(object):
+
+    """State in one JSON file. Rewritten atomically, and only when the state has changed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = None
+
+    def load(self):
+        """The state last saved, or None if there isn't any (or it's unreadable)."""
+        try:
+            with open(self.path) as f:
+                self.saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return self.saved
+
+    def save(self, state):
+        if state == self.saved:
+            return
+        # Write a new file and rename it over the old one, so a crash mid-write can't leave half a checkpoint.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.saved = state
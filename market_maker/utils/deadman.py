@@ -0,0 +1,71 @@
+"""Keep BitMEX's dead man's switch armed, so the exchange cancels our orders if we stop.
+
+order/cancelAllAfter cancels every open order on the account `timeout` ms after it was last called. A background
+thread calls it again every fraction of the timeout, so if the bot hangs, crashes or loses its connection, its
+orders are canceled within `timeout` anyway.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('root')
+
+
+class DeadMansSwitch(object):
+
+    """Re-arms order/cancelAllAfter from a daemon thread.
+
+    The exchange keeps one timer per account, so a process needs one switch per API key; `arm` returns the key's
+    switch, starting it the first time.
+    """
+
+    # Re-arm this many times per timeout, so a failed call or two doesn't let it fire.
+    REARMS_PER_TIMEOUT = 4
+
+    switches = {}  # API key -> DeadMansSwitch
+    lock = threading.Lock()
+
+    @classmethod
+    def arm(cls, bitmex, timeout):
+        """The switch for `bitmex`'s API key, cancelling after `timeout` seconds without a re-arm."""
+        with cls.lock:
+            switch = cls.switches.get(bitmex.apiKey)
+            if switch is None:
+                switch = cls.switches[bitmex.apiKey] = DeadMansSwitch(bitmex, timeout)
+                switch.start()
+            return switch
+
+    def __init__(self, bitmex, timeout):
+        self.bitmex = bitmex
+        self.timeout = timeout
+        self.stopped = threading.Event()
+
+    def start(self):
+        logger.info("Arming the dead man's switch: orders are canceled %ss after we stop re-arming it." % self.timeout)
+        thread = threading.Thread(target=self.run, name='deadman')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        interval = float(self.timeout) / DeadMansSwitch.REARMS_PER_TIMEOUT
+        nextRearm = time.time()
+        while not self.stopped.is_set():
+            nextRearm += interval
+            try:
+                self.bitmex.cancel_all_after(int(self.timeout * 1000), deadline=nextRearm)
+            except (Exception, SystemExit) as e:
+                # Whatever went wrong, keep trying: if this thread stops, the exchange cancels everything.
+                logger.warning("Unable to re-arm the dead man's switch: %r" % e)
+            # On schedule, however long that call took; straight away if it overran.
+            nextRearm = max(nextRearm, time.time())
+            self.stopped.wait(nextRearm - time.time())
+
+    def disarm(self):
+        """Stop re-arming and cancel the exchange's timer, once we've canceled our orders ourselves."""
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        try:
+            self.bitmex.cancel_all_after(0)
+        except (Exception, SystemExit) as e:
+            logger.info("Unable to disarm the dead man's switch: %s" % e)
@@ -0,0 +1,15 @@
+"""JSON decoding for hot paths. Uses the fastest parser installed, falling back to the standard library."""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+    DECODER = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        DECODER = 'ujson'
+    except ImportError:
+        loads = json.loads
+        DECODER = 'json'
@@ -1,14 +1,194 @@
+"""Logging that never holds up trading.
+
+Loggers set up here don't write anything themselves: records go onto one bounded queue per process and a
+background thread ('log') formats and writes them. A logging call on the trading loop or the websocket thread
+costs building the record and a put, however slow stdout is. If the queue fills (stdout is piped to something
+that has stopped reading, or a disk has stalled), records are dropped and counted rather than waited on, and the
+log thread says how many once it catches up.
+
+The same thread writes the order event log: with settings.ORDER_EVENT_LOG set, every order we create, amend or
+cancel, and every fill, as a line of JSON.
+"""
+from __future__ import absolute_import
+import atexit
+import json
 import logging
+import os
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    import queue
+
 from market_maker.settings import settings
 
 
 def setup_custom_logger(name, log_level=settings.LOG_LEVEL):
     formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
-
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
-
     logger = logging.getLogger(name)
     logger.setLevel(log_level)
-    logger.addHandler(handler)
+    logger.addHandler(AsyncHandler(handler))
     return logger
+
+
+def write(text, stream=None):
+    """Write `text` to `stream` (stdout by default) from the log thread."""
+    logThread().put(_write, (stream or sys.stdout, text))
+
+
+def order_event(event, order, **fields):
+    """Log `event` ('create', 'amend', 'cancel' or 'fill') of `order` to settings.ORDER_EVENT_LOG, if set. `fields`
+       are added to the line, overriding the order's."""
+    events = orderEvents()
+    if events is None:
+        return
+    line = dict((field, order.get(field)) for field in OrderEventLog.FIELDS if field in order)
+    line.update(fields)
+    line['event'] = event
+    line['time'] = events.clock()
+    logThread().put(events.write, line)
+
+
+def flush(timeout=5):
+    """Wait (up to `timeout` seconds) for everything logged so far to be written. Call it before exec()ing or
+       otherwise exiting without atexit handlers."""
+    if _logThread is not None:
+        _logThread.flush(timeout)
+
+
+class AsyncHandler(QueueHandler):
+
+    """Hands records to the log thread, for `target` (a handler) to write there."""
+
+    # Args of these types can't change between the logging call and the log thread formatting the message, so
+    # formatting waits for the log thread. Anything else (e.g. a dict we go on updating) is formatted now.
+    IMMUTABLE = (str, int, float, bool, type(None))
+
+    def __init__(self, target):
+        QueueHandler.__init__(self, None)
+        self.target = target
+
+    def setFormatter(self, fmt):
+        # The target does the formatting, in the log thread.
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        args = record.args
+        if args and (not isinstance(args, tuple) or
+                     not all(type(arg) in AsyncHandler.IMMUTABLE for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks now, while we have them. The formatter uses exc_text in place of exc_info.
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        logThread().put(self.target.handle, record)
+
+
+class LogThread(object):
+
+    """Runs what's put() on its queue, in order, in a daemon thread."""
+
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.dropped = 0  # Since the log thread last reported drops. Counted without a lock; it's a log line.
+        self.thread = threading.Thread(target=self.run, name='log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, write, item):
+        """Have the log thread call write(item), or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait((write, item))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout):
+        if threading.current_thread() is self.thread:
+            return
+        done = threading.Event()
+        try:
+            self.queue.put((threading.Event.set, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            write, item = self.queue.get()
+            try:
+                write(item)
+            except Exception:
+                sys.stderr.write("Logging failed writing %r:\n%s\n" %
+                                 (item, _formatter.formatException(sys.exc_info())))
+            if self.dropped and self.queue.empty():
+                dropped, self.dropped = self.dropped, 0
+                logging.getLogger('root').warning(
+                    "The log fell behind: %d lines were dropped rather than hold up trading." % dropped)
+
+
+class OrderEventLog(object):
+
+    """Order events as JSON lines, appended to `path`."""
+
+    # Order fields logged with each event, where the order has them.
+    FIELDS = ('symbol', 'orderID', 'clOrdID', 'side', 'price', 'orderQty', 'leavesQty', 'cumQty', 'ordStatus')
+
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        self.file = open(path, 'a')
+
+    def write(self, line):
+        # One write per line, so processes appending to the same file don't interleave within a line.
+        self.file.write(json.dumps(line, sort_keys=True) + '\n')
+        self.file.flush()
+
+
+def logThread():
+    """The process's log thread, started on first use."""
+    global _logThread
+    if _logThread is None:
+        with _lock:
+            if _logThread is None:
+                _logThread = LogThread(settings.LOG_QUEUE_SIZE)
+                atexit.register(flush)
+    return _logThread
+
+
+def orderEvents():
+    """The process's OrderEventLog, or None without settings.ORDER_EVENT_LOG."""
+    global _orderEvents
+    if _orderEvents is None and settings.ORDER_EVENT_LOG:
+        with _lock:
+            if _orderEvents is None:
+                _orderEvents = OrderEventLog(settings.ORDER_EVENT_LOG)
+    return _orderEvents
+
+
+def _forked():
+    # A forked child has our queue but not the thread; it starts its own.
+    global _logThread
+    _logThread = None
+
+
+def _write(item):
+    stream, text = item
+    stream.write(text)
+    stream.flush()
+
+
+_formatter = logging.Formatter()
+_lock = threading.Lock()
+_logThread = None
+_orderEvents = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forked)
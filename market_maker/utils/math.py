@@ -1,9 +1,41 @@
 from decimal import Decimal
 
+# tickSize -> (tickLog, tickSize as a fraction numerator / 10**tickLog). Instruments share a handful of tick
+# sizes, so this stays small.
+_tickSizes = {}
+
+
+def _tickSize(tickSize):
+    cached = _tickSizes.get(tickSize)
+    if cached is None:
+        # http://stackoverflow.com/a/6190291/832202
+        log = Decimal(str(tickSize)).as_tuple().exponent * -1
+        scale = 10 ** max(0, log)
+        cached = _tickSizes[tickSize] = (log, int(round(tickSize * scale)), scale)
+    return cached
+
+
+def tickLog(tickSize):
+    """Number of decimal places in a tick size: tickLog(0.5) -> 1, tickLog(0.01) -> 2, tickLog(1) -> 0."""
+    return _tickSize(tickSize)[0]
+
+
+def toTicks(num, tickSize):
+    """Round a price to a whole number of ticks: toTicks(401.46, 0.01) -> 40146.
+       Prices in ticks are exact, so compare and step them as ints and convert back with fromTicks."""
+    return int(round(num / tickSize))
+
+
+def fromTicks(ticks, tickSize):
+    """The price of a whole number of ticks, as the float closest to it: fromTicks(40146, 0.01) -> 401.46."""
+    _, numerator, scale = _tickSize(tickSize)
+    # Both are exact integers and int / int rounds correctly, so this is exact where ticks * tickSize isn't.
+    return (ticks * numerator) / scale
+
+
 def toNearest(num, tickSize):
     """Given a number, round it to the nearest tick. Very useful for sussing float error
        out of numbers: e.g. toNearest(401.46, 0.01) -> 401.46, whereas processing is
        normally with floats would give you 401.46000000000004.
        Use this after adding/subtracting/multiplying numbers."""
-    tickDec = Decimal(str(tickSize))
-    return float((Decimal(round(num / tickSize, 0)) * tickDec))
+    return fromTicks(toTicks(num, tickSize), tickSize)
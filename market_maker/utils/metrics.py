@@ -0,0 +1,253 @@
+"""Latency histograms for the trading loop, REST requests and websocket messages.
+
+Code being measured records into the process's registry, one histogram per series (a name and its labels):
+
+    with metrics.timer('loop_phase_seconds', phase='sanity_check', symbol='XBTUSD'):
+        ...
+    metrics.histogram('ws_message_seconds', table='quote', action='insert').record(seconds)
+
+Recording is always on; it costs about a microsecond. `start()` serves every series at
+http://localhost:<port>/metrics in Prometheus' text format, as a summary (p50 and p99, sum and count) plus a _max
+gauge, and logs the p50/p99/max of each series over the last interval.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+from time import perf_counter, sleep
+
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('root')
+
+# Exported as <PREFIX><name>.
+PREFIX = 'marketmaker_'
+HELP = {
+    'loop_phase_seconds': "Time spent in each phase of the order manager's loop.",
+    'rest_request_seconds': "REST request round trips, by endpoint and HTTP status (or timeout/error).",
+    'ws_message_seconds': "Time to decode and apply a websocket message, by table and action.",
+    'feed_latency_seconds': "From the exchange's timestamp on the newest websocket message to our receiving it, "
+                            "sampled each tick, by table.",
+    'quote_latency_seconds': "From the exchange changing the best bid/ask to our orders for it going out.",
+}
+QUANTILES = [0.5, 0.99]
+
+
+class Histogram(object):
+
+    """Latencies in log-linear buckets, as an HDR histogram keeps them.
+
+    Values are counted in whole microseconds. Each power of two is split into SUB_BUCKETS / 2 linear buckets, so
+    a value is kept to within 1/64th (about 1.6%) of what was recorded, whatever its size, and recording is
+    constant time. Only buckets that have been hit are stored.
+
+    Recording takes no lock, as it's on the websocket thread's hot path. Most series are only written by one
+    thread; one written by several at once (REST requests, from the worker pool) can very occasionally lose a
+    count, which doesn't move its percentiles.
+    """
+
+    UNIT = 1e-6
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    HALF = SUB_BUCKETS >> 1
+
+    def __init__(self):
+        self.counts = {}  # bucket index -> values recorded in it
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        shift = value.bit_length() - Histogram.SUB_BUCKET_BITS
+        index = value if shift <= 0 else (shift << (Histogram.SUB_BUCKET_BITS - 1)) + (value >> shift)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """The value (in seconds) that `q` (0 to 1) of recorded values are at or below."""
+        if not self.count:
+            return 0.0
+        rank = max(1, q * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(Histogram.highest(index) * Histogram.UNIT, self.max)
+        return self.max
+
+    def copy(self):
+        other = Histogram()
+        other.counts, other.count, other.sum, other.max = dict(self.counts), self.count, self.sum, self.max
+        return other
+
+    def since(self, earlier):
+        """What's been recorded since `earlier`, a copy() of this histogram. Its max is only as precise as a
+           bucket."""
+        delta = self.copy()
+        if earlier is None:
+            return delta
+        for index, count in earlier.counts.items():
+            delta.counts[index] -= count
+            if not delta.counts[index]:
+                del delta.counts[index]
+        delta.count -= earlier.count
+        delta.sum -= earlier.sum
+        delta.max = min(Histogram.highest(max(delta.counts)) * Histogram.UNIT, self.max) if delta.counts else 0.0
+        return delta
+
+    @staticmethod
+    def highest(index):
+        """The highest value (in UNITs) counted in bucket `index`."""
+        shift = max(0, index // Histogram.HALF - 1)
+        return ((index - shift * Histogram.HALF + 1) << shift) - 1
+
+
+class Timer(object):
+
+    """Context manager recording the time spent in its block."""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(perf_counter() - self.start)
+
+
+class Metrics(object):
+
+    """Every series' histogram."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}  # (name, ((label, value), ...)) -> Histogram
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.series.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.series.setdefault(key, Histogram())
+        return histogram
+
+    def timer(self, name, **labels):
+        return Timer(self.histogram(name, **labels))
+
+    def snapshot(self):
+        """A copy of every series' histogram, by series."""
+        with self.lock:
+            series = list(self.series.items())
+        return dict((key, histogram.copy()) for key, histogram in series)
+
+    def prometheus(self):
+        """Every series in Prometheus' text exposition format."""
+        byName = {}
+        for (name, labels), histogram in sorted(self.snapshot().items(), key=lambda item: str(item[0])):
+            byName.setdefault(name, []).append((labels, histogram))
+        lines = []
+        for name, series in sorted(byName.items()):
+            metric = PREFIX + name
+            if name in HELP:
+                lines.append('# HELP %s %s' % (metric, HELP[name]))
+            lines.append('# TYPE %s summary' % metric)
+            for labels, histogram in series:
+                for q in QUANTILES:
+                    lines.append('%s%s %r' % (metric, format_labels(labels + (('quantile', q),)),
+                                              histogram.percentile(q)))
+                lines.append('%s_sum%s %r' % (metric, format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (metric, format_labels(labels), histogram.count))
+            lines.append('# TYPE %s_max gauge' % metric)
+            for labels, histogram in series:
+                lines.append('%s_max%s %r' % (metric, format_labels(labels), histogram.max))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, earlier, current):
+        """Log lines for what was recorded between two snapshot()s."""
+        lines = []
+        for (name, labels), histogram in sorted(current.items(), key=lambda item: str(item[0])):
+            delta = histogram.since(earlier.get((name, labels)))
+            if delta.count:
+                lines.append("%s%s: %d, p50 %.2fms, p99 %.2fms, max %.2fms" % (
+                    name, format_labels(labels), delta.count, delta.percentile(0.5) * 1000,
+                    delta.percentile(0.99) * 1000, delta.max * 1000))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                                  .replace('\n', r'\n')) for label, value in labels)
+
+
+# The process's registry.
+registry = Metrics()
+
+
+def histogram(name, **labels):
+    return registry.histogram(name, **labels)
+
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.prometheus().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format % args)
+
+
+_started = False
+
+
+def start(port=None, logInterval=None):
+    """Serve the metrics on localhost:`port` and log a summary every `logInterval` seconds, in daemon threads.
+       Either can be None (or 0) to leave it out. Only the first call in a process does anything."""
+    global _started
+    if _started:
+        return
+    _started = True
+    if port:
+        server = HTTPServer(('localhost', port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving latency metrics at http://localhost:%d/metrics" % port)
+    if logInterval:
+        thread = threading.Thread(target=log_summaries, args=(logInterval,), name='metrics-log')
+        thread.daemon = True
+        thread.start()
+
+
+def log_summaries(interval):
+    earlier = registry.snapshot()
+    while True:
+        sleep(interval)
+        current = registry.snapshot()
+        lines = registry.summary(earlier, current)
+        earlier = current
+        if lines:
+            logger.info("Latency over the last %ds:\n  %s" % (interval, "\n  ".join(lines)))
@@ -0,0 +1,180 @@
+"""Our own orders as we've asked for them to be, ahead of the websocket.
+
+A REST call that creates, amends or cancels an order returns before the websocket's `order` update for it arrives,
+so for a moment the websocket still shows the order as it was, or not at all. Quoting off that view re-sends the
+same change, or amends an order that has already closed ("Invalid ordStatus").
+
+ExchangeInterface keeps an OrderTracker per symbol. It records each request as it's sent and the REST response when
+it comes back, and reconciles that against the websocket's open orders and executions each time it's read, until the
+websocket catches up. Orders it's still waiting on carry a FIX-style pending ordStatus, so the order manager can
+leave them alone for a tick.
+"""
+import logging
+import threading
+import time
+
+
+class OrderTracker(object):
+
+    """The state of each of our orders, as the websocket will show it once it has caught up with our requests."""
+
+    # States. An order in a pending state shows that state as its ordStatus until the websocket confirms it.
+    PENDING_NEW = 'PendingNew'          # Created; not on the websocket yet
+    PENDING_AMEND = 'PendingReplace'    # Amended; the websocket still shows it as it was
+    PENDING_CANCEL = 'PendingCancel'    # Cancel sent; the websocket still shows it open
+    LIVE = 'Live'                       # As the websocket shows it
+    FILLED = 'Filled'                   # Closed, though the websocket may still show it open
+    CANCELED = 'Canceled'
+
+    PENDING = (PENDING_NEW, PENDING_AMEND, PENDING_CANCEL)
+    CLOSED = (FILLED, CANCELED)
+
+    # The websocket confirms a request within milliseconds of its REST response. Anything still unconfirmed after
+    # this many seconds is taken to be lost (e.g. an amend that failed without being applied), and the websocket's
+    # view of the order wins.
+    CONFIRM_TIMEOUT = 1
+
+    def __init__(self, clock=time.time):
+        self.logger = logging.getLogger('root')
+        self.clock = clock
+        # Reentrant: the SIGTERM handler can read our orders while the main thread is part way through reconcile().
+        self.lock = threading.RLock()
+        # orderID -> {'order': the order as we intend it, 'state': ..., 'since': when it entered that state,
+        #             'acked': for PENDING_AMEND, whether the REST response told us the clOrdID it was moved to}
+        self.orders = {}
+
+    def open_orders(self):
+        """Our open orders as they'll be once the websocket catches up. Orders being canceled are left out."""
+        with self.lock:
+            return [self.__view(entry) for entry in self.orders.values()
+                    if entry['state'] != OrderTracker.PENDING_CANCEL and entry['state'] not in OrderTracker.CLOSED]
+
+    @staticmethod
+    def is_pending(order):
+        """Whether an order from open_orders() is still waiting for the websocket to confirm a request."""
+        return order.get('ordStatus') in OrderTracker.PENDING
+
+    def reconcile(self, openOrders, executions=()):
+        """Catch up with the websocket: its open orders (ours, on our symbol) and our recent executions there.
+           Orders it confirms go LIVE, as do orders it shows that we didn't know about."""
+        now = self.clock()
+        wsOrders = dict((o['orderID'], o) for o in openOrders)
+        with self.lock:
+            closed = {}
+            if any(entry['state'] != OrderTracker.LIVE for entry in self.orders.values()):
+                closed = dict((e['orderID'], e['ordStatus']) for e in executions
+                              if e.get('ordStatus') in ('Filled', 'Canceled', 'Rejected'))
+            for orderID, entry in list(self.orders.items()):
+                self.__reconcile(orderID, entry, wsOrders.get(orderID), closed.get(orderID), now)
+            for orderID, order in wsOrders.items():
+                if orderID not in self.orders:
+                    self.orders[orderID] = self.__entry(order, OrderTracker.LIVE, now)
+
+    def created(self, orders):
+        """Record the orders a create returned. They're PENDING_NEW until the websocket shows them."""
+        now = self.clock()
+        with self.lock:
+            for order in orders:
+                self.orders[order['orderID']] = self.__entry(order, self.__closed_state(order['ordStatus']) or
+                                                             OrderTracker.PENDING_NEW, now)
+
+    def amending(self, amends):
+        """Mark orders as being amended, before the request is sent."""
+        self.__mark([a['orderID'] for a in amends], OrderTracker.PENDING_AMEND)
+
+    def amended(self, orders):
+        """Record what an amend returned: the orders as they are now, with the clOrdIDs they were moved to."""
+        self.__update(orders, OrderTracker.PENDING_AMEND)
+
+    def canceling(self, orders):
+        """Mark orders as being canceled, before the request is sent."""
+        self.__mark([o['orderID'] for o in orders], OrderTracker.PENDING_CANCEL)
+
+    def canceled(self, orders):
+        """Record what a cancel returned."""
+        self.__update(orders or [], OrderTracker.PENDING_CANCEL)
+
+    def cancel_failed(self, orders):
+        """A cancel failed, so changed nothing: the orders are as the websocket shows them.
+
+        There's no amend_failed. A failed amend may still have been applied to some orders, so they stay
+        PENDING_AMEND until the websocket shows them moved to a new clOrdID (or CONFIRM_TIMEOUT passes)."""
+        now = self.clock()
+        with self.lock:
+            for order in orders:
+                entry = self.orders.get(order['orderID'])
+                if entry is not None and entry['state'] == OrderTracker.PENDING_CANCEL:
+                    entry.update({'state': OrderTracker.LIVE, 'since': now})
+
+    #
+    # Private methods
+    #
+
+    def __reconcile(self, orderID, entry, wsOrder, closedStatus, now):
+        state = entry['state']
+        if state == OrderTracker.LIVE:
+            if wsOrder is None:
+                del self.orders[orderID]  # Filled or canceled
+            else:
+                entry['order'] = wsOrder
+        elif now - entry['since'] > OrderTracker.CONFIRM_TIMEOUT:
+            if state not in OrderTracker.CLOSED:
+                self.logger.warning("Order %s is still %s after %ds; going by the websocket." %
+                                    (orderID, state, OrderTracker.CONFIRM_TIMEOUT))
+            if wsOrder is None:
+                del self.orders[orderID]
+            else:
+                self.orders[orderID] = self.__entry(wsOrder, OrderTracker.LIVE, now)
+        elif state in OrderTracker.CLOSED:
+            # The websocket can still show it open for a moment; ignore that until CONFIRM_TIMEOUT.
+            pass
+        elif closedStatus is not None:
+            entry.update({'state': self.__closed_state(closedStatus), 'since': now})
+        elif state == OrderTracker.PENDING_NEW:
+            if wsOrder is not None:
+                self.orders[orderID] = self.__entry(wsOrder, OrderTracker.LIVE, now)
+        elif wsOrder is None:
+            # We only amend and cancel orders the websocket has shown us. It's dropped this one: it's closed.
+            del self.orders[orderID]
+        elif state == OrderTracker.PENDING_AMEND:
+            if entry['acked']:
+                applied = wsOrder['clOrdID'] == entry['order']['clOrdID']
+            else:
+                # The amend failed, so we don't know the clOrdID it would have moved the order to. Any move will do.
+                applied = wsOrder['clOrdID'] != entry['order']['clOrdID']
+            if applied:
+                self.orders[orderID] = self.__entry(wsOrder, OrderTracker.LIVE, now)
+
+    def __mark(self, orderIDs, state):
+        now = self.clock()
+        with self.lock:
+            for orderID in orderIDs:
+                entry = self.orders.get(orderID)
+                if entry is not None:
+                    entry.update({'state': state, 'since': now, 'acked': False})
+
+    def __update(self, orders, state):
+        now = self.clock()
+        with self.lock:
+            for order in orders:
+                entry = self.orders.get(order['orderID'])
+                if entry is None:
+                    continue
+                entry['order'] = dict(entry['order'], **order)
+                entry.update({'state': self.__closed_state(order.get('ordStatus')) or state, 'since': now,
+                              'acked': True})
+
+    def __closed_state(self, ordStatus):
+        if ordStatus == 'Filled':
+            return OrderTracker.FILLED
+        if ordStatus in ('Canceled', 'Rejected'):
+            return OrderTracker.CANCELED
+        return None
+
+    def __entry(self, order, state, now):
+        return {'order': order, 'state': state, 'since': now, 'acked': False}
+
+    def __view(self, entry):
+        if entry['state'] == OrderTracker.LIVE:
+            return entry['order']
+        return dict(entry['order'], ordStatus=entry['state'])
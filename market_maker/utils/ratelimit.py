@@ -0,0 +1,171 @@
+"""Client-side tracking of the BitMEX REST rate limit.
+
+BitMEX refills each API key's budget continuously (by default 300 requests per 5 minutes) and reports
+what's left in the X-RateLimit-Limit/Remaining/Reset headers of every response. RateLimiter keeps an
+estimate per endpoint class, spends from it as requests go out and re-syncs it from each response, so
+callers can ask what they can afford before sending instead of finding out from a 429.
+"""
+import math
+import threading
+import time
+
+# Endpoint classes
+ORDER = 'order'    # Order placement and amends
+CANCEL = 'cancel'  # Cancels. BitMEX never blocks these, so they're tracked but never throttled.
+QUERY = 'query'    # Everything else
+
+ORDER_PATHS = ['order', 'order/bulk', 'order/all', 'order/closePosition']
+
+
+def endpoint_class(verb, path):
+    """Which budget a request spends from."""
+    if path.strip('/') in ORDER_PATHS:
+        if verb == 'DELETE':
+            return CANCEL
+        if verb in ('POST', 'PUT'):
+            return ORDER
+    return QUERY
+
+
+def bulk_cost(count):
+    """Requests consumed by a bulk placement/amend of `count` orders: 0.1 per order, rounded up."""
+    return int(math.ceil(count / 10.0))
+
+
+def request_cost(verb, path, postdict=None):
+    """Requests consumed by one call."""
+    if path.strip('/') == 'order/bulk' and verb in ('POST', 'PUT') and postdict:
+        return max(1, bulk_cost(len(postdict.get('orders', []))))
+    return 1
+
+
+class TokenBucket(object):
+
+    """Estimate of one rate limit budget, refilling continuously at `limit` requests per `window` seconds."""
+
+    def __init__(self, limit, window, clock=time.time):
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.tokens = float(limit)
+        self.updated = clock()
+
+    def remaining(self):
+        now = self.clock()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.window)
+        self.updated = now
+        return self.tokens
+
+    def spend(self, cost):
+        self.tokens = max(0.0, self.remaining() - cost)
+
+    def sync(self, limit, remaining):
+        """Adopt the server's view of the budget."""
+        self.limit = limit
+        self.tokens = float(remaining)
+        self.updated = self.clock()
+
+    def wait_time(self, cost):
+        """Seconds until `cost` requests are affordable."""
+        missing = cost - self.remaining()
+        return max(0.0, missing * self.window / self.limit)
+
+
+class RateLimiter(object):
+
+    """Tracks the REST budget per endpoint class. Safe to use from any thread.
+
+    `clock` returns the current time in seconds; the backtest passes its simulated clock.
+    """
+
+    def __init__(self, limit=300, window=300, clock=time.time):
+        self.lock = threading.Lock()
+        self.buckets = dict((cls, TokenBucket(limit, window, clock)) for cls in (ORDER, CANCEL, QUERY))
+
+    def spend(self, verb, path, postdict=None):
+        """Record a request as sent."""
+        self.charge(endpoint_class(verb, path), request_cost(verb, path, postdict))
+
+    def charge(self, cls, cost):
+        with self.lock:
+            self.buckets[cls].spend(cost)
+
+    def update(self, verb, path, headers):
+        """Re-sync the request's budget from a response's X-RateLimit-* headers, if it has them."""
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        bucket = self.buckets[endpoint_class(verb, path)]
+        with self.lock:
+            bucket.sync(int(headers.get('X-RateLimit-Limit', bucket.limit)), int(headers['X-RateLimit-Remaining']))
+
+    def wait_time(self, verb, path, postdict=None):
+        """Seconds to wait before sending this request to stay within budget. Always 0 for cancels."""
+        cls = endpoint_class(verb, path)
+        if cls == CANCEL:
+            return 0
+        with self.lock:
+            return self.buckets[cls].wait_time(request_cost(verb, path, postdict))
+
+    def budget(self, cls=ORDER, reserve=0):
+        """Whole requests of class `cls` we can send right now, keeping `reserve` in hand."""
+        with self.lock:
+            return max(0, int(math.floor(self.buckets[cls].remaining() - reserve)))
+
+
+class SharedTokenBucket(TokenBucket):
+
+    """A TokenBucket whose state lives in a shared array (limit, tokens, updated at `offset`), so every process
+    holding the array spends from the same budget. Callers serialize access with the RateLimiter's lock."""
+
+    FIELDS = 3
+
+    def __init__(self, state, offset, window, clock=time.time):
+        self.state = state
+        self.offset = offset
+        self.window = window
+        self.clock = clock
+
+    @property
+    def limit(self):
+        return self.state[self.offset]
+
+    @limit.setter
+    def limit(self, value):
+        self.state[self.offset] = value
+
+    @property
+    def tokens(self):
+        return self.state[self.offset + 1]
+
+    @tokens.setter
+    def tokens(self, value):
+        self.state[self.offset + 1] = value
+
+    @property
+    def updated(self):
+        return self.state[self.offset + 2]
+
+    @updated.setter
+    def updated(self, value):
+        self.state[self.offset + 2] = value
+
+
+class SharedRateLimiter(RateLimiter):
+
+    """A RateLimiter for several processes using one API key (BitMEX limits per key, not per connection).
+
+    Create the shared state once with `allocate()` in the parent and pass it to each child process.
+    """
+
+    CLASSES = (ORDER, CANCEL, QUERY)
+
+    def __init__(self, state, lock, window=300, clock=time.time):
+        self.lock = lock
+        self.buckets = dict((cls, SharedTokenBucket(state, i * SharedTokenBucket.FIELDS, window, clock))
+                            for i, cls in enumerate(SharedRateLimiter.CLASSES))
+
+    @staticmethod
+    def allocate(context, limit=300, clock=time.time):
+        """Shared state for a full budget: (state, lock), from a multiprocessing context."""
+        state = context.RawArray('d', [limit, limit, clock()] * len(SharedRateLimiter.CLASSES))
+        return state, context.Lock()
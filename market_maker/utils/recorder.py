@@ -0,0 +1,154 @@
+"""Record and replay what the bot sends and receives.
+
+A recording is an append-only, gzip-compressed file of JSON lines. Each line is one of:
+
+    [time, "ws", "<raw websocket frame>"]
+    [time, "rest", {"verb": ..., "path": ..., "query": ..., "postdict": ...,
+                    "status": ..., "headers": {...}, "body": "..."}]
+
+where `time` is the wall-clock receive time. A failed request has "error" (e.g. "Timeout") in place
+of status/headers/body. Every run appends a new gzip member, so one file can hold several sessions.
+"""
+import gzip
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from urllib.parse import urlparse
+
+
+# Response headers worth keeping. Bodies are kept whole.
+RECORDED_HEADERS = ['X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset', 'Retry-After']
+
+
+class Recorder(object):
+
+    """Appends websocket frames and REST exchanges to a recording. Safe to call from any thread."""
+
+    # Flush to disk at most this often (seconds). A crash loses at most this much of the recording.
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('root')
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'ab')
+        self.lastFlush = time.time()
+        self.logger.info("Recording websocket and REST traffic to %s" % path)
+
+    def record_frame(self, frame):
+        """Record a raw websocket frame, as received."""
+        self._write([time.time(), 'ws', frame])
+
+    def record_rest(self, verb, url, query, postdict, response=None, error=None):
+        """Record a REST request and its response, or the exception it failed with."""
+        exchange = {'verb': verb, 'path': urlparse(url).path, 'query': query, 'postdict': postdict}
+        if response is not None:
+            exchange['status'] = response.status_code
+            exchange['headers'] = {h: response.headers[h] for h in RECORDED_HEADERS if h in response.headers}
+            exchange['body'] = response.text
+        else:
+            exchange['error'] = type(error).__name__
+        self._write([time.time(), 'rest', exchange])
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf8')
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line)
+            if record[0] - self.lastFlush >= Recorder.FLUSH_INTERVAL:
+                self.file.flush()
+                self.lastFlush = record[0]
+
+
+def read_recording(path, kinds=('ws', 'rest')):
+    """Yield (time, kind, payload) for each record in a recording, in the order written."""
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                record = json.loads(line.decode('utf8'))
+                if record[1] in kinds:
+                    yield tuple(record)
+        except (EOFError, zlib.error):
+            # The recording process died mid-write; everything before this point is intact.
+            return
+
+
+class ReplaySession(requests.Session):
+
+    """A requests.Session that answers from a recording instead of the network.
+
+    Responses are returned in recorded order per (verb, path); recorded failures are raised again as
+    the same requests exception. Pass it to BitMEX as `session` to replay REST traffic.
+    """
+
+    def __init__(self, path):
+        super(ReplaySession, self).__init__()
+        self.exchanges = defaultdict(deque)
+        for _, _, exchange in read_recording(path, kinds=('rest',)):
+            self.exchanges[(exchange['verb'], exchange['path'])].append(exchange)
+
+    def send(self, request, **kwargs):
+        key = (request.method, urlparse(request.url).path)
+        if not self.exchanges[key]:
+            raise LookupError("No recorded response left for %s %s" % key)
+        exchange = self.exchanges[key].popleft()
+
+        if 'error' in exchange:
+            raise getattr(requests.exceptions, exchange['error'], requests.exceptions.RequestException)(
+                request=request)
+
+        response = requests.Response()
+        response.status_code = exchange['status']
+        response.headers = CaseInsensitiveDict(exchange['headers'])
+        response._content = exchange['body'].encode('utf8')
+        response.encoding = 'utf8'
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class Replayer(object):
+
+    """Feeds the websocket frames of a recording into a BitMEXWebsocket.
+
+    `speed` scales the recorded timing: 1 replays in real time, 10 ten times faster, and None
+    as fast as possible.
+    """
+
+    def __init__(self, path, speed=None):
+        self.path = path
+        self.speed = speed
+
+    def frames(self):
+        """Yield (time, frame) for each recorded websocket frame."""
+        for t, _, frame in read_recording(self.path, kinds=('ws',)):
+            yield t, frame
+
+    def replay(self, ws):
+        """Replay every frame into `ws` (see BitMEXWebsocket.open_replay). Returns the frame count."""
+        count = 0
+        start = recordedStart = None
+        for t, frame in self.frames():
+            if self.speed:
+                if start is None:
+                    start, recordedStart = time.time(), t
+                wait = (t - recordedStart) / self.speed - (time.time() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            ws.replay(frame)
+            count += 1
+        return count
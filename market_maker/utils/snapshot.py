@@ -0,0 +1,47 @@
+"""A consistent view of the market and our account for one tick of the order manager.
+
+The websocket keeps updating its tables while the order manager works, so reading them piecemeal can mix
+data from before and after an update (e.g. a fill that shows up in our orders but not yet in our position).
+OrderManager captures a TickSnapshot once per tick and makes all of that tick's decisions from it.
+"""
+from collections import namedtuple
+
+
+class TickSnapshot(namedtuple('TickSnapshot', ['instrument', 'ticker', 'position', 'margin', 'orders'])):
+
+    """Instrument, ticker, position, margin and our open orders, copied when the tick starts.
+
+    The rows are copies, so later updates don't leak in. Treat them as read-only.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def capture(cls, exchange):
+        """Copy the current state from an ExchangeInterface (or anything with the same getters)."""
+        return cls(instrument=dict(exchange.get_instrument()),
+                   ticker=dict(exchange.get_ticker()),
+                   position=dict(exchange.get_position()),
+                   margin=dict(exchange.get_margin()),
+                   orders=tuple(dict(o) for o in exchange.get_orders()))
+
+    @property
+    def tickLog(self):
+        return self.instrument['tickLog']
+
+    @property
+    def tickSize(self):
+        return self.instrument['tickSize']
+
+    @property
+    def delta(self):
+        """Our position in contracts."""
+        return self.position['currentQty']
+
+    def highest_buy(self):
+        buys = [o for o in self.orders if o['side'] == 'Buy']
+        return max(buys, key=lambda o: o['price']) if buys else {'price': -2**32}
+
+    def lowest_sell(self):
+        sells = [o for o in self.orders if o['side'] == 'Sell']
+        return min(sells, key=lambda o: o['price']) if sells else {'price': 2**32}
@@ -0,0 +1,315 @@
+"""Share decoded market data between the processes on one host.
+
+A feed handler (`python -m market_maker.ws.feed XBTUSD ETHUSD`) holds the only market data subscription
+(instrument, quote and trade, plus the L2 book if ORDERBOOK_TABLE is set). It decodes each message once and
+publishes the result into a memory-mapped file. Bots with MARKET_DATA_FEED set to that file read their market
+data from it instead of subscribing themselves. Their own websocket then only carries their orders, executions,
+position and margin.
+
+The file holds a header, one slot per symbol and a ring of recent trades. There's a single writer and nothing
+takes a lock: each slot is a seqlock. The writer makes the slot's sequence number odd while it writes and even
+again when it's done, and a reader retries if it was odd or changed while it read. Each trade record carries its
+own sequence number the same way. Readers unpack fields straight out of the mapping, without copying it first.
+"""
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import mmap
+import struct
+from time import sleep
+
+from market_maker.settings import settings
+from market_maker.utils import fastjson, log
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+logger = logging.getLogger('root')
+
+MAGIC = b'BMXFEED1'
+
+# Instrument fields that change with nearly every message. They're stored as doubles (None as NaN), and the
+# timestamp as text, so publishing a price change doesn't rewrite the rest of the instrument.
+HOT_FIELDS = ('bidPrice', 'askPrice', 'lastPrice', 'midPrice', 'markPrice', 'fairPrice', 'indicativeSettlePrice')
+HOT_KEYS = frozenset(HOT_FIELDS + ('timestamp',))
+
+# magic, slot count, bytes of instrument JSON per slot, trade ring capacity, trades written so far
+HEADER = struct.Struct('<8sIII4xQ')
+# sequence, symbol, version and length of the instrument JSON
+SLOT = struct.Struct('<Q16sQI4x')
+# HOT_FIELDS, the L2 book's best bid, bid size, best ask and ask size, then the timestamp
+HOT = struct.Struct('<' + 'd' * (len(HOT_FIELDS) + 4) + '24s')
+# sequence, slot, side (1 buy, -1 sell), size, price, timestamp
+TRADE = struct.Struct('<QIiqd24s')
+
+COLD_SIZE = 8192
+TRADE_CAPACITY = 1024
+
+TRADE_COUNT_OFFSET = HEADER.size - 8
+NAN = float('nan')
+
+
+def _pack(value):
+    return NAN if value is None else float(value)
+
+
+class FeedLayout(object):
+
+    """Offsets into a feed file."""
+
+    def __init__(self, slots, coldSize, tradeCapacity):
+        self.slots = slots
+        self.coldSize = coldSize
+        self.tradeCapacity = tradeCapacity
+        self.slotSize = SLOT.size + HOT.size + coldSize
+        self.tradesOffset = HEADER.size + slots * self.slotSize
+        self.size = self.tradesOffset + tradeCapacity * TRADE.size
+
+    def slot(self, index):
+        return HEADER.size + index * self.slotSize
+
+    def trade(self, seq):
+        return self.tradesOffset + ((seq - 1) % self.tradeCapacity) * TRADE.size
+
+
+class FeedWriter(object):
+
+    """Creates a feed file for `symbols` and publishes into it. Only one process may write to a feed."""
+
+    def __init__(self, path, symbols, coldSize=COLD_SIZE, tradeCapacity=TRADE_CAPACITY):
+        self.layout = FeedLayout(len(symbols), coldSize, tradeCapacity)
+        with open(path, 'w+b') as f:
+            f.truncate(self.layout.size)
+            self.mm = mmap.mmap(f.fileno(), self.layout.size)
+        HEADER.pack_into(self.mm, 0, MAGIC, len(symbols), coldSize, tradeCapacity, 0)
+        self.index = {}
+        self.cold = {}  # symbol -> the instrument fields we last published as JSON
+        self.coldVersion = {}
+        for i, symbol in enumerate(symbols):
+            self.index[symbol] = i
+            self.coldVersion[symbol] = 0
+            SLOT.pack_into(self.mm, self.layout.slot(i), 0, symbol.encode('ascii'), 0, 0)
+        self.tradeCount = 0
+
+    def publish(self, instrument, bestBid=None, bestAsk=None, hotOnly=False):
+        """Publish a symbol's instrument and, if we keep an L2 book, its best (price, size) on each side.
+           Pass hotOnly=True if only HOT_KEYS or the book can have changed since the last publish."""
+        symbol = instrument['symbol']
+        offset = self.layout.slot(self.index[symbol])
+        blob = None
+        cold = None if hotOnly and symbol in self.cold else \
+            dict((k, v) for k, v in instrument.items() if k not in HOT_KEYS)
+        if cold is not None and cold != self.cold.get(symbol):
+            blob = json.dumps(cold, separators=(',', ':')).encode('utf-8')
+            if len(blob) > self.layout.coldSize:
+                raise ValueError("%s's instrument is %d bytes, more than the feed's %d." %
+                                 (symbol, len(blob), self.layout.coldSize))
+            self.cold[symbol] = cold
+        hot = [_pack(instrument.get(field)) for field in HOT_FIELDS]
+        hot += list(bestBid) if bestBid else [NAN, NAN]
+        hot += list(bestAsk) if bestAsk else [NAN, NAN]
+        hot.append((instrument.get('timestamp') or '').encode('ascii'))
+
+        seq = struct.unpack_from('<Q', self.mm, offset)[0]
+        struct.pack_into('<Q', self.mm, offset, seq + 1)
+        if blob is not None:
+            self.coldVersion[symbol] += 1
+            coldOffset = offset + SLOT.size + HOT.size
+            self.mm[coldOffset:coldOffset + len(blob)] = blob
+            struct.pack_into('<QI', self.mm, offset + 24, self.coldVersion[symbol], len(blob))
+        HOT.pack_into(self.mm, offset + SLOT.size, *hot)
+        struct.pack_into('<Q', self.mm, offset, seq + 2)
+
+    def add_trades(self, trades):
+        """Append trade rows, as the websocket's trade table sends them."""
+        for trade in trades:
+            if trade['symbol'] not in self.index:
+                continue
+            seq = self.tradeCount + 1
+            offset = self.layout.trade(seq)
+            struct.pack_into('<Q', self.mm, offset, 0)
+            TRADE.pack_into(self.mm, offset, 0, self.index[trade['symbol']], 1 if trade['side'] == 'Buy' else -1,
+                            trade['size'], trade['price'], trade['timestamp'].encode('ascii'))
+            struct.pack_into('<Q', self.mm, offset, seq)
+            self.tradeCount = seq
+        struct.pack_into('<Q', self.mm, TRADE_COUNT_OFFSET, self.tradeCount)
+
+    def close(self):
+        self.mm.close()
+
+
+class FeedReader(object):
+
+    """Reads a feed file written by a FeedWriter in another process. Safe to use from any thread."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, slots, coldSize, tradeCapacity, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s isn't a market data feed." % path)
+        self.layout = FeedLayout(slots, coldSize, tradeCapacity)
+        self.offsets = {}
+        self.symbols = []
+        for i in range(slots):
+            symbol = SLOT.unpack_from(self.mm, self.layout.slot(i))[1].rstrip(b'\0').decode('ascii')
+            self.offsets[symbol] = self.layout.slot(i)
+            self.symbols.append(symbol)
+        self.cold = {}  # symbol -> (version, decoded instrument JSON)
+        self.cache = {}  # symbol -> (sequence, instrument, top of book) as of the last read
+
+    def sequence(self, symbol):
+        """Changes whenever `symbol` is published."""
+        return struct.unpack_from('<Q', self.mm, self.offsets[symbol])[0]
+
+    def has(self, symbol):
+        return symbol in self.offsets and self.sequence(symbol) > 0
+
+    def read(self, symbol):
+        """`symbol`'s (sequence, instrument, top of book) as last published. Unchanged until the next publish,
+           so repeated reads in one tick cost one lookup; don't modify them."""
+        cached = self.cache.get(symbol)
+        if cached is not None and cached[0] == self.sequence(symbol):
+            return cached
+
+        offset = self.offsets[symbol]
+        while True:
+            seq, _, version, length = SLOT.unpack_from(self.mm, offset)
+            if seq & 1:
+                continue
+            hot = HOT.unpack_from(self.mm, offset + SLOT.size)
+            cold = self.cold.get(symbol)
+            if cold is None or cold[0] != version:
+                coldOffset = offset + SLOT.size + HOT.size
+                blob = self.mm[coldOffset:coldOffset + length]
+            if struct.unpack_from('<Q', self.mm, offset)[0] == seq:
+                break
+        if seq == 0:
+            raise Exception("Unable to find instrument or index with symbol: " + symbol)
+        if cold is None or cold[0] != version:
+            cold = self.cold[symbol] = (version, fastjson.loads(blob.decode('utf-8')))
+
+        instrument = dict(cold[1])
+        for field, value in zip(HOT_FIELDS, hot):
+            instrument[field] = None if value != value else value  # NaN
+        instrument['timestamp'] = hot[-1].rstrip(b'\0').decode('ascii') or None
+        book = hot[len(HOT_FIELDS):-1]
+        top = (None if book[0] != book[0] else (book[0], book[1]),
+               None if book[2] != book[2] else (book[2], book[3]))
+        cached = self.cache[symbol] = (seq, instrument, top)
+        return cached
+
+    def instrument(self, symbol):
+        return self.read(symbol)[1]
+
+    def top(self, symbol):
+        """The L2 book's best bid and best ask as (price, size), each None if the feed doesn't have one."""
+        return self.read(symbol)[2]
+
+    def trade_count(self):
+        return struct.unpack_from('<Q', self.mm, TRADE_COUNT_OFFSET)[0]
+
+    def trades_since(self, seq):
+        """Trades published after trade number `seq`, oldest first, and the number of the last one. Trades that
+           have already been overwritten in the ring are skipped."""
+        last = self.trade_count()
+        trades = []
+        for n in range(max(seq, last - self.layout.tradeCapacity) + 1, last + 1):
+            offset = self.layout.trade(n)
+            record = TRADE.unpack_from(self.mm, offset)
+            if record[0] != n or struct.unpack_from('<Q', self.mm, offset)[0] != n:
+                continue
+            trades.append({'symbol': self.symbols[record[1]], 'side': 'Buy' if record[2] > 0 else 'Sell',
+                           'size': record[3], 'price': record[4], 'timestamp': record[5].decode('ascii')})
+        return trades, last
+
+    def recent_trades(self, count=None):
+        """The most recent `count` trades (default: all the ring holds), oldest first."""
+        last = self.trade_count()
+        count = min(count or self.layout.tradeCapacity, self.layout.tradeCapacity)
+        return self.trades_since(max(0, last - count))[0]
+
+    def close(self):
+        self.mm.close()
+
+
+class FeedHandler(object):
+
+    """Publishes market data for `symbols` to a feed file as it arrives on our websocket."""
+
+    # Instrument updates carrying only these keys leave everything but HOT_KEYS as it was.
+    HOT_ROW_KEYS = HOT_KEYS | {'symbol'}
+
+    def __init__(self, path, symbols):
+        self.symbols = symbols
+        self.writer = FeedWriter(path, symbols)
+        self.ws = BitMEXWebsocket(listener=self.on_message)
+        self.tops = {}  # symbol -> the top of the book we last published
+
+    def connect(self, endpoint, orderBook=None):
+        self.ws.connect(endpoint, self.symbols, shouldAuth=False, orderBook=orderBook)
+        for symbol in self.symbols:
+            self.publish(symbol)
+
+    def on_message(self, table, action, rows):
+        """Called on the websocket thread after each market data message has been applied."""
+        if table == 'trade':
+            if action in ('partial', 'insert'):
+                self.writer.add_trades(rows)
+        elif table == 'instrument':
+            for symbol in set(row.get('symbol') for row in rows) & set(self.symbols):
+                self.publish(symbol, all(FeedHandler.HOT_ROW_KEYS.issuperset(row)
+                                         for row in rows if row.get('symbol') == symbol))
+        elif table == self.ws.orderBook:
+            # Readers only see the top of the book, so only publish when it moves.
+            for symbol in set(row['symbol'] for row in rows) & set(self.symbols):
+                book = self.ws.books[symbol]
+                if (book.best_bid(), book.best_ask()) != self.tops.get(symbol):
+                    self.publish(symbol, True)
+
+    def publish(self, symbol, hotOnly=False):
+        if 'instrument' not in self.ws.data:
+            return  # Still connecting; we publish everything once we've got it.
+        try:
+            instrument = self.ws.get_instrument(symbol)
+        except Exception:
+            return
+        book = self.ws.books.get(symbol)
+        if book is None:
+            self.writer.publish(instrument, hotOnly=hotOnly)
+        else:
+            self.tops[symbol] = (book.best_bid(), book.best_ask())
+            self.writer.publish(instrument, self.tops[symbol][0], self.tops[symbol][1], hotOnly)
+
+    def run_loop(self):
+        while not self.ws.exited:
+            sleep(1)
+        logger.error("Market data websocket closed. Stopping the feed.")
+
+    def exit(self):
+        self.ws.exit()
+        self.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish BitMEX market data for bots on this host to read')
+    parser.add_argument('symbols', nargs='*', help='Symbols to publish (default: settings.CONTRACTS)')
+    parser.add_argument('--file', default=settings.MARKET_DATA_FEED,
+                        help='Feed file to write (default: settings.MARKET_DATA_FEED)')
+    args = parser.parse_args()
+    if not args.file:
+        parser.error("Set MARKET_DATA_FEED in settings.py or pass --file.")
+    log.setup_custom_logger('root')
+
+    handler = FeedHandler(args.file, args.symbols or list(settings.CONTRACTS))
+    handler.connect(settings.BASE_URL, settings.ORDERBOOK_TABLE)
+    logger.info("Publishing %s to %s." % (", ".join(handler.symbols), args.file))
+    try:
+        handler.run_loop()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handler.exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""How far behind the exchange our market data is.
+
+Every row BitMEX pushes carries the exchange's `timestamp`. FeedLatency keeps, per table and symbol, the newest
+one and when we received it, so the order manager can tell whether the best bid/ask it's quoting off is 5ms or 5s
+old, and stop quoting if the feed falls behind.
+
+Comparing the exchange's timestamps with our receive times needs the offset between the exchange's clock and
+ours. ClockOffset estimates it the way NTP does, from REST requests that change orders: the exchange stamps the
+change somewhere between our sending the request and getting the response, so the midpoint is off by at most half
+the round trip. The websocket bounds it too: nothing arrives before the exchange sent it.
+"""
+from __future__ import absolute_import
+import calendar
+import threading
+import time
+
+from market_maker.utils import metrics
+
+
+def parse_timestamp(timestamp):
+    """A BitMEX timestamp ('2026-10-18T21:34:49.304Z') as seconds since the epoch."""
+    minute = _minutes.get(timestamp[:16])
+    if minute is None:
+        if len(_minutes) > 10000:
+            _minutes.clear()
+        minute = calendar.timegm(time.strptime(timestamp[:16], '%Y-%m-%dT%H:%M'))
+        _minutes[timestamp[:16]] = minute
+    return minute + float(timestamp[17:-1])
+
+
+# 'YYYY-MM-DDTHH:MM' -> seconds since the epoch. Parsing only the seconds of each timestamp keeps this off the
+# websocket thread's profile.
+_minutes = {}
+
+
+class ClockOffset(object):
+
+    """The exchange's clock minus ours, from REST round trips."""
+
+    # Our clock and the exchange's drift apart by up to this much a second (100ppm, a poor quartz clock), so an
+    # old sample's error grows with its age. A newer sample replaces it once it's more precise.
+    MAX_DRIFT = 1e-4
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.best = None  # (offset, error, taken at)
+        self.estimate = None  # The best sample's offset, for the websocket thread to read without a lock
+
+    def sample(self, sent, received, serverTime):
+        """Take a sample: the exchange's time `serverTime` for an event between our `sent` and `received`."""
+        error = (received - sent) / 2
+        with self.lock:
+            if self.best is None or error <= self.__error(self.best, received):
+                self.best = (serverTime - (sent + received) / 2, error, received)
+                self.estimate = self.best[0]
+
+    def sample_response(self, sent, received, result):
+        """Take a sample from a REST response that stamps the exchange's time: an order change (its `timestamp`)
+           or cancelAllAfter (its `now`). Orders returned with an error weren't changed, so aren't stamped now."""
+        rows = result if isinstance(result, list) else [result]
+        stamps = [row.get('now') or row.get('timestamp') for row in rows
+                  if isinstance(row, dict) and not row.get('error')]
+        stamps = [stamp for stamp in stamps if stamp]
+        if stamps:
+            self.sample(sent, received, parse_timestamp(max(stamps)))
+
+    def offset(self):
+        """The offset (seconds to add to our clock to get the exchange's) and its error, or (None, None) with no
+           samples yet."""
+        best = self.best
+        if best is None:
+            return None, None
+        return best[0], self.__error(best, self.clock())
+
+    def __error(self, sample, now):
+        return sample[1] + abs(now - sample[2]) * ClockOffset.MAX_DRIFT
+
+
+# The process's estimate. There's one clock here and one at the exchange, however many connections we have.
+exchangeClock = ClockOffset()
+
+
+class FeedLatency(object):
+
+    """Exchange timestamps against our receive times, per table and symbol, for one websocket's tables.
+
+    The websocket thread calls observe() with each message. It only keeps the newest timestamp (as text) on each
+    table for each symbol and when that arrived: parsing them, and the feed_latency_seconds metric, wait until
+    status() asks, once a tick. Each message that's newest then is sampled once."""
+
+    # Tables whose timestamps say how old our view of the market is. Our orders, executions, position and margin
+    # are tracked too, but only change when we or the market do, so aren't a measure of the feed.
+    MARKET_TABLES = ('instrument', 'quote', 'trade', 'orderBookL2', 'orderBookL2_25')
+
+    # The websocket's bound on the offset is its fastest message over a window of this many seconds, so it
+    # follows the clocks as they drift.
+    WINDOW = 60
+
+    def __init__(self, clockOffset=None, clock=time.time):
+        """`clockOffset` defaults to the process's exchangeClock."""
+        self.exchangeClock = clockOffset or exchangeClock
+        self.clock = clock
+        self.latest = {}  # (table, symbol) -> (the newest exchange timestamp, our time() when we received it)
+        self.quotes = {}  # symbol -> the exchange timestamp its best bid/ask last changed at
+        self.sampled = {}  # (table, symbol) -> the `latest` entry last recorded in feed_latency_seconds
+        self.histograms = {}  # table -> its feed_latency_seconds histogram
+        # The lowest our time() minus the exchange's timestamp has been, in this window and the last.
+        self.minDelay = self.lastMinDelay = float('inf')
+        self.windowStart = clock()
+
+    def observe(self, table, rows):
+        """Record the rows of a message on `table`. This runs for every message, so does as little as it can."""
+        received = self.clock()
+        latest = self.latest
+        for row in rows:
+            timestamp = row.get('timestamp')
+            if timestamp is not None:
+                key = (table, row.get('symbol'))
+                if key not in latest or timestamp >= latest[key][0]:
+                    latest[key] = (timestamp, received)
+                if table == 'instrument' and ('bidPrice' in row or 'askPrice' in row):
+                    self.quotes[key[1]] = timestamp
+
+    def quote_changed(self, table, symbols):
+        """The best bid/ask of `symbols` changed, in a message on `table` that's just been observe()d."""
+        for symbol in symbols:
+            latest = self.latest.get((table, symbol))
+            if latest is not None:
+                self.quotes[symbol] = latest[0]
+
+    def offset(self):
+        """The exchange's clock minus ours, or None until we have a timestamp to go by. ClockOffset's estimate,
+           kept above the websocket's bound. Without REST samples (e.g. on a dry run) it's just the bound, which
+           makes our fastest message instant: latencies are then how much slower than that messages were."""
+        offset = self.exchangeClock.estimate
+        bound = -min(self.minDelay, self.lastMinDelay)
+        if bound == float('-inf'):
+            return offset
+        return bound if offset is None else max(offset, bound)
+
+    def status(self, symbol, feed=None):
+        """How far behind the exchange our view of `symbol` is, as a dict of seconds (None where unknown):
+
+        - age: since the exchange's timestamp on the newest market data we have
+        - lag: how long that newest message took to reach us
+        - quoteAge: since the exchange's timestamp on the last change to the best bid/ask
+        - quoteTime: our time() the best bid/ask last changed at, by the exchange's timestamp
+        - offset: the exchange's clock minus ours
+        - tables: {table: {'age': ..., 'lag': ...}} for every table with timestamps for `symbol`
+
+        Pass the ws.feed.FeedReader market data comes from, if any. It only has the instrument's timestamp, so
+        gives ages but no lags."""
+        now = self.clock()
+        received = {}  # table -> (exchange time, our time when we received it, its `latest` entry)
+        for (table, rowSymbol), latest in list(self.latest.items()):
+            if rowSymbol == symbol:
+                received[table] = (parse_timestamp(latest[0]), latest[1], latest)
+                self.__bound(latest[1] - received[table][0], latest[1])
+        feedTime = None
+        if feed is not None and feed.has(symbol):
+            timestamp = feed.instrument(symbol).get('timestamp')
+            if timestamp:
+                # We don't know when it arrived, only that it was by now.
+                feedTime = parse_timestamp(timestamp)
+                self.__bound(now - feedTime, now)
+        offset = self.offset()
+        if offset is None:
+            return {'age': None, 'lag': None, 'quoteAge': None, 'quoteTime': None, 'offset': None, 'tables': {}}
+
+        tables = {}
+        for table, (exchangeTime, receivedAt, latest) in received.items():
+            tables[table] = {'age': now - (exchangeTime - offset), 'lag': receivedAt - (exchangeTime - offset)}
+            self.__sample(table, symbol, latest, tables[table]['lag'])
+        market = [tables[table] for table in FeedLatency.MARKET_TABLES if table in tables]
+        newest = min(market, key=lambda t: t['age']) if market else None
+        quoteTime = parse_timestamp(self.quotes[symbol]) - offset if symbol in self.quotes else None
+        if feedTime is not None:
+            quoteTime = feedTime - offset
+            newest = {'age': now - quoteTime, 'lag': None}
+        return {'age': newest['age'] if newest else None,
+                'lag': newest['lag'] if newest else None,
+                'quoteAge': now - quoteTime if quoteTime is not None else None,
+                'quoteTime': quoteTime,
+                'offset': offset,
+                'tables': tables}
+
+    #
+    # Private methods
+    #
+
+    def __bound(self, delay, now):
+        if now - self.windowStart > FeedLatency.WINDOW:
+            self.lastMinDelay, self.minDelay, self.windowStart = self.minDelay, float('inf'), now
+        if delay < self.minDelay:
+            self.minDelay = delay
+
+    def __sample(self, table, symbol, latest, lag):
+        """Record the `lag` of `latest`, the newest message on `table`, unless it's already been recorded."""
+        if self.sampled.get((table, symbol)) is latest:
+            return
+        self.sampled[(table, symbol)] = latest
+        histogram = self.histograms.get(table)
+        if histogram is None:
+            histogram = self.histograms[table] = metrics.histogram('feed_latency_seconds', table=table)
+        histogram.record(max(0.0, lag))
@@ -0,0 +1,205 @@
+"""Carry several accounts' realtime data over one websocket, using BitMEX's /realtimemd endpoint.
+
+/realtimemd multiplexes streams over one socket. Every frame is a JSON array, [type, stream ID, topic] or
+[type, stream ID, topic, payload], where type is 1 to open a stream, 2 to close one and 0 for a message on it
+(see test/websocket-multiplexing-test.py). A stream authenticates as one API key, by opening it with a
+'userAuth:<key>:<expires>:<signature>' topic, and then carries the same messages as a /realtime socket.
+
+A Multiplexer holds the socket and its one thread. Each BitMEXWebsocket created with `mux=` becomes a stream
+on it: connecting opens and subscribes the stream, and the Multiplexer hands it its own messages, so it keeps
+its own tables (orders, position, margin...) exactly as it would on its own socket. When the socket drops, the
+Multiplexer reconnects and reopens every stream, and each resynchronizes from fresh partials.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import ssl
+import sys
+import threading
+import uuid
+from time import perf_counter, sleep
+
+import websocket
+
+from market_maker.auth.APIKeyAuth import generate_expires, generate_signature
+from market_maker.settings import settings
+from market_maker.utils import fastjson
+from market_maker.utils.log import setup_custom_logger
+from market_maker.ws.ws_thread import BitMEXWebsocket
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from urllib.parse import urlparse, urlunparse
+
+
+class Multiplexer(object):
+
+    """One /realtimemd socket, shared by the BitMEXWebsocket streams opened on it."""
+
+    ENDPOINT = "/realtimemd?transport=websocket&b64=1"
+
+    # Frame types
+    MESSAGE = 0
+    OPEN = 1
+    CLOSE = 2
+
+    def __init__(self, endpoint):
+        self.logger = logging.getLogger('root')
+        urlParts = list(urlparse(endpoint))
+        urlParts[0] = urlParts[0].replace('http', 'ws')
+        urlParts[2] = Multiplexer.ENDPOINT
+        self.wsURL = urlunparse(urlParts)
+        self.ws = None
+        self.lock = threading.Lock()  # Guards streams, and sending
+        self.streams = {}  # stream ID -> [BitMEXWebsocket, its subscriptions, topic it's open on (None until then)]
+        self.connected = threading.Event()
+        self.opened = False
+        self.exited = False
+        self._error = None
+
+    def connect(self):
+        '''Connect the socket in a thread. Streams can be opened once this returns.'''
+        self.logger.info("Connecting to %s" % self.wsURL)
+        self.ws = self.__create_app()
+        setup_custom_logger('websocket', log_level=settings.LOG_LEVEL)
+        self.wst = threading.Thread(target=self.__run, name='multiplexer')
+        self.wst.daemon = True
+        self.wst.start()
+
+        if not self.connected.wait(5) or self._error:
+            self.logger.error("Couldn't connect to WS! Exiting.")
+            self.exit()
+            sys.exit(1)
+
+    def open(self, stream, subscriptions):
+        '''Open a stream for `stream` (a BitMEXWebsocket), authenticated with its API key if it should auth, and
+           subscribe it to `subscriptions`. Its messages are passed to its `process`.'''
+        streamID = uuid.uuid4().hex
+        with self.lock:
+            self.streams[streamID] = [stream, subscriptions, None]
+            if self.connected.is_set():
+                self.__open(streamID)
+
+    def close(self, stream):
+        '''Close `stream`'s stream, if it's open.'''
+        with self.lock:
+            for streamID, (s, subscriptions, topic) in list(self.streams.items()):
+                if s is stream:
+                    del self.streams[streamID]
+                    if topic and self.connected.is_set():
+                        self.__send([Multiplexer.CLOSE, streamID, topic])
+
+    def exit(self):
+        self.exited = True
+        if self.ws:
+            self.ws.close()
+
+    #
+    # Private methods
+    #
+
+    def __create_app(self):
+        return websocket.WebSocketApp(self.wsURL,
+                                      on_message=self.__on_message,
+                                      on_close=self.__on_close,
+                                      on_open=self.__on_open,
+                                      on_error=self.__on_error)
+
+    def __run(self):
+        '''Run the socket, reconnecting in place whenever it drops, with the same backoff as BitMEXWebsocket.
+           Runs on the websocket thread.'''
+        ssl_defaults = ssl.get_default_verify_paths()
+        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
+        attempt = 0
+        while True:
+            self.ws.run_forever(sslopt=sslopt_ca_certs)
+            self.connected.clear()
+            if self.exited:
+                return
+
+            streams = self.__streams()
+            # Only count consecutive failures; a connection that got every stream fully synced starts over.
+            attempt = 1 if all(s.is_synced() for s in streams) else attempt + 1
+            if attempt > BitMEXWebsocket.MAX_RECONNECT_ATTEMPTS:
+                self.exited = True
+                for stream in streams:
+                    stream.error("Unable to reconnect to the websocket after %d attempts." % (attempt - 1))
+                return
+
+            # Every stream's data is about to be replaced by fresh partials. Until then it's stale.
+            for stream in streams:
+                stream.begin_resync()
+            delay = 0 if attempt == 1 else min(BitMEXWebsocket.RECONNECT_BACKOFF_MIN * 2 ** (attempt - 2),
+                                                BitMEXWebsocket.RECONNECT_BACKOFF_MAX)
+            self.logger.warning("Websocket dropped. Reconnecting in %.1fs (attempt %d)." % (delay, attempt))
+            sleep(delay)
+            if self.exited:
+                return
+            self.ws = self.__create_app()
+
+    def __streams(self):
+        with self.lock:
+            return [entry[0] for entry in self.streams.values()]
+
+    def __open(self, streamID):
+        '''Open a stream and subscribe it. Called with self.lock held.'''
+        stream, subscriptions = self.streams[streamID][:2]
+        if stream.shouldAuth:
+            # Auth is the same as /realtime's: a signature of the /realtime endpoint and the expiry.
+            expires = generate_expires()
+            signature = generate_signature(stream.apiSecret, 'GET', '/realtime', expires, '')
+            topic = "userAuth:%s:%d:%s" % (stream.apiKey, expires, signature)
+        else:
+            topic = "public:" + streamID
+        self.streams[streamID][2] = topic
+        self.__send([Multiplexer.OPEN, streamID, topic])
+        if stream.shouldAuth:
+            self.__send([Multiplexer.MESSAGE, streamID, topic,
+                         {"op": "authKeyExpires", "args": [stream.apiKey, expires, signature]}])
+        self.__send([Multiplexer.MESSAGE, streamID, topic, {"op": "subscribe", "args": subscriptions}])
+
+    def __send(self, frame):
+        try:
+            self.ws.send(json.dumps(frame))
+        except websocket.WebSocketException as e:
+            # The socket's going down; __run reopens everything once it's back.
+            self.logger.warning("Unable to send on the websocket: %s" % e)
+
+    def __on_message(self, message):
+        '''Hand each stream its own messages. Everything else is the socket's (e.g. its welcome).'''
+        received = perf_counter()
+        self.logger.debug(message)
+        frame = fastjson.loads(message)
+        if not isinstance(frame, list) or len(frame) < 3:
+            return
+        entry = self.streams.get(frame[1])
+        if entry is None:
+            return  # A stream we've closed
+        stream = entry[0]
+        if frame[0] == Multiplexer.MESSAGE and len(frame) > 3:
+            if stream.recorder:
+                stream.recorder.record_frame(json.dumps(frame[3]))
+            stream.process(frame[3], received)
+        elif frame[0] == Multiplexer.CLOSE:
+            stream.error("The realtime stream was closed by the exchange.")
+
+    def __on_open(self):
+        self.logger.debug("Websocket Opened.")
+        self.opened = True
+        with self.lock:
+            self.connected.set()
+            for streamID in self.streams:
+                self.__open(streamID)
+
+    def __on_close(self):
+        self.logger.info('Websocket Closed')
+
+    def __on_error(self, error):
+        if self.exited:
+            return
+        if not self.opened:
+            # Never got a connection at all; fail fast rather than retrying a bad URL.
+            self._error = error
+            self.logger.error(error)
+            self.exit()
+        else:
+            self.logger.warning("Websocket error: %s" % error)
@@ -0,0 +1,107 @@
+from itertools import islice
+
+from sortedcontainers import SortedList
+
+
+class OrderBookL2(object):
+
+    """An incremental L2 order book for one symbol, fed by the `orderBookL2` / `orderBookL2_25` tables.
+
+    Each side keeps its price levels in an ascending SortedList alongside two dicts, one from the
+    BitMEX level id to its price and one from price to resting size. `update` (by far the most
+    common action) only changes a size, so it's a single dict write. `insert` and `delete` add or
+    remove a price level in O(log n).
+
+    Queries walk the live lists and never copy the book. The websocket thread applies updates
+    while other threads read, so a depth walk taken mid-update may mix two consecutive states.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.clear()
+
+    def clear(self):
+        # Prices ascending on both sides. Best bid is the last bid, best ask the first ask.
+        self._prices = {'Buy': SortedList(), 'Sell': SortedList()}
+        self._sizes = {'Buy': {}, 'Sell': {}}
+        self._ids = {}
+
+    #
+    # Table actions
+    #
+    def partial(self, rows):
+        self.clear()
+        self.insert(rows)
+
+    def insert(self, rows):
+        for row in rows:
+            if row['id'] in self._ids:
+                self.delete([row])  # Re-insert of a known level; drop the old one first
+            side = row['side']
+            price = row['price']
+            sizes = self._sizes[side]
+            if price not in sizes:
+                self._prices[side].add(price)
+            sizes[price] = row['size']
+            self._ids[row['id']] = (side, price)
+
+    def update(self, rows):
+        for row in rows:
+            level = self._ids.get(row['id'])
+            if level is None:
+                continue  # Could happen before the partial arrives
+            side, price = level
+            if 'size' in row:
+                self._sizes[side][price] = row['size']
+
+    def delete(self, rows):
+        for row in rows:
+            level = self._ids.pop(row['id'], None)
+            if level is None:
+                continue
+            side, price = level
+            self._prices[side].discard(price)
+            self._sizes[side].pop(price, None)
+
+    #
+    # Queries
+    #
+    def best_bid(self):
+        """Return (price, size) of the best bid, or None if there are no bids."""
+        return next(self.depth('Buy', 1), None)
+
+    def best_ask(self):
+        """Return (price, size) of the best ask, or None if there are no asks."""
+        return next(self.depth('Sell', 1), None)
+
+    def mid(self):
+        bid = self.best_bid()
+        ask = self.best_ask()
+        if bid is None or ask is None:
+            return None
+        return (bid[0] + ask[0]) / 2
+
+    def depth(self, side, levels=None):
+        """Yield (price, size) for up to `levels` levels of `side`, best price first."""
+        prices = self._prices[side]
+        sizes = self._sizes[side]
+        for price in islice(reversed(prices) if side == 'Buy' else iter(prices), levels):
+            size = sizes.get(price)
+            if size is not None:
+                yield price, size
+
+    def cumulative_size(self, side, levels=None, price=None):
+        """Total size resting on `side` across the best `levels` levels and/or at prices at least
+           as good as `price`."""
+        total = 0
+        for level_price, size in self.depth(side, levels):
+            if price is not None and (level_price < price if side == 'Buy' else level_price > price):
+                break
+            total += size
+        return total
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return 'OrderBookL2(%s, bid=%r, ask=%r)' % (self.symbol, self.best_bid(), self.best_ask())
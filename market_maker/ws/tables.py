@@ -0,0 +1,129 @@
+class KeyedTable(object):
+
+    """A realtime table indexed by the primary keys BitMEX sends with the table's partial.
+
+    Rows live in a dict keyed on the tuple of key values, so finding, updating and deleting a row
+    is O(1) instead of a scan over the whole table. The table still behaves like the list it
+    replaces (iteration, len() and indexing), so callers reading `ws.data[table]` keep working.
+    """
+
+    def __init__(self, keys, rows=()):
+        self.keys = list(keys)
+        self._rows = {}
+        self.extend(rows)
+
+    def key_of(self, row):
+        """Return the primary key tuple for a row."""
+        return tuple(row[k] for k in self.keys)
+
+    def extend(self, rows):
+        """Insert (or replace) rows."""
+        for row in rows:
+            self._rows[self.key_of(row)] = row
+
+    def get(self, match):
+        """Find the row sharing `match`'s keys, or None if it isn't in the table."""
+        try:
+            return self._rows.get(self.key_of(match))
+        except KeyError:
+            # `match` doesn't carry all of our keys.
+            return None
+
+    def lookup(self, *values):
+        """Find a row by its key values, given in the order of `keys`."""
+        return self._rows.get(values)
+
+    def remove(self, row):
+        """Remove a row. Raises KeyError if it isn't in the table."""
+        del self._rows[self.key_of(row)]
+
+    def pop(self, match):
+        """Remove and return the row sharing `match`'s keys, or None if it isn't in the table."""
+        try:
+            return self._rows.pop(self.key_of(match), None)
+        except KeyError:
+            return None
+
+    def clear(self):
+        self._rows.clear()
+
+    # The websocket thread mutates the table while other threads read it. Iterating a dict that
+    # changes size raises, so readers always get a snapshot. Building the snapshot runs entirely
+    # in C under the GIL, so it can't observe a half-applied update.
+    def __iter__(self):
+        return iter(list(self._rows.values()))
+
+    def __getitem__(self, index):
+        # The first or last row (e.g. `data['margin'][0]`) without copying the table.
+        if index == 0 or index == -1:
+            values = self._rows.values()
+            try:
+                return next(iter(values) if index == 0 else reversed(values))
+            except StopIteration:
+                raise IndexError('table index out of range')
+            except (RuntimeError, TypeError):
+                pass  # Changed under us, or no reversed() for dict views before Python 3.8: take the snapshot.
+        return list(self._rows.values())[index]
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return 'KeyedTable(keys=%r, rows=%d)' % (self.keys, len(self._rows))
+
+
+class RingTable(object):
+
+    """A fixed-capacity table for append-only streams (trades, quotes, executions).
+
+    Rows go into a preallocated ring, so an insert is O(1) and never copies the table; once full,
+    each insert overwrites the oldest row. Reads return a snapshot of the most recent rows, oldest
+    first, as the list it replaces did.
+    """
+
+    def __init__(self, capacity, rows=()):
+        self.capacity = capacity
+        # One spare slot: the slot being written is never part of a full-capacity snapshot.
+        self._rows = [None] * (capacity + 1)
+        self._count = 0  # Rows ever appended; the next row goes in slot _count % len(_rows)
+        self.extend(rows)
+
+    def append(self, row):
+        self._rows[self._count % len(self._rows)] = row
+        self._count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def last(self, n=None):
+        """Return a snapshot of the most recent `n` rows (default: all of them), oldest first."""
+        size = len(self._rows)
+        end = self._count
+        count = min(end, self.capacity, self.capacity if n is None else n)
+        if count <= 0:
+            return []
+        start = (end - count) % size
+        if start + count <= size:
+            snapshot = self._rows[start:start + count]
+        else:
+            snapshot = self._rows[start:] + self._rows[:start + count - size]
+        # Rows appended by the websocket thread while we copied may have overwritten the oldest rows
+        # we took, so drop as many as were appended.
+        return snapshot[self._count - end:]
+
+    def clear(self):
+        self._rows = [None] * (self.capacity + 1)
+        self._count = 0
+
+    def __iter__(self):
+        return iter(self.last())
+
+    def __getitem__(self, index):
+        return self.last()[index]
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def __repr__(self):
+        return 'RingTable(capacity=%d, rows=%d)' % (self.capacity, len(self))
@@ -3,14 +3,17 @@ import websocket
 import threading
 import traceback
 import ssl
-from time import sleep
+from time import perf_counter, sleep, time
 import json
-import decimal
 import logging
 from market_maker.settings import settings
 from market_maker.auth.APIKeyAuth import generate_expires, generate_signature
+from market_maker.utils import fastjson, log, metrics
 from market_maker.utils.log import setup_custom_logger
-from market_maker.utils.math import toNearest
+from market_maker.utils.math import tickLog, toNearest
+from market_maker.ws.latency import FeedLatency
+from market_maker.ws.orderbook import OrderBookL2
+from market_maker.ws.tables import KeyedTable, RingTable
 from future.utils import iteritems
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
@@ -28,57 +31,122 @@ with hooks():  # Python 2/3 compat
 class BitMEXWebsocket():
 
     # Don't grow a table larger than this amount. Helps cap memory usage.
+    # Tables listed in settings.TABLE_CAPACITY use a ring buffer of that size instead.
     MAX_TABLE_LEN = 200
 
-    def __init__(self):
+    # L2 tables we can maintain a local order book from. See `connect(orderBook=...)`.
+    ORDERBOOK_TABLES = ['orderBookL2', 'orderBookL2_25']
+
+    # Instrument fields that move our quotes. Updates touching only other fields (funding, open interest...)
+    # don't wake up `wait_for_update`.
+    QUOTE_FIELDS = {'bidPrice', 'askPrice', 'lastPrice', 'midPrice', 'markPrice', 'state'}
+
+    # When the socket drops we reconnect in place. The first attempt is immediate, then we back off
+    # exponentially between these bounds (in seconds), giving up after MAX_RECONNECT_ATTEMPTS in a row.
+    RECONNECT_BACKOFF_MIN = 0.5
+    RECONNECT_BACKOFF_MAX = 30
+    MAX_RECONNECT_ATTEMPTS = 10
+
+    # With a market data feed, how often (in seconds) wait_for_update checks it for changes.
+    FEED_POLL_INTERVAL = 0.005
+
+    def __init__(self, recorder=None, feed=None, listener=None, mux=None, apiKey=None, apiSecret=None):
+        '''Pass a utils.recorder.Recorder to record every frame received.
+           Pass a ws.feed.FeedReader as `feed` to read market data from a feed handler instead of subscribing to
+           it here; this socket then only carries our orders, executions, position and margin.
+           `listener(table, action, rows)` is called on the websocket thread after each table message is applied.
+           Pass a ws.multiplex.Multiplexer as `mux` to run as a stream on its shared socket instead of opening our
+           own. `apiKey` and `apiSecret` default to settings.'''
         self.logger = logging.getLogger('root')
+        self.recorder = recorder
+        self.feed = feed
+        self.listener = listener
+        self.mux = mux
+        self.apiKey = apiKey or settings.API_KEY
+        self.apiSecret = apiSecret or settings.API_SECRET
+        self.ws = None
+        self.messageHistograms = {}  # (table, action) -> its ws_message_seconds histogram
+        self.latency = FeedLatency()
         self.__reset()
 
     def __del__(self):
         self.exit()
 
-    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True):
-        '''Connect to the websocket and initialize data stores.'''
+    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, orderBook=None):
+        '''Connect to the websocket and initialize data stores.
+           Pass a list as `symbol` to follow several symbols on this one socket; `self.symbol` is the first.
+           Pass one of ORDERBOOK_TABLES as `orderBook` to also maintain a local L2 book.'''
 
         self.logger.debug("Connecting WebSocket.")
-        self.symbol = symbol
+        self.symbols = list(symbol) if isinstance(symbol, (list, tuple)) else [symbol]
+        self.symbol = self.symbols[0]
         self.shouldAuth = shouldAuth
+        if orderBook is not None and orderBook not in BitMEXWebsocket.ORDERBOOK_TABLES:
+            raise ValueError("orderBook must be one of %s" % BitMEXWebsocket.ORDERBOOK_TABLES)
+        self.orderBook = orderBook
 
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade"]]
-        subscriptions += ["instrument"]  # We want all of them
+        subscriptions = []
+        if self.feed is None:
+            subscriptions += [sub + ':' + s for s in self.symbols for sub in ["quote", "trade"]]
+            subscriptions += ["instrument"]  # We want all of them
+            if self.orderBook:
+                subscriptions += [self.orderBook + ':' + s for s in self.symbols]
         if self.shouldAuth:
-            subscriptions += [sub + ':' + symbol for sub in ["order", "execution"]]
+            subscriptions += [sub + ':' + s for s in self.symbols for sub in ["order", "execution"]]
             subscriptions += ["margin", "position"]
 
-        # Get WS URL and connect.
-        urlParts = list(urlparse(endpoint))
-        urlParts[0] = urlParts[0].replace('http', 'ws')
-        urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
-        wsURL = urlunparse(urlParts)
-        self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL)
+        # Subscriptions we expect a partial for, on connect and after every reconnect.
+        self.tables = subscriptions
+
+        if self.mux is not None:
+            self.logger.info("Opening a stream on the shared websocket for %s." % ", ".join(self.symbols))
+            self.mux.open(self, subscriptions)
+        else:
+            # Get WS URL and connect.
+            urlParts = list(urlparse(endpoint))
+            urlParts[0] = urlParts[0].replace('http', 'ws')
+            urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
+            self.wsURL = urlunparse(urlParts)
+            self.logger.info("Connecting to %s" % self.wsURL)
+            self.__connect()
         self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
 
         # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
+        for s in self.symbols:
+            if self.feed is not None:
+                self.__wait_for_feed(s)
+            else:
+                self.__wait_for_symbol(s)
         if self.shouldAuth:
             self.__wait_for_account()
         self.logger.info('Got all market data. Starting.')
 
+    def open_replay(self, symbol, shouldAuth=True, orderBook=None):
+        '''Set up to process frames from `replay` (e.g. a utils.recorder.Replayer) instead of a socket.'''
+        self.symbols = list(symbol) if isinstance(symbol, (list, tuple)) else [symbol]
+        self.symbol = self.symbols[0]
+        self.shouldAuth = shouldAuth
+        self.orderBook = orderBook
+        self.tables = []
+
+    def replay(self, message):
+        '''Process a raw frame as if it had arrived on the socket.'''
+        self.__on_message(message)
+
     #
     # Data methods
     #
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
+        if self.feed is not None:
+            instrument = self.feed.instrument(symbol)
+        else:
+            instrument = self.data['instrument'].get({'symbol': symbol})
+        if instrument is None:
             raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
         # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+        instrument['tickLog'] = tickLog(instrument['tickSize'])
         return instrument
 
     def get_ticker(self, symbol):
@@ -94,6 +162,11 @@ class BitMEXWebsocket():
         else:
             bid = instrument['bidPrice'] or instrument['lastPrice']
             ask = instrument['askPrice'] or instrument['lastPrice']
+            # Prefer the L2 book's top of book if we keep one; it can be fresher than the instrument.
+            bestBid, bestAsk = self.feed.top(symbol) if self.feed is not None else self.__top_of_book(symbol)
+            if bestBid and bestAsk:
+                bid = bestBid[0]
+                ask = bestAsk[0]
             ticker = {
                 "last": instrument['lastPrice'],
                 "buy": bid,
@@ -104,17 +177,36 @@ class BitMEXWebsocket():
         # The instrument has a tickSize. Use it to round values.
         return {k: toNearest(float(v or 0), instrument['tickSize']) for k, v in iteritems(ticker)}
 
+    def feed_latency(self, symbol):
+        '''How far behind the exchange our market data for `symbol` is. See FeedLatency.status.'''
+        return self.latency.status(symbol, self.feed)
+
     def funds(self):
         return self.data['margin'][0]
 
     def market_depth(self, symbol):
-        raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
-        # return self.data['orderBook25'][0]
+        '''Return the OrderBookL2 for a symbol. Requires connecting with `orderBook`.'''
+        if symbol not in self.books:
+            raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
+        return self.books[symbol]
 
-    def open_orders(self, clOrdIDPrefix):
+    def open_orders(self, clOrdIDPrefix, symbol=None):
+        '''Our open orders, optionally only those for `symbol`.'''
         orders = self.data['order']
         # Filter to only open orders (leavesQty > 0) and those that we actually placed
-        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0]
+        return [o for o in orders if str(o['clOrdID']).startswith(clOrdIDPrefix) and o['leavesQty'] > 0 and
+                (symbol is None or o['symbol'] == symbol)]
+
+    def executions(self, symbol=None):
+        '''Our most recent executions (fills, amends, cancels...), oldest first, optionally only those for `symbol`.'''
+        executions = self.data.get('execution', [])
+        return [e for e in executions if symbol is None or e['symbol'] == symbol]
+
+    def get_order(self, orderID):
+        '''Return the order with this orderID, or None if we don't have it.'''
+        if 'order' not in self.data:
+            return None
+        return self.__find('order', {'orderID': orderID})
 
     def position(self, symbol):
         positions = self.data['position']
@@ -124,8 +216,42 @@ class BitMEXWebsocket():
             return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
         return pos[0]
 
-    def recent_trades(self):
-        return self.data['trade']
+    def recent_trades(self, count=None):
+        '''Return the most recent `count` trades (default: all we keep), oldest first.'''
+        if self.feed is not None:
+            return self.feed.recent_trades(count)
+        trades = self.data['trade']
+        if isinstance(trades, RingTable):
+            return trades.last(count)
+        return trades[-count:] if count else list(trades)
+
+    def is_synced(self):
+        '''False while we're reconnecting and rebuilding tables from fresh partials.'''
+        return self.synced.is_set()
+
+    def wait_for_sync(self, timeout=None):
+        '''Block until tables are rebuilt after a reconnect. Returns False on timeout.'''
+        return self.synced.wait(timeout)
+
+    def wait_for_update(self, timeout=None, symbol=None):
+        '''Block until the quote, book, orders or position for `symbol` (default: our first symbol) change,
+           or until timeout. Returns (tables, since): the set of tables that changed, and the time() of the
+           first change, or (set(), None) on timeout. Each symbol's changes are tracked separately, so one
+           thread per symbol can wait on the same socket.'''
+        symbol = symbol or self.symbol
+        with self.updated:
+            if self.feed is None:
+                if symbol not in self.updates:
+                    self.updated.wait_for(lambda: symbol in self.updates, timeout)
+            else:
+                # Market data changes arrive through the feed, which can't wake us; check it every so often.
+                deadline = None if timeout is None else time() + timeout
+                while not self.__check_feed(symbol):
+                    remaining = BitMEXWebsocket.FEED_POLL_INTERVAL if deadline is None else deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.updated.wait(min(remaining, BitMEXWebsocket.FEED_POLL_INTERVAL))
+            return self.updates.pop(symbol, (set(), None))
 
     #
     # Lifecycle methods
@@ -137,28 +263,28 @@ class BitMEXWebsocket():
 
     def exit(self):
         self.exited = True
-        self.ws.close()
+        if self.mux is not None:
+            self.mux.close(self)
+        elif self.ws:
+            self.ws.close()
+
+    def begin_resync(self):
+        '''Mark everything we hold stale until fresh partials replace it, as after the socket drops.'''
+        self.synced.clear()
+        self.resyncStart = time()
+        self.staleTables = set(self.tables)
 
     #
     # Private methods
     #
 
-    def __connect(self, wsURL):
+    def __connect(self):
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        ssl_defaults = ssl.get_default_verify_paths()
-        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth()
-                                         )
-
+        self.ws = self.__create_app()
         setup_custom_logger('websocket', log_level=settings.LOG_LEVEL)
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever(sslopt=sslopt_ca_certs))
+        self.wst = threading.Thread(target=self.__run)
         self.wst.daemon = True
         self.wst.start()
         self.logger.info("Started thread")
@@ -174,6 +300,53 @@ class BitMEXWebsocket():
             self.exit()
             sys.exit(1)
 
+    def __create_app(self):
+        '''Create the socket. Auth headers are generated fresh on every (re)connect.'''
+        return websocket.WebSocketApp(self.wsURL,
+                                      on_message=self.__on_message,
+                                      on_close=self.__on_close,
+                                      on_open=self.__on_open,
+                                      on_error=self.__on_error,
+                                      header=self.__get_auth()
+                                      )
+
+    def __run(self):
+        '''Run the socket, reconnecting in place whenever it drops.
+           Runs on the websocket thread.'''
+        ssl_defaults = ssl.get_default_verify_paths()
+        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
+        attempt = 0
+        while True:
+            self.ws.run_forever(sslopt=sslopt_ca_certs)
+            if self.exited:
+                return
+
+            # Only count consecutive failures; a connection that got fully synced starts over.
+            attempt = 1 if self.is_synced() else attempt + 1
+            if attempt > BitMEXWebsocket.MAX_RECONNECT_ATTEMPTS:
+                self.error("Unable to reconnect to the websocket after %d attempts." % (attempt - 1))
+                return
+
+            # Everything we hold is about to be replaced by fresh partials. Until then it's stale.
+            self.begin_resync()
+            delay = 0 if attempt == 1 else min(BitMEXWebsocket.RECONNECT_BACKOFF_MIN * 2 ** (attempt - 2),
+                                                BitMEXWebsocket.RECONNECT_BACKOFF_MAX)
+            self.logger.warning("Websocket dropped. Reconnecting in %.1fs (attempt %d)." % (delay, attempt))
+            sleep(delay)
+            if self.exited:
+                return
+            self.ws = self.__create_app()
+
+    def __end_resync(self, subscription):
+        '''Called for each partial. Once every subscription has been re-imaged, we're synced again.'''
+        if subscription not in self.staleTables:
+            return
+        self.staleTables.discard(subscription)
+        if not self.staleTables:
+            self.logger.info("Websocket resynchronized in %.0fms." % ((time() - self.resyncStart) * 1000))
+            self.synced.set()
+            self.__signal_update(subscription.split(':')[0], self.symbols)
+
     def __get_auth(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
 
@@ -186,8 +359,8 @@ class BitMEXWebsocket():
         nonce = generate_expires()
         return [
             "api-expires: " + str(nonce),
-            "api-signature: " + generate_signature(settings.API_SECRET, 'GET', '/realtime', nonce, ''),
-            "api-key:" + settings.API_KEY
+            "api-signature: " + generate_signature(self.apiSecret, 'GET', '/realtime', nonce, ''),
+            "api-key:" + self.apiKey
         ]
 
     def __wait_for_account(self):
@@ -200,6 +373,31 @@ class BitMEXWebsocket():
         '''On subscribe, this data will come down. Wait for it.'''
         while not {'instrument', 'trade', 'quote'} <= set(self.data):
             sleep(0.1)
+        while self.orderBook and symbol not in self.books:
+            sleep(0.1)
+
+    def __wait_for_feed(self, symbol):
+        '''Wait for the feed handler to publish this symbol.'''
+        while not self.feed.has(symbol):
+            sleep(0.1)
+        self.feedSeqs[symbol] = self.feed.sequence(symbol)
+
+    def __check_feed(self, symbol):
+        '''Record a feed update to `symbol` as a change. Returns True if `symbol` has changes waiting.
+           Called with self.updated held.'''
+        seq = self.feed.sequence(symbol)
+        if seq != self.feedSeqs.get(symbol):
+            self.feedSeqs[symbol] = seq
+            tables, since = self.updates.setdefault(symbol, (set(), time()))
+            tables.add('feed')
+        return symbol in self.updates
+
+    def __top_of_book(self, symbol):
+        '''The best bid and best ask as (price, size) in our L2 book, each None if we don't have one.'''
+        book = self.books.get(symbol)
+        if book is None:
+            return None, None
+        return book.best_bid(), book.best_ask()
 
     def __send_command(self, command, args):
         '''Send a raw command.'''
@@ -207,15 +405,24 @@ class BitMEXWebsocket():
 
     def __on_message(self, message):
         '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
-
+        # This runs for every frame, so debug output must cost nothing when it's off: log the raw frame
+        # rather than re-serializing the decoded one, and pass logging args lazily throughout.
+        received = perf_counter()
+        self.logger.debug(message)
+        if self.recorder:
+            self.recorder.record_frame(message)
+        self.process(fastjson.loads(message), received)
+
+    def process(self, message, received=None):
+        '''Apply a decoded message: one of our socket's, or one a Multiplexer demultiplexed for our stream.
+           `received` is the perf_counter() it arrived at, so its time in the metrics includes decoding it.'''
+        received = received or perf_counter()
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
         try:
             if 'subscribe' in message:
                 if message['success']:
-                    self.logger.debug("Subscribed to %s." % message['subscribe'])
+                    self.logger.debug("Subscribed to %s.", message['subscribe'])
                 else:
                     self.error("Unable to subscribe to %s. Error: \"%s\" Please check and restart." %
                                (message['request']['args'][0], message['error']))
@@ -224,10 +431,18 @@ class BitMEXWebsocket():
                     self.error(message['error'])
                 if message['status'] == 401:
                     self.error("API Key incorrect, please check and restart.")
+            elif action and table in BitMEXWebsocket.ORDERBOOK_TABLES:
+                self.latency.observe(table, message['data'])
+                changed = self.__on_orderbook(message)
+                if changed:
+                    self.latency.quote_changed(table, changed)
+                    self.__signal_update(table, changed)
+                if action == 'partial':
+                    self.__end_resync(self.__subscription(message))
             elif action:
 
                 if table not in self.data:
-                    self.data[table] = []
+                    self.data[table] = self.__new_table(table, [], [])
 
                 if table not in self.keys:
                     self.keys[table] = []
@@ -238,25 +453,38 @@ class BitMEXWebsocket():
                 # 'update'  - update row
                 # 'delete'  - delete row
                 if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
+                    self.logger.debug("%s: partial", table)
                     # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
+                    # an item. We index the table on them so updates and deletes are O(1).
                     self.keys[table] = message['keys']
+                    # After a reconnect, the partial replaces everything we had (for its symbol, if it has one).
+                    subscription = self.__subscription(message)
+                    if subscription not in self.staleTables:
+                        rows = list(self.data[table])
+                    elif ':' in subscription:
+                        rows = [r for r in self.data[table] if r.get('symbol') != message['filter']['symbol']]
+                    else:
+                        rows = []
+                    self.data[table] = self.__new_table(table, self.keys[table], rows + message['data'])
+                    self.__end_resync(subscription)
                 elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                    self.logger.debug('%s: inserting %s', table, message['data'])
+                    if isinstance(self.data[table], list):
+                        self.data[table] += message['data']
+
+                        # Limit the max length of the table to avoid excessive memory usage.
+                        if len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
+                            self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                    else:
+                        # Ring tables cap themselves. Keyed tables (orders, instruments, positions...) are
+                        # bounded by their keys, and we'd lose valuable state if we trimmed them.
+                        self.data[table].extend(message['data'])
 
                 elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
+                    self.logger.debug('%s: updating %s', table, message['data'])
                     # Locate the item in the collection and update it.
                     for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
+                        item = self.__find(table, updateData)
                         if not item:
                             continue  # No item found to update. Could happen before push
 
@@ -267,9 +495,10 @@ class BitMEXWebsocket():
                                 contExecuted = updateData['cumQty'] - item['cumQty']
                                 if contExecuted > 0:
                                     instrument = self.get_instrument(item['symbol'])
-                                    self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
-                                             (item['side'], contExecuted, item['symbol'],
-                                              instrument['tickLog'], item['price']))
+                                    self.logger.info("Execution: %s %d Contracts of %s at %.*f",
+                                                     item['side'], contExecuted, item['symbol'],
+                                                     instrument['tickLog'], item['price'])
+                                    log.order_event('fill', dict(item, **updateData), lastQty=contExecuted)
 
                         # Update this item.
                         item.update(updateData)
@@ -279,30 +508,129 @@ class BitMEXWebsocket():
                             self.data[table].remove(item)
 
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    self.logger.debug('%s: deleting %s', table, message['data'])
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
+                        if isinstance(self.data[table], KeyedTable):
+                            self.data[table].pop(deleteData)
+                        else:
+                            item = findItemByKeys(self.keys[table], self.data[table], deleteData)
+                            self.data[table].remove(item)
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                self.latency.observe(table, message['data'])
+                changed = self.__changed_symbols(table, message['data'])
+                if changed:
+                    self.__signal_update(table, changed)
+
+            if action and self.listener:
+                self.listener(table, action, message['data'])
         except:
             self.logger.error(traceback.format_exc())
 
+        if action:
+            histogram = self.messageHistograms.get((table, action))
+            if histogram is None:
+                histogram = metrics.histogram('ws_message_seconds', table=table, action=action)
+                self.messageHistograms[(table, action)] = histogram
+            histogram.record(perf_counter() - received)
+
+    def __new_table(self, table, keys, rows):
+        '''Create the store for a table: a ring buffer for append-only streams, a KeyedTable if the
+           partial gave us keys, otherwise a plain list.'''
+        if table in settings.TABLE_CAPACITY:
+            return RingTable(settings.TABLE_CAPACITY[table], rows)
+        if keys:
+            return KeyedTable(keys, rows)
+        return list(rows)
+
+    def __on_orderbook(self, message):
+        '''Apply an L2 table message to the per-symbol order books.'''
+        action = message['action']
+        if action not in ['partial', 'insert', 'update', 'delete']:
+            raise Exception("Unknown action: %s" % action)
+
+        rowsBySymbol = {}
+        for row in message['data']:
+            rowsBySymbol.setdefault(row['symbol'], []).append(row)
+        # An empty partial still means the book exists (and is empty).
+        if action == 'partial' and 'symbol' in message.get('filter', {}):
+            rowsBySymbol.setdefault(message['filter']['symbol'], [])
+
+        topChanged = set()
+        for symbol, rows in iteritems(rowsBySymbol):
+            if symbol not in self.books:
+                self.books[symbol] = OrderBookL2(symbol)
+            book = self.books[symbol]
+            top = (book.best_bid(), book.best_ask())
+            getattr(book, action)(rows)
+            if symbol in self.symbols and top != (book.best_bid(), book.best_ask()):
+                topChanged.add(symbol)
+        return topChanged
+
+    def __subscription(self, message):
+        '''The subscription a partial answers, e.g. 'quote:XBTUSD' or 'margin'.'''
+        symbol = message.get('filter', {}).get('symbol')
+        return message['table'] + ':' + symbol if symbol else message['table']
+
+    def __changed_symbols(self, table, rows):
+        '''Which of our symbols a message on `table` can change how we quote.'''
+        if table in ['quote', 'order', 'execution']:
+            # These are only subscribed for our symbols. An update row may carry only the keys.
+            changed = set(row['symbol'] for row in rows if 'symbol' in row)
+            return changed if len(changed) == len(rows) else set(self.symbols)
+        if table == 'position':
+            return set(row.get('symbol') for row in rows) & set(self.symbols)
+        if table == 'instrument':
+            return set(row.get('symbol') for row in rows if not BitMEXWebsocket.QUOTE_FIELDS.isdisjoint(row)) & \
+                set(self.symbols)
+        return set()
+
+    def __signal_update(self, table, symbols):
+        '''Wake up anyone blocked in wait_for_update for these symbols.'''
+        with self.updated:
+            for symbol in symbols:
+                tables, since = self.updates.setdefault(symbol, (set(), time()))
+                tables.add(table)
+            self.updated.notify_all()
+
+    def __find(self, table, matchData):
+        '''Find the row in `table` matching the keys in matchData.'''
+        if isinstance(self.data[table], KeyedTable):
+            return self.data[table].get(matchData)
+        return findItemByKeys(self.keys[table], self.data[table], matchData)
+
     def __on_open(self):
         self.logger.debug("Websocket Opened.")
+        self.opened = True
 
     def __on_close(self):
+        # Unless we're exiting, __run reconnects.
         self.logger.info('Websocket Closed')
-        self.exit()
 
-    def __on_error(self, ws, error):
-        if not self.exited:
+    def __on_error(self, error):
+        if self.exited:
+            return
+        if not self.opened:
+            # Never got a connection at all; fail fast rather than retrying a bad URL or key.
             self.error(error)
+        else:
+            self.logger.warning("Websocket error: %s" % error)
 
     def __reset(self):
         self.data = {}
         self.keys = {}
+        self.books = {}
+        self.symbols = []
+        self.updated = threading.Condition()
+        self.updates = {}  # symbol -> (tables changed, time of the first change) since its last wait_for_update
+        self.feedSeqs = {}  # symbol -> the feed sequence number we last saw
+        self.synced = threading.Event()
+        self.synced.set()
+        self.staleTables = set()
+        self.resyncStart = None
+        self.opened = False
         self.exited = False
         self._error = None
 
@@ -19,10 +19,12 @@ setup(name='bitmex-market-maker',
       install_requires=[
           'requests',
           'websocket-client',
-          'future'
+          'future',
+          'sortedcontainers'
       ],
       packages=['market_maker', 'market_maker.auth', 'market_maker.utils', 'market_maker.ws'],
       entry_points={
-          'console_scripts': ['marketmaker = market_maker:run']
+          'console_scripts': ['marketmaker = market_maker:run',
+                              'marketmaker-supervisor = market_maker:supervise']
       }
       )
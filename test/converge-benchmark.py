@@ -0,0 +1,138 @@
+import random
+import sys
+import time
+
+from market_maker.backtest import Backtest, SimulatedExchange, market_events
+from market_maker.market_maker import OrderManager
+from market_maker.settings import settings
+
+###
+# converge-benchmark.py
+#
+# Compares how many order changes and REST requests converge_orders sends per tick when existing orders
+# are matched to desired ones by OrderManager.diff_orders (keep every order that already fits, then pair
+# the rest by price) versus in the order get_orders() returns them (how converge_orders used to work).
+#
+# Usage: python test/converge-benchmark.py [recording.gz]
+#
+# Run from a marketmaker project (it needs settings.py). Both strategies are backtested against the same
+# market data: a RECORD_FILE recording, or a synthetic XBTUSD random walk with sweeps that fill a few
+# levels at a time. Also reports two fixed scenarios: a middle level filling, and unchanged orders
+# listed in a different order.
+###
+
+SYMBOL = "XBTUSD"
+HOURS = 4
+
+
+class LegacyOrderManager(OrderManager):
+
+    """Pairs existing orders with desired ones in get_orders() order, as converge_orders used to."""
+
+    def diff_orders(self, existing_orders, buy_orders, sell_orders):
+        to_amend, to_create, to_cancel = [], [], []
+        buys_matched = sells_matched = 0
+        for order in existing_orders:
+            try:
+                if order['side'] == 'Buy':
+                    desired_order = buy_orders[buys_matched]
+                    buys_matched += 1
+                else:
+                    desired_order = sell_orders[sells_matched]
+                    sells_matched += 1
+                if self.needs_amend(order, desired_order):
+                    to_amend.append({'orderID': order['orderID'], 'orderQty': order['cumQty'] + desired_order['orderQty'],
+                                     'price': desired_order['price'], 'side': order['side']})
+            except IndexError:
+                to_cancel.append(order)
+        to_create += buy_orders[buys_matched:] + sell_orders[sells_matched:]
+        return to_amend, to_create, to_cancel
+
+
+def main():
+    if len(sys.argv) > 1:
+        events = list(market_events(sys.argv[1], SYMBOL))
+    else:
+        events = synthetic_events()
+    print("%d market events; ORDER_PAIRS %d, INTERVAL %s, RELIST_INTERVAL %s" %
+          (len(events), settings.ORDER_PAIRS, settings.INTERVAL, settings.RELIST_INTERVAL))
+
+    print("%-8s %6s %8s %8s %8s %9s %12s %10s" %
+          ('', 'ticks', 'amends', 'creates', 'cancels', 'requests', 'requests/tick', 'diff (us)'))
+    for name, orderManagerClass in [('legacy', LegacyOrderManager), ('aligned', OrderManager)]:
+        timed = timed_diff(orderManagerClass)
+        report = Backtest(SimulatedExchange(SYMBOL, events), timed).run()
+        print("%-8s %6d %8d %8d %8d %9d %12.2f %10.1f" %
+              (name, report['ticks'], report['amends'], report['creates'], report['cancels'], report['requests'],
+               report['requests'] / max(1, report['ticks']), 1e6 * timed.diffTime / max(1, timed.diffCalls)))
+
+    for title, scenario in [("One middle level (3 of 6) filled", middle_fill),
+                            ("Nothing changed, orders listed inside out (e.g. after a resync)", relisted)]:
+        print("\n%s:" % title)
+        for name, orderManagerClass in [('legacy', LegacyOrderManager), ('aligned', OrderManager)]:
+            ladder, existing = scenario()
+            om = orderManagerClass.__new__(orderManagerClass)
+            to_amend, to_create, to_cancel = om.diff_orders(existing, ladder, [])
+            print("%-8s %d amends, %d creates, %d cancels" % (name, len(to_amend), len(to_create), len(to_cancel)))
+
+
+def timed_diff(orderManagerClass):
+    """Subclass that totals the time spent in diff_orders."""
+    class Timed(orderManagerClass):
+        diffTime = 0.0
+        diffCalls = 0
+
+        def diff_orders(self, *args):
+            start = time.perf_counter()
+            result = super(Timed, self).diff_orders(*args)
+            Timed.diffTime += time.perf_counter() - start
+            Timed.diffCalls += 1
+            return result
+    return Timed
+
+
+def buy_ladder():
+    """Desired buys, outside in (as place_orders makes them), and the orders placed for them, in creation order."""
+    ladder = [{'price': 9950.0 - 50 * i, 'orderQty': 100 * (i + 1), 'side': 'Buy'} for i in reversed(range(6))]
+    existing = [dict(o, orderID=str(i), leavesQty=o['orderQty'], cumQty=0) for i, o in enumerate(ladder)]
+    return ladder, existing
+
+
+def middle_fill():
+    ladder, existing = buy_ladder()
+    del existing[3]
+    return ladder, existing
+
+
+def relisted():
+    ladder, existing = buy_ladder()
+    return ladder, list(reversed(existing))
+
+
+def synthetic_events():
+    rand = random.Random(7)
+    t = start = 1.5e9
+    mid = 10000.0
+    events = [(t, 'instrument', {'symbol': SYMBOL, 'tickSize': 0.5, 'state': 'Open', 'isInverse': True,
+                                 'bidPrice': mid - 0.5, 'askPrice': mid, 'lastPrice': mid, 'midPrice': mid,
+                                 'markPrice': mid})]
+    while t < start + HOURS * 3600:
+        t += rand.expovariate(5)
+        if rand.random() < 0.6:
+            if rand.random() < 0.3:
+                mid += rand.choice([-10, 0, 10])
+            events.append((t, 'quote', {'symbol': SYMBOL, 'bidPrice': mid - 0.5, 'askPrice': mid,
+                                        'bidSize': rand.randint(100, 50000), 'askSize': rand.randint(100, 50000)}))
+        else:
+            side = rand.choice(['Buy', 'Sell'])
+            price = mid if side == 'Buy' else mid - 0.5
+            if rand.random() < 0.02:
+                # A sweep through a few levels
+                price += rand.choice([60, 110, 160]) * (1 if side == 'Buy' else -1)
+            events.append((t, 'trade', {'symbol': SYMBOL, 'side': side, 'price': price,
+                                        'size': rand.randint(1, 100000)}))
+    return events
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from market_maker.ws.feed import FeedHandler, FeedReader
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+###
+# feed-benchmark.py
+#
+# Compares the cost of market data for many bots on one host: each bot decoding the /realtime stream itself,
+# against one feed handler decoding it and publishing to shared memory for the bots to read.
+#
+# Usage: python test/feed-benchmark.py [bots]
+#
+# Run from a marketmaker project (it needs settings.py). Replays a synthetic corpus of instrument updates
+# (for XBTUSD and, as the unfiltered subscription sends them, other instruments), XBTUSD quotes and trades
+# through a plain BitMEXWebsocket (what every bot does without a feed) and through a FeedHandler, ticking a bot
+# (reading its ticker and instrument) every few messages. Then totals the CPU per second for many bots.
+###
+
+SYMBOL = "XBTUSD"
+# The instrument subscription isn't filtered: every bot also receives every other instrument's updates.
+OTHER_SYMBOLS = ["ETHUSD", "XBTZ20", "XBTH21", "ETHZ20", ".BXBT", ".BETH"]
+MESSAGES = 50000
+# For the per-second totals: messages received for our symbol and the others, and ticks made. An event-driven bot
+# re-quotes at most once per UPDATE_DEBOUNCE (0.05s).
+MESSAGES_PER_SECOND = 100
+TICKS_PER_SECOND = 20
+
+
+def main():
+    bots = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    corpus = synthetic_corpus()
+    directory = tempfile.mkdtemp()
+    every = MESSAGES_PER_SECOND // TICKS_PER_SECOND
+
+    # Without a feed, every bot decodes every message itself.
+    ws = BitMEXWebsocket()
+    ws.open_replay(SYMBOL, shouldAuth=False)
+    decode, wsTick = replay(ws, corpus, ws, every)
+    direct = report("decode, per bot", len(corpus), decode)
+
+    # With one, the feed handler decodes and publishes each message once, and bots read what changed.
+    path = os.path.join(directory, 'feed')
+    handler = FeedHandler(path, [SYMBOL])
+    handler.ws.open_replay(SYMBOL, shouldAuth=False)
+    bot = BitMEXWebsocket(feed=FeedReader(path))
+    publishing, feedTick = replay(handler.ws, corpus, bot, every)
+    publish = report("decode + publish, once", len(corpus), publishing)
+    assert bot.get_ticker(SYMBOL) == ws.get_ticker(SYMBOL), "feed and websocket disagree"
+
+    ticks = len(corpus) // every
+    wsRead = report("tick reads, websocket", ticks, wsTick)
+    feedRead = report("tick reads, feed", ticks, feedTick)
+
+    print("")
+    print("Market data CPU per second for %d bots (%d messages/s, %d ticks/s each):" %
+          (bots, MESSAGES_PER_SECOND, TICKS_PER_SECOND))
+    print("  each with its own websocket  %6.2fms" %
+          (bots * (MESSAGES_PER_SECOND * direct + TICKS_PER_SECOND * wsRead) / 1000))
+    print("  one feed handler             %6.2fms" %
+          ((MESSAGES_PER_SECOND * publish + bots * TICKS_PER_SECOND * feedRead) / 1000))
+    handler.exit()
+
+
+def replay(ws, corpus, bot, every):
+    """Feed `corpus` to `ws`, ticking `bot` every `every` messages. Returns the seconds spent in each."""
+    handling = reading = 0
+    for i, frame in enumerate(corpus):
+        start = time.perf_counter()
+        ws.replay(frame)
+        handling += time.perf_counter() - start
+        if i % every == 0:
+            start = time.perf_counter()
+            bot.get_ticker(SYMBOL)
+            bot.get_instrument(SYMBOL)
+            reading += time.perf_counter() - start
+    return handling, reading
+
+
+def report(name, count, elapsed):
+    perCall = elapsed / count * 1e6
+    print("%-24s %8.2fus each  (%.3fs)" % (name, perCall, elapsed))
+    return perCall
+
+
+def synthetic_corpus():
+    rand = random.Random(42)
+    instrument = {'symbol': SYMBOL, 'rootSymbol': 'XBT', 'state': 'Open', 'typ': 'FFWCSX', 'tickSize': 0.5,
+                  'lotSize': 1, 'multiplier': -100000000, 'isQuanto': False, 'isInverse': True,
+                  'underlyingToSettleMultiplier': -100000000, 'quoteToSettleMultiplier': None,
+                  'initMargin': 0.01, 'maintMargin': 0.005, 'makerFee': -0.00025, 'takerFee': 0.00075,
+                  'fundingRate': 0.0001, 'indicativeFundingRate': 0.0001, 'openInterest': 1000000,
+                  'volume': 0, 'volume24h': 0, 'turnover': 0, 'vwap': 10000.0, 'highPrice': 10100.0,
+                  'lowPrice': 9900.0, 'lastPrice': 10000.0, 'lastTickDirection': 'PlusTick',
+                  'bidPrice': 9999.5, 'askPrice': 10000.0, 'midPrice': 9999.75, 'markPrice': 10000.12,
+                  'fairPrice': 10000.12, 'indicativeSettlePrice': 10000.0, 'timestamp': '2018-01-01T00:00:00.000Z'}
+    frames = [
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'],
+         'data': [instrument] + [dict(instrument, symbol=symbol) for symbol in OTHER_SYMBOLS]},
+        {'table': 'quote', 'action': 'partial', 'keys': [], 'data': []},
+        {'table': 'trade', 'action': 'partial', 'keys': [], 'data': []},
+    ]
+    for _ in range(MESSAGES):
+        roll = rand.random()
+        price = 10000.0 + rand.randint(-20, 20) * 0.5
+        stamp = '2018-01-01T00:00:%02d.%03dZ' % (rand.randint(0, 59), rand.randint(0, 999))
+        if roll < 0.2:
+            frames.append({'table': 'instrument', 'action': 'update',
+                           'data': [{'symbol': SYMBOL, 'bidPrice': price, 'askPrice': price + 0.5,
+                                     'midPrice': price + 0.25, 'timestamp': stamp}]})
+        elif roll < 0.4:
+            frames.append({'table': 'instrument', 'action': 'update',
+                           'data': [{'symbol': rand.choice(OTHER_SYMBOLS), 'fairPrice': price,
+                                     'markPrice': price, 'openInterest': rand.randint(1, 10 ** 8),
+                                     'timestamp': stamp}]})
+        elif roll < 0.7:
+            frames.append({'table': 'quote', 'action': 'insert',
+                           'data': [{'symbol': SYMBOL, 'bidSize': rand.randint(1, 9999), 'bidPrice': price,
+                                     'askPrice': price + 0.5, 'askSize': rand.randint(1, 9999), 'timestamp': stamp}]})
+        else:
+            frames.append({'table': 'trade', 'action': 'insert',
+                           'data': [{'symbol': SYMBOL, 'side': rand.choice(['Buy', 'Sell']), 'price': price,
+                                     'size': rand.randint(1, 5000), 'tickDirection': 'PlusTick',
+                                     'trdMatchID': '%032x' % rand.getrandbits(128), 'timestamp': stamp}]})
+    return [json.dumps(frame) for frame in frames]
+
+
+if __name__ == "__main__":
+    main()
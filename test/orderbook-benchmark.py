@@ -0,0 +1,94 @@
+import json
+import random
+import sys
+import time
+
+from market_maker.utils.recorder import Replayer
+from market_maker.ws.orderbook import OrderBookL2
+
+###
+# orderbook-benchmark.py
+#
+# Measures how many L2 rows per second OrderBookL2 can apply.
+#
+# Usage: python test/orderbook-benchmark.py [stream.jsonl | recording.gz]
+# (with market_maker importable, e.g. after `make dev`)
+#
+# The stream is a file of raw orderBookL2 / orderBookL2_25 websocket frames, one per line, as
+# received from /realtime, or a RECORD_FILE recording. Without one, a synthetic XBTUSD stream
+# with a realistic mix of actions (mostly size updates, some level inserts and deletes) is generated.
+###
+
+SYMBOL = "XBTUSD"
+TICK = 0.5
+MESSAGES = 200000
+
+
+def load_frames(path):
+    """Read raw frames from a recording (see utils.recorder) or a plain file of one frame per line."""
+    if path.endswith('.gz'):
+        return [frame for _, frame in Replayer(path).frames()]
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def main():
+    if len(sys.argv) > 1:
+        messages = [json.loads(frame) for frame in load_frames(sys.argv[1])]
+        messages = [m for m in messages if m.get('table', '').startswith('orderBookL2')]
+    else:
+        messages = synthetic_stream()
+
+    rows = sum(len(m['data']) for m in messages)
+    book = OrderBookL2(SYMBOL)
+    start = time.perf_counter()
+    for message in messages:
+        getattr(book, message['action'])(message['data'])
+    elapsed = time.perf_counter() - start
+
+    print("Applied %d messages (%d rows) in %.3fs" % (len(messages), rows, elapsed))
+    print("%.0f messages/s, %.0f rows/s" % (len(messages) / elapsed, rows / elapsed))
+    print("Final book: %d levels, %r" % (len(book), book))
+
+
+def synthetic_stream():
+    """Generate a partial of 25 levels a side followed by MESSAGES incremental messages."""
+    rand = random.Random(42)
+    mid = 10000.0
+
+    def level(price, side):
+        # BitMEX level ids count down as price goes up.
+        return {'symbol': SYMBOL, 'id': int(8800000000 - price / TICK), 'side': side,
+                'size': rand.randint(1, 50000), 'price': price}
+
+    live = {}
+    partial = []
+    for n in range(1, 26):
+        for row in (level(mid - n * TICK, 'Buy'), level(mid + n * TICK, 'Sell')):
+            live[row['id']] = row
+            partial.append(row)
+    messages = [{'table': 'orderBookL2_25', 'action': 'partial', 'data': partial}]
+
+    for _ in range(MESSAGES):
+        roll = rand.random()
+        if roll < 0.85:
+            row = live[rand.choice(list(live))]
+            messages.append({'table': 'orderBookL2_25', 'action': 'update',
+                             'data': [{'symbol': SYMBOL, 'id': row['id'], 'side': row['side'],
+                                       'size': rand.randint(1, 50000)}]})
+        elif roll < 0.93 or len(live) < 40:
+            side = rand.choice(['Buy', 'Sell'])
+            offset = rand.randint(1, 40) * TICK
+            row = level(mid - offset if side == 'Buy' else mid + offset, side)
+            if row['id'] not in live:
+                live[row['id']] = row
+                messages.append({'table': 'orderBookL2_25', 'action': 'insert', 'data': [row]})
+        else:
+            row = live.pop(rand.choice(list(live)))
+            messages.append({'table': 'orderBookL2_25', 'action': 'delete',
+                             'data': [{'symbol': SYMBOL, 'id': row['id'], 'side': row['side']}]})
+    return messages
+
+
+if __name__ == "__main__":
+    main()
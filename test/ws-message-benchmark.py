@@ -0,0 +1,108 @@
+import json
+import random
+import sys
+import time
+
+from market_maker.utils import fastjson
+from market_maker.utils.recorder import Replayer
+from market_maker.ws.ws_thread import BitMEXWebsocket
+
+###
+# ws-message-benchmark.py
+#
+# Measures websocket message handling throughput, in messages per second.
+#
+# Usage: python test/ws-message-benchmark.py [corpus.jsonl | recording.gz]
+#
+# Run from a marketmaker project (it needs settings.py). The corpus is a file of raw /realtime
+# frames, one per line, or a RECORD_FILE recording. Without one, a synthetic XBTUSD corpus of
+# instrument updates, quotes, trades and order updates is generated.
+#
+# Reports JSON decoding alone with each installed parser, then the full BitMEXWebsocket message
+# handler using the parser `fastjson` picked.
+###
+
+SYMBOL = "XBTUSD"
+MESSAGES = 100000
+
+
+def load_frames(path):
+    """Read raw frames from a recording (see utils.recorder) or a plain file of one frame per line."""
+    if path.endswith('.gz'):
+        return [frame for _, frame in Replayer(path).frames()]
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def main():
+    if len(sys.argv) > 1:
+        corpus = load_frames(sys.argv[1])
+    else:
+        corpus = synthetic_corpus()
+    size = sum(len(frame) for frame in corpus)
+    print("Corpus: %d messages, %.1f MB" % (len(corpus), size / 1e6))
+
+    decoders = [('json', json.loads)]
+    for name in ['ujson', 'orjson']:
+        try:
+            decoders.append((name, __import__(name).loads))
+        except ImportError:
+            pass
+    for name, loads in decoders:
+        start = time.perf_counter()
+        for frame in corpus:
+            loads(frame)
+        report("decode (%s)" % name, len(corpus), time.perf_counter() - start)
+
+    ws = BitMEXWebsocket()
+    ws.open_replay(SYMBOL)
+    start = time.perf_counter()
+    for frame in corpus:
+        ws.replay(frame)
+    report("__on_message (%s)" % fastjson.DECODER, len(corpus), time.perf_counter() - start)
+
+
+def report(name, count, elapsed):
+    print("%-24s %9.0f msg/s  (%.3fs)" % (name, count / elapsed, elapsed))
+
+
+def synthetic_corpus():
+    rand = random.Random(42)
+    instrument = {'symbol': SYMBOL, 'tickSize': 0.5, 'lastPrice': 10000.0, 'bidPrice': 9999.5, 'askPrice': 10000.0,
+                  'midPrice': 9999.75, 'markPrice': 10000.12, 'state': 'Open', 'openInterest': 1000000,
+                  'fundingRate': 0.0001, 'timestamp': '2018-01-01T00:00:00.000Z'}
+    orders = [{'orderID': 'order-%d' % i, 'clOrdID': 'mm_bitmex_%d' % i, 'symbol': SYMBOL,
+               'side': 'Buy' if i % 2 else 'Sell', 'price': 10000.0 + (i - 6) * 50, 'orderQty': 100,
+               'leavesQty': 100, 'cumQty': 0, 'ordStatus': 'New', 'timestamp': '2018-01-01T00:00:00.000Z'}
+              for i in range(12)]
+    frames = [
+        {'table': 'instrument', 'action': 'partial', 'keys': ['symbol'], 'data': [instrument]},
+        {'table': 'order', 'action': 'partial', 'keys': ['orderID'], 'data': orders},
+        {'table': 'quote', 'action': 'partial', 'keys': [], 'data': []},
+        {'table': 'trade', 'action': 'partial', 'keys': [], 'data': []},
+    ]
+    for _ in range(MESSAGES):
+        roll = rand.random()
+        price = 10000.0 + rand.randint(-20, 20) * 0.5
+        stamp = '2018-01-01T00:00:%02d.%03dZ' % (rand.randint(0, 59), rand.randint(0, 999))
+        if roll < 0.4:
+            frames.append({'table': 'instrument', 'action': 'update',
+                           'data': [{'symbol': SYMBOL, 'bidPrice': price, 'timestamp': stamp}]})
+        elif roll < 0.7:
+            frames.append({'table': 'quote', 'action': 'insert',
+                           'data': [{'symbol': SYMBOL, 'bidSize': rand.randint(1, 9999), 'bidPrice': price,
+                                     'askPrice': price + 0.5, 'askSize': rand.randint(1, 9999), 'timestamp': stamp}]})
+        elif roll < 0.95:
+            frames.append({'table': 'trade', 'action': 'insert',
+                           'data': [{'symbol': SYMBOL, 'side': rand.choice(['Buy', 'Sell']), 'price': price,
+                                     'size': rand.randint(1, 5000), 'tickDirection': 'PlusTick',
+                                     'trdMatchID': '%032x' % rand.getrandbits(128), 'timestamp': stamp}]})
+        else:
+            order = rand.choice(orders)
+            frames.append({'table': 'order', 'action': 'update',
+                           'data': [{'orderID': order['orderID'], 'price': price, 'timestamp': stamp}]})
+    return [json.dumps(frame) for frame in frames]
+
+
+if __name__ == "__main__":
+    main()